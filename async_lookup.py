@@ -0,0 +1,184 @@
+"""
+Concurrent ISBN lookups and cover downloads with asyncio
+
+isbn_lookup makes one request at a time, which is what the form needs but
+is slow for big imports and enrichment runs while Open Library takes its
+time answering. AsyncLookupEngine keeps up to `concurrency` requests going
+at once:
+
+    async with AsyncLookupEngine(concurrency=8) as engine:
+        results = await engine.lookup_isbns(isbns)
+        saved = await engine.download_cover(url, path)
+
+Scripts and the Tk app (from a worker thread) can use the plain functions
+instead, which run an event loop for the duration of the call:
+
+    books = async_lookup.fetch_books(isbns, covers=True, concurrency=8)
+
+There is no asyncio HTTP client among the app's dependencies, so requests
+run on the engine's own pool of `concurrency` threads, through
+isbn_lookup's own code. That means the same per-thread requests Sessions
+(connections to each host are kept open and reused), retries, parsing and
+caching, and so exactly the same results. The event loop bounds the
+concurrency, puts an overall timeout on each request and handles
+cancellation.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import isbn_lookup
+
+CONCURRENCY = 8             # requests in flight at once
+# Longest to wait for one request, including its retries
+REQUEST_TIMEOUT = isbn_lookup.TIMEOUT * (isbn_lookup.RETRIES + 1)
+STOP_POLL = 0.05            # seconds between should_stop() checks in the sync functions
+
+
+class AsyncLookupEngine:
+    """Runs isbn_lookup requests concurrently, at most concurrency at a time"""
+
+    def __init__(self, concurrency=CONCURRENCY, timeout=REQUEST_TIMEOUT,
+                 batch_size=isbn_lookup.BATCH_SIZE):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self._executor = None
+        self._semaphore = None
+        self.requests = 0       # requests started
+        self.timeouts = 0       # requests given up on after timeout seconds
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        """Create the worker threads (done by async with)"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                thread_name_prefix="async-lookup")
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    def close(self):
+        """Stop the worker threads, dropping requests that haven't started"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, func, *args):
+        """Run a blocking isbn_lookup call on a worker thread, with the timeout"""
+        async with self._semaphore:
+            self.requests += 1
+            future = asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise
+
+    async def lookup_isbns(self, isbns, use_cache=True):
+        """
+        Look up many ISBNs, up to batch_size per request and concurrency
+        requests at once
+
+        Returns the same dict as isbn_lookup.lookup_isbns. ISBNs whose
+        request failed, timed out or was cancelled map to None and aren't
+        cached, even if the answer arrives later.
+        """
+        results, wanted = isbn_lookup.check_cache(isbns, use_cache)
+        pending = list(wanted)
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        for answers in await asyncio.gather(*(self._lookup_batch(batch) for batch in batches)):
+            for isbn_clean, result in answers.items():
+                for isbn in wanted[isbn_clean]:
+                    results[isbn] = result
+        return results
+
+    async def _lookup_batch(self, batch):
+        # A worker thread can't be stopped mid-request, so one that is given
+        # up on still finishes its request; the cancel Event stops it caching
+        cancel = threading.Event()
+        try:
+            return await self._run(isbn_lookup.fetch_batch, batch, cancel)
+        except asyncio.TimeoutError:
+            return {}       # like a failed request: tried again next time
+        finally:
+            cancel.set()
+
+    async def lookup_isbn(self, isbn, use_cache=True):
+        """Look up one ISBN (see isbn_lookup.lookup_isbn)"""
+        return (await self.lookup_isbns([isbn], use_cache))[isbn]
+
+    async def download_cover(self, cover_url, save_path, max_bytes=isbn_lookup.MAX_COVER_BYTES):
+        """
+        Download a cover like isbn_lookup.download_cover, returning True if saved
+
+        If it times out or the task is cancelled, the download is stopped
+        at its next chunk and nothing is left behind.
+        """
+        cancel = threading.Event()
+        try:
+            return await self._run(isbn_lookup.download_cover, cover_url, save_path,
+                                   max_bytes, cancel)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            cancel.set()
+
+    async def fetch_books(self, isbns, covers=True, use_cache=True):
+        """
+        Look up ISBNs and download their covers
+
+        Returns {isbn: (result, cover_path)} like the app's single lookup:
+        result is None if not found, cover_path None if there was no cover
+        (or covers is False).
+        """
+        results = await self.lookup_isbns(isbns, use_cache)
+        wanted = [isbn for isbn, result in results.items()
+                  if covers and result and result.get('cover_url')]
+        paths = [isbn_lookup.get_cover_path(isbn) for isbn in wanted]
+        saved = await asyncio.gather(*(self.download_cover(results[isbn]['cover_url'], path)
+                                       for isbn, path in zip(wanted, paths)))
+        cover_paths = {isbn: path for isbn, path, ok in zip(wanted, paths, saved) if ok}
+        return {isbn: (result, cover_paths.get(isbn)) for isbn, result in results.items()}
+
+
+def _run_sync(work, concurrency, batch_size, should_stop):
+    """Run work(engine) on a new event loop; None if should_stop() said to stop"""
+    async def main():
+        async with AsyncLookupEngine(concurrency, batch_size=batch_size) as engine:
+            task = asyncio.ensure_future(work(engine))
+            while should_stop is not None and not task.done():
+                if should_stop():
+                    task.cancel()
+                    break
+                await asyncio.wait({task}, timeout=STOP_POLL)
+            try:
+                return await task
+            except asyncio.CancelledError:
+                return None
+
+    return asyncio.run(main())
+
+
+def lookup_isbns(isbns, concurrency=CONCURRENCY, use_cache=True, should_stop=None,
+                 batch_size=isbn_lookup.BATCH_SIZE):
+    """
+    Blocking version of AsyncLookupEngine.lookup_isbns, for scripts and worker threads
+
+    should_stop() is checked every STOP_POLL seconds; once it returns True
+    the lookups are cancelled and None is returned.
+    """
+    return _run_sync(lambda engine: engine.lookup_isbns(isbns, use_cache),
+                     concurrency, batch_size, should_stop)
+
+
+def fetch_books(isbns, covers=True, concurrency=CONCURRENCY, use_cache=True, should_stop=None,
+                batch_size=isbn_lookup.BATCH_SIZE):
+    """Blocking version of AsyncLookupEngine.fetch_books (see lookup_isbns for should_stop)"""
+    return _run_sync(lambda engine: engine.fetch_books(isbns, covers, use_cache),
+                     concurrency, batch_size, should_stop)
@@ -0,0 +1,140 @@
+"""
+Background work for Callum's Library App
+
+Runs slow functions (database queries, network lookups) on worker threads
+and hands their results back to the Tk main thread, which is the only
+thread allowed to touch widgets. Results travel through a queue that the
+main thread polls with root.after().
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Task:
+    """A function submitted to BackgroundTasks"""
+
+    def __init__(self, key):
+        self.key = key
+        self.future = None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Stop the task if it hasn't started, and discard its result either way"""
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    @property
+    def cancelled(self):
+        """Whether cancel() was called (worker functions can check this to stop early)"""
+        return self._cancelled.is_set()
+
+
+class BackgroundTasks:
+    """
+    Thread pool whose results are delivered on the Tk main thread
+
+    Tasks submitted with the same key supersede each other: only the most
+    recent one delivers its result, so a slow, outdated query can never
+    overwrite a newer one.
+    """
+
+    def __init__(self, root, max_workers=4, poll_ms=30):
+        self.root = root
+        self.poll_ms = poll_ms
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="library-worker")
+        self._results = queue.Queue()
+        self._latest = {}       # key -> newest Task for that key
+        self._pending = 0       # tasks whose results haven't been delivered yet
+        self._poll_id = None
+
+    def submit(self, func, *args, on_done=None, on_error=None, key=None, pass_task=False,
+               **kwargs):
+        """
+        Run func(*args, **kwargs) on a worker thread
+
+        on_done(result) or on_error(exception) is then called on the main
+        thread, unless the task was cancelled or superseded by a newer task
+        with the same key. With pass_task=True the Task is passed as func's
+        first argument, so long jobs can check task.cancelled and stop early.
+        Returns the Task.
+        """
+        task = Task(key)
+        if pass_task:
+            args = (task,) + args
+        if key is not None:
+            previous = self._latest.get(key)
+            if previous is not None:
+                previous.cancel()
+            self._latest[key] = task
+
+        def run():
+            if task.cancelled:
+                self._results.put((task, None, None, on_done, on_error))
+                return
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self._results.put((task, None, e, on_done, on_error))
+            else:
+                self._results.put((task, result, None, on_done, on_error))
+
+        def report_if_cancelled(future):
+            # A future cancelled before it started never runs run(), so report it here
+            if future.cancelled():
+                self._results.put((task, None, None, on_done, on_error))
+
+        self._pending += 1
+        task.future = self._executor.submit(run)
+        task.future.add_done_callback(report_if_cancelled)
+        self._start_polling()
+        return task
+
+    def is_latest(self, task):
+        """Whether task is still the newest one for its key"""
+        return task.key is None or self._latest.get(task.key) is task
+
+    def shutdown(self):
+        """Stop polling and abandon outstanding work (call when the window closes)"""
+        for task in self._latest.values():
+            task.cancel()
+        if self._poll_id is not None:
+            self.root.after_cancel(self._poll_id)
+            self._poll_id = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _start_polling(self):
+        if self._poll_id is None:
+            self._poll_id = self.root.after(self.poll_ms, self._poll)
+
+    def _poll(self):
+        self._poll_id = None
+        while True:
+            try:
+                task, result, error, on_done, on_error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._pending -= 1
+            self._deliver(task, result, error, on_done, on_error)
+
+        if self._pending:
+            self._start_polling()
+
+    def _deliver(self, task, result, error, on_done, on_error):
+        if task.key is not None:
+            if self._latest.get(task.key) is not task:
+                return      # superseded by a newer task
+            del self._latest[task.key]
+        if task.cancelled:
+            return
+
+        if error is not None:
+            if on_error:
+                on_error(error)
+            else:
+                print(f"Background task failed: {error!r}")
+        elif on_done:
+            on_done(result)
@@ -0,0 +1,505 @@
+"""
+Performance benchmarks for Callum's Library App
+
+Run with:  python benchmark.py [name ...]
+Each benchmark builds its own throwaway database in a temp folder,
+so the real library.db is never touched.
+"""
+
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import connection_manager
+import database
+import migrations
+
+
+def use_temp_database(folder, name="bench.db"):
+    """Point database.py at a fresh database inside folder"""
+    connection_manager.close_all()
+    database.DB_PATH = Path(folder) / name
+    database.init_database()
+
+
+WORDS = ("shadow river night glass garden winter empire silent iron crown storm "
+         "dragon city house ocean stone dream fire secret journey moon forest "
+         "king queen star war lost last blood golden hidden dark light child").split()
+SYLLABLES = "ka lo mi ra ven tor sel dan bri quo fen ath ul mor ith zan pe gor lis nad".split()
+NAMES = ("Smith Jones Taylor Brown Williams Wilson Johnson Davies Robinson Wright "
+         "Thompson Evans Walker White Roberts Green Hall Wood Jackson Clarke").split()
+
+
+def _vocabulary(size, seed):
+    """Made-up words so that, like a real catalogue, most words are rare"""
+    rng = random.Random(seed)
+    return [''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(size)]
+
+
+def synthetic_books(count, seed=1):
+    """Generate reproducible book rows as dicts"""
+    rng = random.Random(seed)
+    vocabulary = WORDS + _vocabulary(5000, seed)
+    for i in range(count):
+        title = ' '.join(rng.choice(vocabulary).capitalize() for _ in range(rng.randint(1, 4)))
+        yield {
+            'isbn': f"978{i:010d}",
+            'title': f"{title} {i}",
+            'year': str(rng.randint(1950, 2024)),
+            'author': f"{rng.choice(NAMES[:10])[0]}. {rng.choice(NAMES)}",
+            'artist': rng.choice(NAMES) if rng.random() < 0.2 else None,
+            'publisher': f"{rng.choice(NAMES)} Press",
+            'page_count': rng.randint(32, 900),
+            'description': ' '.join(rng.choice(WORDS) for _ in range(60)),
+        }
+
+
+def populate_books(count, seed=1):
+    """Fill the current benchmark database with synthetic books"""
+    conn = connection_manager.get_connection(database.DB_PATH)
+    with connection_manager.transaction(conn):
+        conn.executemany("""
+            INSERT INTO books (isbn, title, year, author, artist, publisher, page_count, description)
+            VALUES (:isbn, :title, :year, :author, :artist, :publisher, :page_count, :description)
+        """, synthetic_books(count, seed))
+
+
+def populate_loans(count, book_count, seed=1):
+    """Lend out count random books from the first book_count (none returned yet)"""
+    rng = random.Random(seed)
+    conn = connection_manager.get_connection(database.DB_PATH)
+    with connection_manager.transaction(conn):
+        conn.executemany("""
+            INSERT INTO loans (book_id, borrower_name, date_loaned, date_due)
+            VALUES (?, ?, '2024-01-01T00:00:00', '2024-01-31T00:00:00')
+        """, ((book_id, rng.choice(NAMES)) for book_id in rng.sample(range(1, book_count + 1), count)))
+
+
+def time_ms(func, repeat=5):
+    """Median wall time of func() in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def calls_per_second(func, duration=1.0):
+    """Call func repeatedly for about `duration` seconds and return the rate"""
+    calls = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            func()
+        calls += 100
+    return calls / (time.perf_counter() - start)
+
+
+def bench_connections():
+    """Connect-per-call (the old behaviour) vs the pooled connection manager"""
+    print("Connection reuse: get_book / get_current_loan calls per second")
+
+    with tempfile.TemporaryDirectory() as folder:
+        use_temp_database(folder)
+        book_id = database.add_book("9780451526538", "Nineteen Eighty-Four", "1949", "George Orwell")
+        database.loan_book(book_id, "Rowan")
+
+        def get_book_unpooled():
+            conn = sqlite3.connect(database.DB_PATH)
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM books WHERE id = ?", (book_id,))
+            book = cursor.fetchone()
+            conn.close()
+            return dict(book) if book else None
+
+        def get_current_loan_unpooled():
+            conn = sqlite3.connect(database.DB_PATH)
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT * FROM loans
+                WHERE book_id = ? AND date_returned IS NULL
+                ORDER BY date_loaned DESC
+                LIMIT 1
+            """, (book_id,))
+            loan = cursor.fetchone()
+            conn.close()
+            return dict(loan) if loan else None
+
+        cases = [
+            ("get_book", get_book_unpooled, lambda: database.get_book(book_id)),
+            ("get_current_loan", get_current_loan_unpooled, lambda: database.get_current_loan(book_id)),
+        ]
+        for name, before, after in cases:
+            before_rate = calls_per_second(before)
+            after_rate = calls_per_second(after)
+            print(f"  {name:.<30} before {before_rate:>10,.0f}/s   "
+                  f"after {after_rate:>10,.0f}/s   ({after_rate / before_rate:.1f}x)")
+
+        connection_manager.close_all()
+
+
+def bench_search(count=80_000):
+    """Per-keystroke quick search: LIKE table scan vs the FTS5 index"""
+    print(f"Search: milliseconds per keystroke on {count:,} books")
+
+    with tempfile.TemporaryDirectory() as folder:
+        use_temp_database(folder)
+        if not migrations.fts5_available():
+            print("  (skipped - this SQLite build has no FTS5)")
+            return
+        populate_books(count)
+
+        # Typing "golden dr" one key at a time, as the library search box sees it
+        typed = "golden dr"
+        keystrokes = [typed[:n] for n in range(1, len(typed) + 1) if typed[n - 1] != ' ']
+        for label, search in (("LIKE scan", database._search_books_like),
+                              ("FTS5 index", database.search_books)):
+            per_key = [time_ms(lambda q=q: search(q), repeat=3) for q in keystrokes]
+            print(f"  {label:.<30} median {statistics.median(per_key):>8.1f} ms   "
+                  f"worst {max(per_key):>8.1f} ms")
+
+        advanced = dict(title="dragon", author="smith")
+        like_ms = time_ms(lambda: database._advanced_search_like(**advanced))
+        fts_ms = time_ms(lambda: database.advanced_search(**advanced))
+        print(f"  {'advanced_search (LIKE)':.<30} {like_ms:>8.1f} ms")
+        print(f"  {'advanced_search (FTS5)':.<30} {fts_ms:>8.1f} ms")
+
+        connection_manager.close_all()
+
+
+def bench_bulk_insert(count=50_000):
+    """add_book one at a time vs add_books_bulk in one transaction"""
+    print("Bulk insert: books inserted per second (target 10,000/s)")
+
+    with tempfile.TemporaryDirectory() as folder:
+        use_temp_database(folder)
+        sample = 2_000
+        records = list(synthetic_books(sample, seed=2))
+        start = time.perf_counter()
+        for record in records:
+            database.add_book(**record)
+        single_rate = sample / (time.perf_counter() - start)
+        print(f"  {'add_book':.<30} {single_rate:>10,.0f}/s   ({sample:,} books)")
+
+        use_temp_database(folder, "bulk.db")
+        records = list(synthetic_books(count, seed=3))
+        start = time.perf_counter()
+        outcomes = database.add_books_bulk(records)
+        bulk_rate = count / (time.perf_counter() - start)
+        inserted = sum(1 for outcome in outcomes if outcome['status'] == 'inserted')
+        print(f"  {'add_books_bulk':.<30} {bulk_rate:>10,.0f}/s   ({inserted:,} books)  "
+              f"{'✓' if bulk_rate >= 10_000 else '✗ below target'}")
+
+        connection_manager.close_all()
+
+
+def bench_paging(count=100_000):
+    """Loading the whole library list vs paging through it a screen at a time"""
+    print(f"Library list: {count:,} books")
+    from library_app import BookListSource
+    from widgets import PagedRows
+
+    with tempfile.TemporaryDirectory() as folder:
+        use_temp_database(folder)
+        populate_books(count)
+
+        print(f"  {'get_all_books (old list)':.<40} {time_ms(database.get_all_books, repeat=3):>8.1f} ms")
+
+        visible = 30
+        model = PagedRows(BookListSource())
+        steps = []
+        for top in range(0, 20_000, 3):          # wheel-scrolling three rows at a time
+            start = time.perf_counter()
+            model.rows(top, visible)
+            steps.append((time.perf_counter() - start) * 1000)
+        print(f"  {'scroll step (3 rows)':.<40} mean {statistics.mean(steps):>6.3f} ms   "
+              f"worst {max(steps):>6.2f} ms")
+
+        jumps = []
+        for letter in "aeimqu":
+            start = time.perf_counter()
+            model.rows(model.position_of((letter, 0)), visible)
+            jumps.append((time.perf_counter() - start) * 1000)
+        print(f"  {'jump to letter':.<40} mean {statistics.mean(jumps):>6.1f} ms   "
+              f"worst {max(jumps):>6.1f} ms")
+
+        drags = [time_ms(lambda f=f: PagedRows(BookListSource()).rows(int(f * count), visible), repeat=1)
+                 for f in (0.25, 0.5, 0.9)]
+        print(f"  {'scrollbar drag (new position)':.<40} worst {max(drags):>6.1f} ms")
+
+        connection_manager.close_all()
+
+
+def peak_memory_mb(func):
+    """Peak Python memory allocated while running func(), in MB"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def bench_listing(count=100_000):
+    """'Show All' in the search tab: full dict rows vs BookSummary projections"""
+    print(f"Search tab listing: {count:,} books")
+
+    with tempfile.TemporaryDirectory() as folder:
+        use_temp_database(folder)
+        populate_books(count)
+        populate_loans(count // 10, count)
+
+        def status_per_row():
+            # What a status column would cost without the join: one query per book
+            return [(book, database.get_current_loan(book.id)) for book in database.get_book_summaries()]
+
+        cases = (
+            ("show all: SELECT * dicts (old)", database.get_all_books),
+            ("show all + get_current_loan per row", status_per_row),
+            ("show all: BookSummary + loan status", database.get_book_summaries),
+            ("advanced search: dicts", lambda: database.advanced_search(publisher="smith")),
+            ("advanced search: BookSummary",
+             lambda: database.advanced_search(publisher="smith", summaries=True)),
+        )
+        for label, func in cases:
+            print(f"  {label:.<40} {time_ms(func, repeat=3):>8.1f} ms   "
+                  f"peak {peak_memory_mb(func):>6.1f} MB")
+
+        connection_manager.close_all()
+
+
+def bench_overdue(books=2_000, open_loans=500):
+    """Overdue tab as the loan history grows"""
+    print(f"Overdue tab: {open_loans} open loans, growing history of returned loans")
+    from datetime import datetime
+
+    with tempfile.TemporaryDirectory() as folder:
+        use_temp_database(folder)
+        populate_books(books)
+        conn = connection_manager.get_connection(database.DB_PATH)
+        rng = random.Random(1)
+        now = int(time.time())
+
+        def add_loans(count, returned):
+            rows = []
+            for _ in range(count):
+                loaned = now - rng.randint(0, 3 * 365 * 86400)
+                due = loaned + 30 * 86400
+                back = loaned + rng.randint(1, 40) * 86400 if returned else None
+                rows.append((rng.randint(1, books), rng.choice(NAMES),
+                             datetime.fromtimestamp(loaned).isoformat(),
+                             datetime.fromtimestamp(due).isoformat(),
+                             datetime.fromtimestamp(back).isoformat() if back else None,
+                             loaned, due, back))
+            with connection_manager.transaction(conn):
+                conn.executemany("""
+                    INSERT INTO loans (book_id, borrower_name, date_loaned, date_due, date_returned,
+                                       loaned_at, due_at, returned_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, rows)
+
+        def old_overdue():
+            # The original: ISO string comparison over every loan, days worked out in Python
+            rows = conn.execute("""
+                SELECT loans.*, books.title, books.author
+                FROM loans NOT INDEXED
+                JOIN books ON loans.book_id = books.id
+                WHERE loans.date_returned IS NULL AND loans.date_due < ?
+                ORDER BY loans.date_due
+            """, (datetime.now().isoformat(),)).fetchall()
+            today = datetime.now()
+            return [(today - datetime.fromisoformat(row['date_due'])).days for row in rows]
+
+        add_loans(open_loans, returned=False)
+        history = 0
+        for target in (10_000, 100_000, 1_000_000):
+            add_loans(target - history, returned=True)
+            history = target
+            conn.execute("ANALYZE")
+            print(f"  {f'{history:,} returned loans':.<26} original {time_ms(old_overdue):>8.2f} ms   "
+                  f"get_overdue_loans {time_ms(database.get_overdue_loans):>6.2f} ms   "
+                  f"get_all_loans {time_ms(database.get_all_loans):>6.2f} ms")
+
+        connection_manager.close_all()
+
+
+def bench_migrations(count=100_000):
+    """Cost of upgrading a large database that predates the migrations"""
+    print(f"Migrations: upgrading a pre-migration database with {count:,} books")
+
+    with tempfile.TemporaryDirectory() as folder:
+        use_temp_database(folder)
+        populate_books(count)
+        conn = connection_manager.get_connection(database.DB_PATH)
+
+        # Strip it back to the original schema: no indexes, no FTS, version 0
+        with connection_manager.transaction(conn):
+            for (name,) in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+                conn.execute(f"DROP TRIGGER {name}")
+            for (name,) in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL").fetchall():
+                conn.execute(f"DROP INDEX {name}")
+            conn.execute("DROP TABLE IF EXISTS books_fts")
+            conn.execute("PRAGMA user_version = 0")
+
+        for version, description, seconds in database.init_database():
+            print(f"  {f'{version}: {description}':.<50} {seconds * 1000:>8.1f} ms")
+
+        connection_manager.close_all()
+
+
+def bench_covers(count=20):
+    """Showing a selected book's cover: full decode vs thumbnail caches"""
+    print(f"Covers: {count} large JPEG covers")
+    from PIL import Image
+    import cover_cache
+
+    with tempfile.TemporaryDirectory() as folder:
+        cover_cache.THUMBNAIL_DIR = Path(folder) / "thumbnails"
+        covers = []
+        for i in range(count):
+            path = Path(folder) / f"cover{i}.jpg"
+            # Noise is the worst case for JPEG decoding
+            Image.effect_noise((1600, 2400), 40 + i).convert('RGB').save(path, quality=90)
+            covers.append(path)
+
+        def old_display():
+            for path in covers:
+                img = Image.open(path)
+                img.thumbnail(cover_cache.THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+
+        # make_photo=identity keeps Tk out of it; only the caching is measured
+        photos = cover_cache.PhotoCache(make_photo=lambda image: image)
+        first = time_ms(lambda: [photos.get(path) for path in covers], repeat=1)
+        on_disk = time_ms(lambda: [cover_cache.load_thumbnail(path) for path in covers])
+        in_memory = time_ms(lambda: [photos.get(path) for path in covers])
+
+        print(f"  {'full decode + LANCZOS (old)':.<40} {time_ms(old_display, repeat=3) / count:>8.2f} ms per cover")
+        print(f"  {'first view (thumbnail made)':.<40} {first / count:>8.2f} ms per cover")
+        print(f"  {'thumbnail from disk':.<40} {on_disk / count:>8.2f} ms per cover")
+        print(f"  {'PhotoCache hit':.<40} {in_memory / count:>8.3f} ms per cover")
+
+
+def bench_async_lookup(count=64, latency=0.05):
+    """One ISBN per request: one at a time vs the asyncio engine at rising concurrency"""
+    print(f"Async lookup: {count} ISBNs, one per request, {latency * 1000:.0f} ms server latency")
+    import asyncio
+    import async_lookup
+    import isbn_cache
+    import isbn_lookup
+    from openlibrary_stub import OpenLibraryStub
+
+    isbns = [f"97800000{n:05d}" for n in range(count)]
+    books = {isbn: {'title': f"Book {n}", 'authors': [{'name': "Author"}]}
+             for n, isbn in enumerate(isbns)}
+    originals = (isbn_cache.CACHE_PATH, isbn_lookup.OPEN_LIBRARY_URL)
+    with tempfile.TemporaryDirectory() as folder, OpenLibraryStub(books, latency=latency) as stub:
+        isbn_cache.CACHE_PATH = Path(folder) / "isbn_cache.db"
+        isbn_lookup.OPEN_LIBRARY_URL = stub.url
+        try:
+            start = time.perf_counter()
+            expected = isbn_lookup.lookup_isbns(isbns, batch_size=1, use_cache=False)
+            seconds = time.perf_counter() - start
+            print(f"  {'isbn_lookup.lookup_isbns':.<40} {count / seconds:>8.1f} lookups/s")
+
+            for concurrency in (1, 2, 4, 8, 16):
+                async def lookup_all():
+                    async with async_lookup.AsyncLookupEngine(concurrency, batch_size=1) as engine:
+                        return await engine.lookup_isbns(isbns, use_cache=False)
+                start = time.perf_counter()
+                results = asyncio.run(lookup_all())
+                rate = count / (time.perf_counter() - start)
+                assert results == expected
+                print(f"  {f'AsyncLookupEngine, concurrency {concurrency}':.<40} {rate:>8.1f} lookups/s"
+                      f"   ({rate * seconds / count:.1f}x)")
+        finally:
+            connection_manager.close_all()
+            isbn_cache.CACHE_PATH, isbn_lookup.OPEN_LIBRARY_URL = originals
+
+
+def import_times(code):
+    """
+    Run code in a fresh interpreter under -X importtime
+
+    Returns (total ms spent importing, {module: cumulative ms} for every
+    module imported, wall time of the whole process in ms). Interpreter
+    startup itself (site) is left out of the total.
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, cwd=Path(__file__).parent, check=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    total_ms = 0.0
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split('|')
+        if not cumulative.strip().isdigit():
+            continue        # the header line
+        modules[name.strip()] = int(cumulative) / 1000
+        if len(name) - len(name.lstrip()) == 1 and name.strip() != 'site':
+            total_ms += int(cumulative) / 1000
+    return total_ms, modules, wall_ms
+
+
+def bench_startup():
+    """Start-up imports: the window vs the command line (python -X importtime)"""
+    print("Startup: time spent importing modules")
+    with tempfile.TemporaryDirectory() as folder:
+        db_path = Path(folder) / "startup.db"
+        cases = [
+            ("library_app (window)", "import library_app"),
+            ("library_cli overdue", "import io, library_cli; "
+             f"library_cli.main(['--db', {str(db_path)!r}, 'overdue'], out=io.StringIO())"),
+        ]
+        for label, code in cases:
+            total_ms, modules, wall_ms = import_times(code)
+            heavy = ', '.join(f"{name} {modules[name]:.0f} ms"
+                              for name in ('tkinter', 'PIL.Image', 'requests') if name in modules)
+            print(f"  {label:.<30} {total_ms:>7.1f} ms importing, {wall_ms:>6.0f} ms in all"
+                  f"   (heavy: {heavy or 'none'})")
+
+
+BENCHMARKS = {
+    'connections': bench_connections,
+    'search': bench_search,
+    'bulk': bench_bulk_insert,
+    'paging': bench_paging,
+    'listing': bench_listing,
+    'overdue': bench_overdue,
+    'migrations': bench_migrations,
+    'covers': bench_covers,
+    'async': bench_async_lookup,
+    'startup': bench_startup,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark '{name}'. Available: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+
+    print("=" * 60)
+    print("Callum's Library App - Benchmarks")
+    print("=" * 60)
+    for name in names:
+        print()
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
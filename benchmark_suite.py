@@ -0,0 +1,341 @@
+"""
+Large-library benchmark suite for database.py
+
+Builds reproducible synthetic libraries (10k, 100k and 1M books, each with
+a few years of loan history) in a temp folder, times every public
+database.py function against them and writes the p50/p95/p99 timings as
+JSON. With --compare, the results are checked against a stored baseline
+and any function that got slower by more than the threshold is flagged.
+
+    python benchmark_suite.py --output baseline.json
+    ... change something ...
+    python benchmark_suite.py --compare baseline.json
+
+Run with --sizes 10k for a quick check; building the 1M library takes a
+few minutes. The real library.db is never touched.
+"""
+
+import argparse
+import inspect
+import json
+import math
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import connection_manager
+import database
+from benchmark import NAMES, WORDS, synthetic_books, use_temp_database
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1M': 1_000_000}
+REPEAT = 30             # timed calls per function (fewer if it runs out of time)
+TIME_BUDGET = 2.0       # seconds allowed per function and size
+THRESHOLD = 1.25        # flag a function whose p50 or p95 grew by more than this factor
+NOISE_MS = 0.05         # ...and by more than this, so microsecond jitter isn't flagged
+
+DAY = 86400
+BORROWERS = [f"{first} {last}" for first in NAMES[:10] for last in NAMES]
+
+
+def synthetic_loans(book_count, now, seed=1):
+    """
+    Generate a reproducible loan history as rows for the loans table
+
+    Each book has been lent out 0-6 times over the last five years, one
+    loan after another. Most of the latest loans are back; about 4% of
+    books are still out, a quarter of those past their due date.
+    """
+    rng = random.Random(seed)
+    for book_id in range(1, book_count + 1):
+        loaned = now - rng.randint(30, 5 * 365) * DAY
+        for number in range(rng.choice((0, 0, 1, 1, 2, 2, 3, 4, 6))):
+            due = loaned + 30 * DAY
+            if loaned > now - 60 * DAY:
+                break
+            back = loaned + rng.randint(3, 45) * DAY
+            yield (book_id, rng.choice(BORROWERS), loaned, due, back)
+            loaned = back + rng.randint(1, 200) * DAY
+        if rng.random() < 0.04:
+            loaned = now - (rng.randint(31, 90) if rng.random() < 0.25 else rng.randint(0, 29)) * DAY
+            yield (book_id, rng.choice(BORROWERS), loaned, loaned + 30 * DAY, None)
+
+
+def build_library(size, seed=1, now=None):
+    """Fill the current (empty) database with size books and their loans"""
+    now = int(time.time()) if now is None else now
+    database.add_books_bulk(synthetic_books(size, seed))
+
+    def iso(timestamp):
+        return datetime.fromtimestamp(timestamp).isoformat() if timestamp is not None else None
+
+    conn = connection_manager.get_connection(database.DB_PATH)
+    with connection_manager.transaction(conn):
+        conn.executemany("""
+            INSERT INTO loans (book_id, borrower_name, date_loaned, date_due, date_returned,
+                               loaned_at, due_at, returned_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, ((book_id, borrower, iso(loaned), iso(due), iso(back), loaned, due, back)
+              for book_id, borrower, loaned, due, back in synthetic_loans(size, now, seed)))
+    conn.execute("ANALYZE")
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarise(timings_ms):
+    timings_ms = sorted(timings_ms)
+    return {
+        'runs': len(timings_ms),
+        'p50_ms': round(percentile(timings_ms, 50), 4),
+        'p95_ms': round(percentile(timings_ms, 95), 4),
+        'p99_ms': round(percentile(timings_ms, 99), 4),
+        'max_ms': round(timings_ms[-1], 4),
+    }
+
+
+class Context:
+    """What the benchmark cases need to know about the library being tested"""
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.rng = random.Random(seed)
+        conn = connection_manager.get_connection(database.DB_PATH)
+        self.open_loans = [row[0] for row in conn.execute(
+            "SELECT id FROM loans WHERE returned_at IS NULL ORDER BY id")]
+        self.loaned_books = {row[0] for row in conn.execute(
+            "SELECT book_id FROM loans WHERE returned_at IS NULL")}
+        self.added = 0
+
+    def book_id(self):
+        return self.rng.randint(1, self.size)
+
+    def free_book_id(self):
+        while True:
+            book_id = self.book_id()
+            if book_id not in self.loaned_books:
+                self.loaned_books.add(book_id)
+                return book_id
+
+    def word(self):
+        return self.rng.choice(WORDS)
+
+    def new_book(self):
+        self.added += 1
+        return {'isbn': f"979{self.added:010d}", 'title': f"Benchmark Book {self.added}",
+                'year': "2024", 'author': "B. Enchmark"}
+
+    def staged(self, count):
+        """Stage count new books in the intake table as found; returns their intake ids"""
+        books = [self.new_book() for _ in range(count)]
+        ids = [database.add_intake(book['isbn']) for book in books]
+        database.save_intake_results([
+            (intake_id, 'found', {field: book[field] for field in ('title', 'year', 'author')})
+            for intake_id, book in zip(ids, books)])
+        return ids
+
+
+def _book_at_middle(ctx):
+    return database.get_books_page_at(ctx.size // 2, limit=1)[0]
+
+
+# name -> function(ctx) returning the zero-argument call to time. Reads come
+# first; the writes at the end change the library a little as they go.
+CASES = {
+    'init_database': lambda ctx: database.init_database,
+    'change_token': lambda ctx: database.change_token,
+    'table_generations': lambda ctx: database.table_generations,
+    'get_book': lambda ctx: (lambda book_id=ctx.book_id(): database.get_book(book_id)),
+    'get_books': lambda ctx: (lambda ids=[ctx.book_id() for _ in range(11)]: database.get_books(ids)),
+    'get_all_books': lambda ctx: database.get_all_books,
+    'get_book_summaries': lambda ctx: database.get_book_summaries,
+    'get_books_page': lambda ctx: (
+        lambda key=database.book_sort_key(_book_at_middle(ctx)): database.get_books_page(key, limit=100)),
+    'get_books_page (search)': lambda ctx: (
+        lambda query=ctx.word(): database.get_books_page(None, limit=100, query=query)),
+    'get_books_page_at': lambda ctx: (
+        lambda offset=ctx.rng.randint(0, ctx.size - 100): database.get_books_page_at(offset, limit=100)),
+    'count_books': lambda ctx: database.count_books,
+    'count_books (search)': lambda ctx: (lambda query=ctx.word(): database.count_books(query)),
+    'count_books_before': lambda ctx: (
+        lambda key=database.book_sort_key(_book_at_middle(ctx)): database.count_books_before(key)),
+    'book_sort_key': lambda ctx: (
+        lambda book={'title': "Dune", 'id': 1}: database.book_sort_key(book)),
+    'search_books': lambda ctx: (lambda query=ctx.word(): database.search_books(query)),
+    'search_books (prefix)': lambda ctx: (lambda query=ctx.word()[:3]: database.search_books(query)),
+    'search_books (one letter)': lambda ctx: (lambda query=ctx.word()[:1]: database.search_books(query)),
+    'search_books (summaries)': lambda ctx: (
+        lambda query=ctx.word(): database.search_books(query, summaries=True)),
+    'advanced_search': lambda ctx: (
+        lambda title=ctx.word(), author=ctx.rng.choice(NAMES):
+            database.advanced_search(title=title, author=author)),
+    'advanced_search_ids': lambda ctx: (
+        lambda title=ctx.word(): database.advanced_search_ids(title=title)),
+    'advanced_search_ids (all)': lambda ctx: database.advanced_search_ids,
+    'get_book_summaries (ids)': lambda ctx: (
+        lambda ids=[ctx.book_id() for _ in range(40)]: database.get_book_summaries(ids)),
+    'get_books_to_enrich': lambda ctx: (lambda: database.get_books_to_enrich(limit=100)),
+    'get_isbns': lambda ctx: database.get_isbns,
+    'get_intake': lambda ctx: database.get_intake,
+    'get_current_loan': lambda ctx: (lambda book_id=ctx.book_id(): database.get_current_loan(book_id)),
+    'get_all_loans': lambda ctx: database.get_all_loans,
+    'get_overdue_loans': lambda ctx: database.get_overdue_loans,
+    'get_loan_history': lambda ctx: (lambda book_id=ctx.book_id(): database.get_loan_history(book_id)),
+    'add_book': lambda ctx: (lambda book=ctx.new_book(): database.add_book(**book)),
+    'add_books_bulk': lambda ctx: (
+        lambda books=[ctx.new_book() for _ in range(100)]: database.add_books_bulk(books)),
+    'update_book': lambda ctx: (
+        lambda book_id=ctx.book_id(): database.update_book(book_id, notes="Benchmarked")),
+    'save_enrichment': lambda ctx: (
+        lambda results=[(ctx.book_id(), 'unchanged', {}) for _ in range(25)]:
+            database.save_enrichment(results)),
+    'loan_book': lambda ctx: (lambda book_id=ctx.free_book_id(): database.loan_book(book_id, "Bench")),
+    'return_book': lambda ctx: (
+        lambda loan_id=ctx.open_loans.pop() if ctx.open_loans else 0: database.return_book(loan_id)),
+    'add_intake': lambda ctx: (lambda isbn=ctx.new_book()['isbn']: database.add_intake(isbn)),
+    'save_intake_results': lambda ctx: (
+        lambda results=[(intake_id, 'not_found', {}) for intake_id in ctx.staged(25)]:
+            database.save_intake_results(results)),
+    'approve_intake': lambda ctx: (lambda ids=ctx.staged(25): database.approve_intake(ids)),
+    'discard_intake': lambda ctx: (lambda ids=ctx.staged(25): database.discard_intake(ids)),
+    'delete_book': lambda ctx: (lambda book_id=ctx.size - ctx.rng.randrange(ctx.size // 10):
+                                database.delete_book(book_id)),
+}
+
+
+def public_functions():
+    """Names of the public functions in database.py"""
+    return sorted(name for name, value in vars(database).items()
+                  if inspect.isfunction(value) and value.__module__ == database.__name__
+                  and not name.startswith('_'))
+
+
+def uncovered_functions():
+    """Public database.py functions that have no benchmark case"""
+    covered = {name.split(' ')[0] for name in CASES}
+    return [name for name in public_functions() if name not in covered]
+
+
+def time_case(make_call, ctx, repeat=REPEAT, budget=TIME_BUDGET):
+    """Time fresh calls from make_call(ctx), returning a summary dict"""
+    timings = []
+    deadline = time.perf_counter() + budget
+    while len(timings) < repeat and (len(timings) < 3 or time.perf_counter() < deadline):
+        call = make_call(ctx)
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    return summarise(timings)
+
+
+def run_size(label, size, seed=1, repeat=REPEAT, budget=TIME_BUDGET, cases=None, log=print):
+    """Build one synthetic library and time every case against it"""
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        use_temp_database(folder)
+        start = time.perf_counter()
+        build_library(size, seed)
+        log(f"{label}: built {size:,} books in {time.perf_counter() - start:.1f} s")
+        ctx = Context(size, seed)
+        for name in cases or CASES:
+            results[name] = time_case(CASES[name], ctx, repeat, budget)
+            timing = results[name]
+            log(f"  {name:.<32} p50 {timing['p50_ms']:>9.3f} ms   p95 {timing['p95_ms']:>9.3f} ms   "
+                f"p99 {timing['p99_ms']:>9.3f} ms")
+        connection_manager.close_all()
+    return results
+
+
+def run(sizes=tuple(SIZES), seed=1, repeat=REPEAT, budget=TIME_BUDGET, cases=None, log=print):
+    """Run the suite for each size label, returning the JSON-ready report"""
+    return {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'seed': seed,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'results': {label: run_size(label, SIZES[label], seed, repeat, budget, cases, log)
+                    for label in sizes},
+    }
+
+
+def compare(baseline, current, threshold=THRESHOLD, noise_ms=NOISE_MS):
+    """
+    Find the functions that got slower than in baseline
+
+    Returns a list of (size, function, statistic, baseline ms, current ms),
+    for the p50 and p95 timings that grew by more than threshold times and
+    by more than noise_ms. Functions or sizes missing from either report are
+    ignored.
+    """
+    regressions = []
+    for label, functions in current['results'].items():
+        before = baseline['results'].get(label, {})
+        for name, timing in functions.items():
+            if name not in before:
+                continue
+            for statistic in ('p50_ms', 'p95_ms'):
+                old, new = before[name][statistic], timing[statistic]
+                if new > old * threshold and new - old > noise_ms:
+                    regressions.append((label, name, statistic, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every database.py function on large libraries")
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=list(SIZES),
+                        help="library sizes to test (default: all)")
+    parser.add_argument('--seed', type=int, default=1, help="random seed (default %(default)s)")
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help="timed calls per function (default %(default)s)")
+    parser.add_argument('--only', nargs='+', metavar='FUNCTION', help="only time these cases")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', metavar='BASELINE', help="flag regressions against this JSON file")
+    parser.add_argument('--results', metavar='JSON',
+                        help="with --compare: check these saved results instead of running")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="slowdown factor counted as a regression (default %(default)s)")
+    args = parser.parse_args()
+
+    missing = uncovered_functions()
+    if missing:
+        print(f"Warning: no benchmark for {', '.join(missing)}")
+    unknown = [name for name in args.only or [] if name not in CASES]
+    if unknown:
+        print(f"Unknown case(s) {', '.join(unknown)}. Available: {', '.join(CASES)}")
+        sys.exit(2)
+
+    if args.results:
+        with open(args.results) as f:
+            report = json.load(f)
+    else:
+        report = run(args.sizes, args.seed, args.repeat, cases=args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        if not regressions:
+            print(f"No regressions against {args.compare}")
+            return
+        print(f"{len(regressions)} regression(s) against {args.compare}:")
+        for label, name, statistic, old, new in regressions:
+            print(f"  {label:>4} {name:.<32} {statistic[:3]} {old:>9.3f} ms -> {new:>9.3f} ms "
+                  f"({new / old if old else math.inf:.1f}x)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
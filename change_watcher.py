@@ -0,0 +1,73 @@
+"""
+Database change detection for Callum's Library App
+
+Rebuilding the book, loan and overdue lists is only worth doing when their
+data has changed - whether this window changed it or another copy of the
+app sharing the same library.db did. Triggers keep a generation counter
+per table (see migration 7), and ChangeWatcher polls cheaply with
+root.after():
+
+- database.change_token() is compared first; it only moves when something
+  was committed, by this connection or any other
+- only then are the table counters read, to find out which tables changed
+
+on_change(tables) is called on the Tk main thread with the set of table
+names whose counters moved.
+"""
+
+import database
+
+POLL_MS = 1000      # how often to look for changes made elsewhere
+
+
+class ChangeWatcher:
+    """Calls on_change(tables) when tracked tables change in the database"""
+
+    def __init__(self, root, on_change, interval_ms=POLL_MS):
+        self.root = root
+        self.on_change = on_change
+        self.interval_ms = interval_ms
+        self._token = database.change_token()
+        self._generations = database.table_generations()
+        self._poll_id = None
+        self.checks = 0         # times the token was compared
+        self.reads = 0          # times the table counters had to be read
+
+    def start(self):
+        """Start polling"""
+        if self._poll_id is None:
+            self._poll_id = self.root.after(self.interval_ms, self._poll)
+
+    def stop(self):
+        """Stop polling"""
+        if self._poll_id is not None:
+            self.root.after_cancel(self._poll_id)
+            self._poll_id = None
+
+    def check_now(self):
+        """
+        Look for changes straight away (e.g. right after saving something)
+
+        Returns the set of changed tables, which is empty if nothing changed.
+        """
+        self.checks += 1
+        token = database.change_token()
+        if token == self._token:
+            return set()
+        self._token = token
+
+        self.reads += 1
+        generations = database.table_generations()
+        changed = {name for name, generation in generations.items()
+                   if generation != self._generations.get(name)}
+        self._generations = generations
+        if changed:
+            self.on_change(changed)
+        return changed
+
+    def _poll(self):
+        self._poll_id = None
+        try:
+            self.check_now()
+        finally:
+            self._poll_id = self.root.after(self.interval_ms, self._poll)
@@ -0,0 +1,219 @@
+"""
+Connection manager for Callum's Library App
+Keeps one long-lived SQLite connection per thread instead of reconnecting on every call
+"""
+
+import functools
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-connection settings, applied once when a connection is first opened.
+# The busy timeout is how long SQLite itself waits for another connection's
+# write lock; set LIBRARY_BUSY_TIMEOUT_MS to change it (e.g. on slow disks).
+BUSY_TIMEOUT_MS = int(os.environ.get('LIBRARY_BUSY_TIMEOUT_MS', 5000))
+CACHE_SIZE_KB = 16 * 1024         # negative cache_size is in KiB
+MMAP_SIZE = 64 * 1024 * 1024
+
+# Retrying writes that still find the database locked after the busy timeout
+BUSY_RETRIES = 5                  # attempts after the first
+BUSY_BACKOFF = 0.05               # seconds before the first retry, doubled each time
+BUSY_BACKOFF_MAX = 2.0            # longest wait between attempts
+
+_local = threading.local()
+_all_connections = []
+_registry_lock = threading.RLock()   # re-entrant: _ThreadConnections.__del__ can run anywhere
+_generation = 0   # bumped by close_all() so other threads drop their stale handles
+_retry_stats = {'busy_errors': 0, 'retries': 0, 'gave_up': 0}
+_retry_lock = threading.Lock()
+
+
+class _ThreadConnections(dict):
+    """
+    One thread's connections by path
+
+    Held only by the thread-local, so it is dropped when its thread exits;
+    worker pools that come and go (lookups, enrichment) then don't leave
+    their connections open in _all_connections.
+    """
+
+    def __del__(self):
+        for conn in self.values():
+            _close(conn)
+
+
+def _close(conn):
+    """Close a connection and drop it from the registry"""
+    with _registry_lock:
+        if conn in _all_connections:
+            _all_connections.remove(conn)
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def _configure(conn):
+    """Apply per-connection pragmas"""
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT_MS)}")
+    conn.execute(f"PRAGMA cache_size = -{int(CACHE_SIZE_KB)}")
+    conn.execute(f"PRAGMA mmap_size = {int(MMAP_SIZE)}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+
+def get_connection(db_path):
+    """
+    Get this thread's connection to db_path, opening it on first use
+
+    Connections run in autocommit mode; use transaction() to group writes.
+    Rows come back as sqlite3.Row so callers can use dict(row).
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None or getattr(_local, 'generation', None) != _generation:
+        connections = _local.connections = _ThreadConnections()
+        _local.generation = _generation
+
+    key = str(db_path)
+    conn = connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(key, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        _configure(conn)
+        connections[key] = conn
+        with _registry_lock:
+            _all_connections.append(conn)
+
+    return conn
+
+
+def is_busy_error(error):
+    """Whether an exception is SQLite reporting the database as busy or locked"""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(error)
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def _count_retry(name):
+    with _retry_lock:
+        _retry_stats[name] += 1
+
+
+def _backoff(attempt):
+    """Seconds to wait before retry number attempt (0-based), with full jitter"""
+    return random.uniform(0, min(BUSY_BACKOFF_MAX, BUSY_BACKOFF * 2 ** attempt))
+
+
+def _with_retries(func, *args, **kwargs):
+    """Call func, retrying with jittered backoff while the database is busy"""
+    for attempt in range(BUSY_RETRIES + 1):
+        try:
+            return func(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e):
+                raise
+            _count_retry('busy_errors')
+            if attempt == BUSY_RETRIES:
+                _count_retry('gave_up')
+                raise
+        _count_retry('retries')
+        time.sleep(_backoff(attempt))
+
+
+def retry_on_busy(func):
+    """
+    Decorator for write functions: retry the whole call if the database is busy
+
+    The wrapped function must be safe to run again after a busy error rolled
+    it back, i.e. do all its writes in one statement or one transaction().
+    Only the outermost decorated call retries; nested ones (e.g. update_book
+    inside save_enrichment) let the error through to it.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'retrying', False):
+            return func(*args, **kwargs)
+        _local.retrying = True
+        try:
+            return _with_retries(func, *args, **kwargs)
+        finally:
+            _local.retrying = False
+    return wrapper
+
+
+def retry_stats():
+    """Get the busy/retry counters for this process"""
+    with _retry_lock:
+        return dict(_retry_stats)
+
+
+def reset_retry_stats():
+    """Zero the busy/retry counters"""
+    with _retry_lock:
+        for name in _retry_stats:
+            _retry_stats[name] = 0
+
+
+@contextmanager
+def transaction(conn):
+    """
+    Run a block of statements in a single write transaction
+
+    BEGIN IMMEDIATE takes the write lock up front, so the transaction can't
+    fail half way through waiting to upgrade a read lock. If another
+    connection holds the lock past the busy timeout, BEGIN is retried with
+    backoff - nothing has been done yet, so that is always safe.
+    """
+    if conn.in_transaction:
+        # Already inside an outer transaction - let that one commit
+        yield conn
+        return
+
+    if getattr(_local, 'retrying', False):
+        conn.execute("BEGIN IMMEDIATE")     # retry_on_busy retries the whole call
+    else:
+        _with_retries(conn.execute, "BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:     # SQLite may already have rolled back
+            conn.execute("ROLLBACK")
+        raise
+
+
+def close_connection(db_path=None):
+    """Close this thread's connection(s), or only the one for db_path"""
+    connections = getattr(_local, 'connections', None)
+    if not connections:
+        return
+
+    keys = [str(db_path)] if db_path is not None else list(connections)
+    for key in keys:
+        conn = connections.pop(key, None)
+        if conn is not None:
+            _close(conn)
+
+
+def close_all():
+    """Close every connection opened by any thread (call on shutdown)"""
+    global _generation
+    with _registry_lock:
+        _generation += 1
+        connections = list(_all_connections)
+        _all_connections.clear()
+
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
@@ -0,0 +1,151 @@
+"""
+Cover image caching for Callum's Library App
+
+Covers are stored full size, but only ever shown as small thumbnails.
+Decoding a large JPEG and shrinking it every time a book is selected is
+slow, so there are two caches:
+
+- thumbnails on disk, in THUMBNAIL_DIR, made once per cover and size and
+  named after the cover's path, modification time and the size, so a
+  replaced cover gets a new thumbnail automatically
+- PhotoCache, an in-memory LRU of ready-to-show PhotoImages, limited by
+  the memory their pixels take up
+
+Only PhotoCache needs Tk, and it imports PIL.ImageTk (and with it tkinter)
+when the first one is made, so isbn_lookup and prefetch can use this
+module from scripts and worker threads without loading Tk.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from PIL import Image
+
+THUMBNAIL_DIR = Path(__file__).parent / "thumbnails"
+THUMBNAIL_SIZE = (200, 300)                 # largest width and height shown
+PHOTO_CACHE_BYTES = 32 * 1024 * 1024        # pixel memory kept by a PhotoCache
+
+_stats = {'memory_hits': 0, 'disk_hits': 0, 'generated': 0, 'decode_seconds': 0.0}
+_stats_lock = threading.Lock()
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def to_rgb(image):
+    """Convert an image to RGB for saving as JPEG, putting any transparency on white"""
+    if 'A' in image.getbands() or image.mode == 'P':
+        rgba = image.convert('RGBA')
+        flattened = Image.new('RGB', rgba.size, 'white')
+        flattened.paste(rgba, mask=rgba)
+        return flattened
+    return image.convert('RGB')
+
+
+def _cache_key(source, size):
+    """(path, mtime, size) identifying one thumbnail of one version of a cover"""
+    path = os.path.abspath(source)
+    return path, os.stat(path).st_mtime_ns, tuple(size)
+
+
+def thumbnail_path(source, size=THUMBNAIL_SIZE):
+    """Where the thumbnail of source at size is (or will be) stored"""
+    path, mtime, (width, height) = _cache_key(source, size)
+    digest = hashlib.sha1(f"{path}|{mtime}|{width}x{height}".encode()).hexdigest()
+    return THUMBNAIL_DIR / f"{digest}.jpg"
+
+
+def load_thumbnail(source, size=THUMBNAIL_SIZE):
+    """
+    Get a cover shrunk to fit size, making and saving the thumbnail if needed
+
+    Returns a loaded PIL Image. Doesn't touch Tk, so it can run on a worker
+    thread.
+    """
+    thumb_path = thumbnail_path(source, size)
+    start = time.perf_counter()
+    try:
+        with Image.open(thumb_path) as thumb:
+            thumb.load()
+        _count('disk_hits')
+    except FileNotFoundError:
+        with Image.open(source) as img:
+            img.draft('RGB', size)      # JPEGs can decode straight at a smaller scale
+            img.thumbnail(size, Image.Resampling.LANCZOS)
+            thumb = to_rgb(img)
+        THUMBNAIL_DIR.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so a half-written thumbnail is never picked up
+        partial = thumb_path.with_suffix(f".{threading.get_ident()}.tmp")
+        thumb.save(partial, 'JPEG', quality=90)
+        os.replace(partial, thumb_path)
+        _count('generated')
+    _count('decode_seconds', time.perf_counter() - start)
+    return thumb
+
+
+def stats():
+    """Get the cache counters since start-up (or the last reset_stats)"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    """Zero the cache counters"""
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
+
+
+class PhotoCache:
+    """
+    Least-recently-used cache of PhotoImages, keyed like the thumbnails
+
+    Must only be used on the Tk main thread. make_photo turns a PIL Image
+    into something Tk can show (ImageTk.PhotoImage by default).
+    """
+
+    def __init__(self, max_bytes=PHOTO_CACHE_BYTES, make_photo=None):
+        if make_photo is None:
+            from PIL import ImageTk
+            make_photo = ImageTk.PhotoImage
+        self.max_bytes = max_bytes
+        self.make_photo = make_photo
+        self.bytes = 0
+        self._photos = OrderedDict()    # key -> (photo, bytes)
+
+    def get(self, source, size=THUMBNAIL_SIZE):
+        """Get a PhotoImage of a cover shrunk to fit size"""
+        key = _cache_key(source, size)
+        if key in self._photos:
+            self._photos.move_to_end(key)
+            _count('memory_hits')
+            return self._photos[key][0]
+        return self._store(key, load_thumbnail(source, size))
+
+    def put(self, source, image, size=THUMBNAIL_SIZE):
+        """Add a thumbnail loaded elsewhere (e.g. on a worker thread)"""
+        key = _cache_key(source, size)
+        if key in self._photos:
+            self._photos.move_to_end(key)
+        else:
+            self._store(key, image)
+
+    def __len__(self):
+        return len(self._photos)
+
+    def _store(self, key, image):
+        photo = self.make_photo(image)
+        size = image.width * image.height * 4      # Tk keeps 32-bit pixels
+        self._photos[key] = (photo, size)
+        self.bytes += size
+        # Evict the least recently used, but always keep the newest
+        while self.bytes > self.max_bytes and len(self._photos) > 1:
+            _, (_, evicted) = self._photos.popitem(last=False)
+            self.bytes -= evicted
+        return photo
@@ -3,72 +3,165 @@ Database module for Callum's Library App
 Handles SQLite database creation and operations
 """
 
+import re
 import sqlite3
+import time
+from array import array
 from datetime import datetime, timedelta
 from pathlib import Path
 
+from connection_manager import get_connection, retry_on_busy, transaction
+from migrations import (FTS_COLUMNS, TRACKED_TABLES, change_trigger_sql, fts_insert_trigger_sql,
+                        migrate)
+import query_stats
+
 DB_PATH = Path(__file__).parent / "library.db"
 
+# Active loans due within this many days are flagged as due soon
+DUE_SOON_DAYS = 7
+
+# search_books orders queries whose words are all this short by title, not
+# relevance, and returns only the first SHORT_QUERY_LIMIT of them
+SHORT_QUERY_CHARS = 2
+SHORT_QUERY_LIMIT = 500
+
+# Columns of books that add_book / add_books_bulk fill in, in INSERT order.
+# Records use add_book's argument names, so 'format' is given as 'format_type'.
+BOOK_FIELDS = ('isbn', 'title', 'year', 'author', 'artist', 'publisher', 'page_count',
+               'description', 'series_name', 'series_number', 'format', 'cover_path', 'notes')
+
+_fts_ready = {}  # DB path -> whether books_fts exists there
+
+
+def _connect():
+    """Get the pooled connection for the current thread (timed if query_stats is enabled)"""
+    return query_stats.wrap(get_connection(DB_PATH))
+
+
+def _has_fts():
+    """Whether the current database has a usable books_fts index"""
+    key = str(DB_PATH)
+    if key not in _fts_ready:
+        row = _connect().execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+        ).fetchone()
+        _fts_ready[key] = row is not None
+    return _fts_ready[key]
+
+
+def _fts_terms(text):
+    """
+    Turn free text into FTS5 prefix terms, e.g. 'harry pot' -> '"harry"* "pot"*'
+
+    Quoting each word keeps FTS5 operators and punctuation typed by the user
+    from being parsed as query syntax. Returns None if there are no words.
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+# Who has a book and when it's due, looked up through books.current_loan_id
+# (a rowid lookup, and nothing at all for books that aren't on loan)
+LOAN_STATUS_SELECT = """
+    (SELECT borrower_name FROM loans WHERE loans.id = books.current_loan_id) AS borrower_name,
+    (SELECT date_due FROM loans WHERE loans.id = books.current_loan_id) AS date_due
+"""
+
+# Columns shown by the list and search views - no description or notes
+SUMMARY_COLUMNS = ('id', 'title', 'author', 'artist', 'series_name', 'series_number',
+                   'publisher', 'year', 'borrower_name', 'date_due')
+_SUMMARY_SELECT = ', '.join(f"books.{column}" for column in SUMMARY_COLUMNS[:-2])
+_SUMMARY_SELECT += ', ' + LOAN_STATUS_SELECT
+
+
+class BookSummary:
+    """
+    One book as the list and search views show it
+
+    Much smaller than a full book dict: no description or notes, and slots
+    instead of a per-object dict. Use get_book for the full record.
+    borrower_name and date_due are None unless the book is on loan.
+    """
+    __slots__ = SUMMARY_COLUMNS
+
+    def __init__(self, id, title, author, artist, series_name, series_number, publisher, year,
+                 borrower_name, date_due):
+        self.id = id
+        self.title = title
+        self.author = author
+        self.artist = artist
+        self.series_name = series_name
+        self.series_number = series_number
+        self.publisher = publisher
+        self.year = year
+        self.borrower_name = borrower_name
+        self.date_due = date_due
+
+    def __repr__(self):
+        return f"BookSummary(id={self.id!r}, title={self.title!r})"
+
+
+def _summary_row(cursor, row):
+    return BookSummary(*row)
+
+
+def _fetch_summaries(query, params=()):
+    """Run a query selecting SUMMARY_COLUMNS, returning BookSummary objects"""
+    cursor = _connect().cursor()
+    cursor.row_factory = _summary_row      # skip building sqlite3.Row objects
+    return cursor.execute(query, params).fetchall()
+
+
+def _fetch(query, params, summaries):
+    """Run a book query whose select list is {columns}, as dicts or BookSummary objects"""
+    if summaries:
+        return _fetch_summaries(query.format(columns=_SUMMARY_SELECT), params)
+    cursor = _connect().execute(query.format(columns="books.*"), params)
+    return [dict(row) for row in cursor.fetchall()]
+
 
 def init_database():
-    """Create the database and tables if they don't exist"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Books table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS books (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            isbn TEXT UNIQUE,
-            title TEXT NOT NULL,
-            year TEXT,
-            author TEXT,
-            artist TEXT,
-            publisher TEXT,
-            page_count INTEGER,
-            description TEXT,
-            series_name TEXT,
-            series_number INTEGER,
-            format TEXT DEFAULT 'Book',
-            cover_path TEXT,
-            notes TEXT,
-            date_added TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    # Add artist column to existing databases (migration)
-    try:
-        cursor.execute("ALTER TABLE books ADD COLUMN artist TEXT")
-        conn.commit()
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    # Loans table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS loans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            book_id INTEGER NOT NULL,
-            borrower_name TEXT NOT NULL,
-            date_loaned TEXT NOT NULL,
-            date_due TEXT NOT NULL,
-            date_returned TEXT,
-            FOREIGN KEY (book_id) REFERENCES books (id) ON DELETE CASCADE
-        )
-    """)
-    
-    conn.commit()
-    conn.close()
+    """
+    Create the database if it doesn't exist and bring its schema up to date
+
+    Returns the migrations that were applied as (version, description, seconds).
+    """
+    applied = migrate(_connect())
+    _fts_ready.pop(str(DB_PATH), None)
+    return applied
+
+
+def change_token():
+    """
+    A cheap value that changes whenever the database might have
+
+    Combines PRAGMA data_version (bumped by commits from any other
+    connection or process) with this connection's own total_changes.
+    Compare two tokens before bothering with table_generations().
+    """
+    conn = _connect()
+    return conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes
+
 
+def table_generations():
+    """Get the change counter of each tracked table, e.g. {'books': 12, 'loans': 3}"""
+    rows = _connect().execute("SELECT name, generation FROM change_counters").fetchall()
+    generations = {name: 0 for name in TRACKED_TABLES}
+    generations.update((name, generation) for name, generation in rows)
+    return generations
 
+
+@retry_on_busy
 def add_book(isbn, title, year, author, artist=None, publisher=None, page_count=None, 
              description=None, series_name=None, series_number=None,
              format_type='Book', cover_path=None, notes=None):
     """Add a new book to the database"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    conn = _connect()
     
     try:
-        cursor.execute("""
+        cursor = conn.execute("""
             INSERT INTO books (isbn, title, year, author, artist, publisher, page_count,
                              description, series_name, series_number, format, 
                              cover_path, notes)
@@ -76,252 +169,734 @@ def add_book(isbn, title, year, author, artist=None, publisher=None, page_count=
         """, (isbn, title, year, author, artist, publisher, page_count, description,
               series_name, series_number, format_type, cover_path, notes))
         
-        conn.commit()
-        book_id = cursor.lastrowid
-        conn.close()
-        return book_id
+        return cursor.lastrowid
     except sqlite3.IntegrityError:
-        conn.close()
         raise ValueError("A book with this ISBN already exists")
 
 
-def update_book(book_id, **kwargs):
-    """Update book details"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
+def add_books_bulk(records, on_conflict='skip', chunk_size=500):
+    """
+    Add many books in a single transaction
+
+    records is an iterable of dicts using add_book's argument names. It is
+    consumed chunk_size records at a time, so generators over large files
+    are fine. on_conflict decides what happens to a record whose ISBN is
+    already in the library (or earlier in the same batch):
+        'skip'   - leave the existing book alone
+        'update' - overwrite the existing book with the fields in the record
+        'error'  - raise ValueError and roll the whole batch back
+
+    Unlike the other writes this isn't retried as a whole if the database
+    is busy, since records may be a generator that can only be read once;
+    transaction() still retries getting the write lock before starting.
+
+    Returns one outcome dict per record, in order, with:
+        - index  (position in records)
+        - status ('inserted', 'updated', 'skipped' or 'error')
+        - id     (book id, None for errors)
+        - error  (message, only for status 'error')
+    """
+    if on_conflict not in ('skip', 'update', 'error'):
+        raise ValueError(f"on_conflict must be 'skip', 'update' or 'error', not {on_conflict!r}")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    
+    conn = _connect()
+    outcomes = []
+    with transaction(conn):
+        # Indexing row by row from the trigger is several times slower than
+        # indexing each chunk's new rows in one statement, and the same goes
+        # for the change counter. Dropping the triggers is part of this
+        # transaction, so no other connection ever sees them missing.
+        defer_fts = _has_fts()
+        if defer_fts:
+            conn.execute("DROP TRIGGER IF EXISTS books_fts_insert")
+        conn.execute("DROP TRIGGER IF EXISTS books_changed_insert")
+        
+        chunk = []
+        for index, record in enumerate(records):
+            chunk.append((index, record))
+            if len(chunk) >= chunk_size:
+                outcomes.extend(_add_books_chunk(conn, chunk, on_conflict, defer_fts))
+                chunk = []
+        if chunk:
+            outcomes.extend(_add_books_chunk(conn, chunk, on_conflict, defer_fts))
+        
+        if defer_fts:
+            conn.execute(fts_insert_trigger_sql())
+        conn.execute("UPDATE change_counters SET generation = generation + 1 WHERE name = 'books'")
+        conn.execute(change_trigger_sql('books', 'INSERT'))
+    
+    return outcomes
+
+
+def _book_values(record):
+    """
+    Validate an add_book-style record
+
+    Returns (values, record): the BOOK_FIELDS tuple to insert, and the record
+    with column names, holding only the fields it was given.
+    """
+    record = dict(record)
+    if 'format_type' in record:
+        record['format'] = record.pop('format_type')
+    unknown = set(record) - set(BOOK_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(sorted(unknown))}")
+    if not (record.get('title') or '').strip():
+        raise ValueError("Title is required")
+    
+    record['isbn'] = record.get('isbn') or None
+    values = {'format': 'Book', **record}
+    return tuple(values.get(field) for field in BOOK_FIELDS), record
+
+
+def _add_books_chunk(conn, chunk, on_conflict, index_fts=False):
+    """
+    Insert one chunk of add_books_bulk records; returns their outcomes
+
+    With index_fts (the insert trigger dropped), the new rows are added to
+    books_fts before any duplicates are updated: the update trigger removes
+    the old text from the index, which fails for a row that isn't in it.
+    """
+    outcomes = {}
+    to_insert = []    # (index, values)
+    duplicates = []   # (index, record, isbn)
+    pending = {}      # ISBN -> index of the record in this chunk that will insert it
+    
+    rows = []
+    for index, record in chunk:
+        try:
+            rows.append((index, *_book_values(record)))
+        except ValueError as e:
+            outcomes[index] = {'index': index, 'status': 'error', 'id': None, 'error': str(e)}
+    
+    isbns = [values[0] for _, values, _ in rows if values[0] is not None]
+    existing = {}
+    if isbns:
+        placeholders = ', '.join('?' * len(isbns))
+        existing = dict(conn.execute(
+            f"SELECT isbn, id FROM books WHERE isbn IN ({placeholders})", isbns
+        ).fetchall())
+    
+    for index, values, record in rows:
+        isbn = values[0]
+        if isbn is None or (isbn not in existing and isbn not in pending):
+            to_insert.append((index, values))
+            if isbn is not None:
+                pending[isbn] = index
+        elif on_conflict == 'error':
+            raise ValueError(f"A book with ISBN {isbn} already exists (record {index})")
+        else:
+            duplicates.append((index, record, isbn))
+    
+    _insert_rows(conn, to_insert, outcomes)
+    
+    inserted = [outcomes[index]['id'] for index, _ in to_insert
+                if outcomes[index]['status'] == 'inserted']
+    if index_fts and inserted:
+        # We hold the write lock, so every id from this chunk's first new one up is ours
+        columns = ', '.join(FTS_COLUMNS)
+        conn.execute(f"""
+            INSERT INTO books_fts (rowid, {columns})
+            SELECT id, {columns} FROM books WHERE id >= ?
+        """, (min(inserted),))
+    
+    # Duplicates of a book inserted earlier in this same chunk get its new id
+    for isbn, index in pending.items():
+        existing[isbn] = outcomes[index]['id']
+    
+    for index, record, isbn in duplicates:
+        book_id = existing.get(isbn)
+        if book_id is None:
+            outcomes[index] = {'index': index, 'status': 'error', 'id': None,
+                               'error': f"Earlier record with ISBN {isbn} failed"}
+        elif on_conflict == 'update':
+            fields = [field for field in BOOK_FIELDS if field in record and field != 'isbn']
+            if fields:
+                assignments = ', '.join(f"{field} = ?" for field in fields)
+                conn.execute(f"UPDATE books SET {assignments} WHERE id = ?",
+                             [record[field] for field in fields] + [book_id])
+            outcomes[index] = {'index': index, 'status': 'updated', 'id': book_id, 'error': None}
+        else:
+            outcomes[index] = {'index': index, 'status': 'skipped', 'id': book_id, 'error': None}
+    
+    return [outcomes[index] for index, _ in chunk]
+
+
+def _insert_rows(conn, to_insert, outcomes):
+    """
+    executemany the new rows, recording their ids in outcomes
+
+    The ids are worked out from last_insert_rowid(): we hold the write lock
+    and books uses AUTOINCREMENT, so one executemany allocates consecutive
+    ids. If the batch fails it is retried row by row to find the bad rows.
+    """
+    if not to_insert:
+        return
+    
+    columns = ', '.join(BOOK_FIELDS)
+    placeholders = ', '.join('?' * len(BOOK_FIELDS))
+    insert = f"INSERT INTO books ({columns}) VALUES ({placeholders})"
+    
+    conn.execute("SAVEPOINT bulk_chunk")
+    try:
+        conn.executemany(insert, [values for _, values in to_insert])
+    except sqlite3.Error:
+        conn.execute("ROLLBACK TO bulk_chunk")
+        conn.execute("RELEASE bulk_chunk")
+    else:
+        conn.execute("RELEASE bulk_chunk")
+        last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        first_id = last_id - len(to_insert) + 1
+        for offset, (index, _) in enumerate(to_insert):
+            outcomes[index] = {'index': index, 'status': 'inserted', 'id': first_id + offset,
+                               'error': None}
+        return
+    
+    for index, values in to_insert:
+        try:
+            book_id = conn.execute(insert, values).lastrowid
+            outcomes[index] = {'index': index, 'status': 'inserted', 'id': book_id, 'error': None}
+        except sqlite3.Error as e:
+            outcomes[index] = {'index': index, 'status': 'error', 'id': None, 'error': str(e)}
+
+
+@retry_on_busy
+def update_book(book_id, only_if_empty=False, **kwargs):
+    """
+    Update book details
+
+    With only_if_empty=True a field is only set if it is currently empty
+    (NULL or ''), so values the user has entered are never overwritten.
+    """
     # Build update query dynamically based on provided kwargs
     fields = []
     values = []
     for key, value in kwargs.items():
-        fields.append(f"{key} = ?")
+        if only_if_empty:
+            fields.append(f"{key} = CASE WHEN {key} IS NULL OR {key} = '' THEN ? ELSE {key} END")
+        else:
+            fields.append(f"{key} = ?")
         values.append(value)
     
     if fields:
         query = f"UPDATE books SET {', '.join(fields)} WHERE id = ?"
         values.append(book_id)
-        cursor.execute(query, values)
-        conn.commit()
-    
-    conn.close()
+        _connect().execute(query, values)
+
+
+# Details the ISBN lookup can fill in for books added by hand or offline
+ENRICHABLE_FIELDS = ('publisher', 'page_count', 'description', 'cover_path')
+
+
+def get_books_to_enrich(retry=False, limit=None):
+    """
+    Get books that have an ISBN but are missing some ENRICHABLE_FIELDS
+
+    Books already in the enrichment log are skipped unless retry is True.
+    """
+    columns = ', '.join(ENRICHABLE_FIELDS)
+    missing = ' OR '.join(f"{field} IS NULL OR {field} = ''" for field in ENRICHABLE_FIELDS)
+    query = f"""
+        SELECT id, isbn, {columns} FROM books
+        WHERE isbn IS NOT NULL AND isbn != '' AND ({missing})
+    """
+    if not retry:
+        query += " AND id NOT IN (SELECT book_id FROM enrichment_log)"
+    query += " ORDER BY id"
+    params = []
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return _connect().execute(query, params).fetchall()
+
+
+@retry_on_busy
+def save_enrichment(results):
+    """
+    Write a batch of enrichment results in one transaction
+
+    results is a list of (book_id, status, fields). Only empty fields are
+    filled in, and each book is recorded in the enrichment log - except
+    with status None, so the next run looks at it again.
+    """
+    conn = _connect()
+    with transaction(conn):
+        for book_id, status, fields in results:
+            if fields:
+                update_book(book_id, only_if_empty=True, **fields)
+            if status is None:
+                continue
+            conn.execute("""
+                INSERT OR REPLACE INTO enrichment_log (book_id, status, attempted_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+            """, (book_id, status))
+
+
+# Book details an intake lookup fills in, kept in the intake table until approved
+INTAKE_FIELDS = ('title', 'year', 'author', 'publisher', 'page_count', 'description', 'cover_path')
+
+
+def get_isbns():
+    """Get the ISBN of every book that has one (as entered, not normalised)"""
+    cursor = _connect().cursor()
+    cursor.row_factory = None
+    cursor.execute("SELECT isbn FROM books WHERE isbn IS NOT NULL AND isbn != ''")
+    return [isbn for (isbn,) in cursor.fetchall()]
+
+
+@retry_on_busy
+def add_intake(isbn, status='pending'):
+    """Stage a scanned ISBN for review; returns the intake id"""
+    return _connect().execute("INSERT INTO intake (isbn, status) VALUES (?, ?)",
+                              (isbn, status)).lastrowid
+
+
+def get_intake():
+    """Get every staged ISBN, oldest scan first"""
+    cursor = _connect().execute("SELECT * FROM intake ORDER BY id")
+    
+    return [dict(row) for row in cursor.fetchall()]
+
+
+@retry_on_busy
+def save_intake_results(results):
+    """
+    Write a batch of intake lookups in one transaction
+
+    results is a list of (intake_id, status, fields), fields being a dict
+    of INTAKE_FIELDS.
+    """
+    conn = _connect()
+    with transaction(conn):
+        for intake_id, status, fields in results:
+            columns = [field for field in INTAKE_FIELDS if field in fields]
+            assignments = ''.join(f", {field} = ?" for field in columns)
+            conn.execute(f"UPDATE intake SET status = ?{assignments} WHERE id = ?",
+                         [status, *(fields[field] for field in columns), intake_id])
+
+
+@retry_on_busy
+def approve_intake(intake_ids):
+    """
+    Add staged books to the library in one transaction
+
+    Only entries whose lookup found a title are added, through
+    add_books_bulk (so an ISBN that reached the library in the meantime is
+    skipped). Entries that were added or skipped leave the intake table.
+    Returns add_books_bulk's outcomes, with 'intake_id' added to each.
+    """
+    intake_ids = list(intake_ids)
+    if not intake_ids:
+        return []
+    conn = _connect()
+    with transaction(conn):
+        placeholders = ', '.join('?' * len(intake_ids))
+        rows = conn.execute(f"""
+            SELECT * FROM intake
+            WHERE id IN ({placeholders}) AND title IS NOT NULL AND title != ''
+            ORDER BY id
+        """, intake_ids).fetchall()
+        outcomes = add_books_bulk(
+            {'isbn': row['isbn'], **{field: row[field] for field in INTAKE_FIELDS}}
+            for row in rows)
+        done = []
+        for outcome, row in zip(outcomes, rows):
+            outcome['intake_id'] = row['id']
+            if outcome['status'] in ('inserted', 'skipped'):
+                done.append(row['id'])
+        if done:
+            placeholders = ', '.join('?' * len(done))
+            conn.execute(f"DELETE FROM intake WHERE id IN ({placeholders})", done)
+    return outcomes
+
+
+@retry_on_busy
+def discard_intake(intake_ids):
+    """Remove staged ISBNs without adding them"""
+    intake_ids = list(intake_ids)
+    if intake_ids:
+        placeholders = ', '.join('?' * len(intake_ids))
+        _connect().execute(f"DELETE FROM intake WHERE id IN ({placeholders})", intake_ids)
 
 
 def get_book(book_id):
     """Get a book by ID"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM books WHERE id = ?", (book_id,))
-    book = cursor.fetchone()
-    conn.close()
+    book = _connect().execute("SELECT * FROM books WHERE id = ?", (book_id,)).fetchone()
     
     return dict(book) if book else None
 
 
+def get_books(book_ids):
+    """Get several books by ID in one query, as a dict of ID -> book"""
+    book_ids = list(book_ids)
+    if not book_ids:
+        return {}
+    placeholders = ', '.join('?' * len(book_ids))
+    cursor = _connect().execute(f"SELECT * FROM books WHERE id IN ({placeholders})", book_ids)
+    
+    return {row['id']: dict(row) for row in cursor.fetchall()}
+
+
 def get_all_books():
     """Get all books"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    cursor = _connect().execute("SELECT * FROM books ORDER BY title COLLATE NOCASE")
+    
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def get_book_summaries(book_ids=None):
+    """
+    Get books as BookSummary objects
+
+    With no book_ids, every book sorted by title; otherwise just those
+    books, in book_ids order (IDs that no longer exist are left out).
+    """
+    if book_ids is None:
+        return _fetch_summaries(f"SELECT {_SUMMARY_SELECT} FROM books ORDER BY title COLLATE NOCASE")
+    book_ids = list(book_ids)
+    if not book_ids:
+        return []
+    placeholders = ', '.join('?' * len(book_ids))
+    found = {book.id: book for book in _fetch_summaries(
+        f"SELECT {_SUMMARY_SELECT} FROM books WHERE id IN ({placeholders})", book_ids)}
+    return [found[book_id] for book_id in book_ids if book_id in found]
+
+
+def _quick_search_filter(query):
+    """
+    WHERE clause and params restricting books to a quick-search query
+
+    Same matching rules as search_books: the full-text index, or a LIKE
+    substring match if there isn't one. Returns ("1", []) for an empty query.
+    """
+    query = (query or '').strip()
+    if not query:
+        return "1", []
+    
+    terms = _fts_terms(query)
+    if terms and _has_fts():
+        return "id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ?)", [terms]
+    pattern = f"%{query}%"
+    return "(title LIKE ? OR author LIKE ? OR artist LIKE ? OR isbn LIKE ?)", [pattern] * 4
+
+
+def get_books_page(after_sort_key=None, limit=100, query=None, before_sort_key=None):
+    """
+    Get one page of the alphabetical book list using keyset pagination
+
+    Books are ordered by (title, id), case-insensitively. Pass the sort key
+    of the last row you have as after_sort_key to get the next page, or the
+    key of the first row as before_sort_key to get the page above it (still
+    returned in list order). Sort keys come from book_sort_key(). Seeking
+    by key uses the title index, so every page costs the same however deep
+    into the list it is, unlike LIMIT/OFFSET.
+
+    Only the columns a list needs are fetched: id, title, author, and the
+    borrower_name and date_due of the current loan (None if not on loan).
+    """
+    where, params = _quick_search_filter(query)
+    conditions = [where]
+    # Written as (title, id) > (? COLLATE NOCASE, ?) rather than putting the
+    # COLLATE on title - same comparison, but this form lets SQLite seek
+    # straight to the key in idx_books_title instead of scanning up to it
+    if after_sort_key is not None:
+        conditions.append("(title, id) > (? COLLATE NOCASE, ?)")
+        params += list(after_sort_key)
+    if before_sort_key is not None:
+        conditions.append("(title, id) < (? COLLATE NOCASE, ?)")
+        params += list(before_sort_key)
+    
+    direction = "DESC" if before_sort_key is not None and after_sort_key is None else "ASC"
+    cursor = _connect().execute(f"""
+        SELECT id, title, author, {LOAN_STATUS_SELECT} FROM books
+        WHERE {' AND '.join(conditions)}
+        ORDER BY title COLLATE NOCASE {direction}, id {direction}
+        LIMIT ?
+    """, params + [limit])
     
-    cursor.execute("SELECT * FROM books ORDER BY title COLLATE NOCASE")
     books = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
+    if direction == "DESC":
+        books.reverse()
     return books
 
 
-def search_books(query):
-    """Search books by title, author, artist, or ISBN (quick search)"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
+def get_books_page_at(offset, limit=100, query=None):
+    """
+    Get the page of the alphabetical book list starting at a row number
+
+    For jumping to an arbitrary scroll position. OFFSET still walks the
+    index up to that row, so use get_books_page to move page by page.
+    """
+    where, params = _quick_search_filter(query)
+    cursor = _connect().execute(f"""
+        SELECT id, title, author, {LOAN_STATUS_SELECT} FROM books
+        WHERE {where}
+        ORDER BY title COLLATE NOCASE, id
+        LIMIT ? OFFSET ?
+    """, params + [limit, max(0, offset)])
+    
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def count_books(query=None):
+    """Count the books in the library, or those matching a quick-search query"""
+    where, params = _quick_search_filter(query)
+    return _connect().execute(f"SELECT COUNT(*) FROM books WHERE {where}", params).fetchone()[0]
+
+
+def count_books_before(sort_key, query=None):
+    """Count the books that sort before sort_key, i.e. the row number it would have"""
+    where, params = _quick_search_filter(query)
+    return _connect().execute(f"""
+        SELECT COUNT(*) FROM books
+        WHERE {where} AND (title, id) < (? COLLATE NOCASE, ?)
+    """, params + list(sort_key)).fetchone()[0]
+
+
+def book_sort_key(book):
+    """The keyset pagination key for a book row: (title, id)"""
+    return (book['title'], book['id'])
+
+
+def search_books(query, summaries=False):
+    """
+    Search books by title, author, artist, or ISBN (quick search)
+
+    Uses the full-text index with prefix matching, best matches first:
+    each word must start a word of the book, so "man" finds "Manga" and
+    "Iron Man" but not "Batman". Without FTS5 it falls back to a LIKE
+    substring match (a full table scan). A query of only one- or two-letter
+    words matches too many books for ranking to mean much, so it returns
+    the first SHORT_QUERY_LIMIT matches by title instead. Returns dicts, or
+    BookSummary objects if summaries is True.
+    """
+    terms = _fts_terms(query)
+    if not (terms and _has_fts()):
+        return _search_books_like(query, summaries)
+    
+    if max(len(word) for word in re.findall(r'\w+', query)) <= SHORT_QUERY_CHARS:
+        return _fetch("""
+            SELECT {columns} FROM books
+            WHERE id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ?)
+            ORDER BY title COLLATE NOCASE, id
+            LIMIT ?
+        """, (terms, SHORT_QUERY_LIMIT), summaries)
+    
+    weights = ', '.join(str(weight) for weight in FTS_COLUMNS.values())
+    return _fetch(f"""
+        SELECT {{columns}} FROM books_fts
+        JOIN books ON books.id = books_fts.rowid
+        WHERE books_fts MATCH ?
+        ORDER BY bm25(books_fts, {weights}), books.title COLLATE NOCASE
+    """, (terms,), summaries)
+
+
+def _search_books_like(query, summaries=False):
+    """Quick search using LIKE substring matching (full table scan)"""
     search_pattern = f"%{query}%"
-    cursor.execute("""
-        SELECT * FROM books 
+    return _fetch("""
+        SELECT {columns} FROM books 
         WHERE title LIKE ? OR author LIKE ? OR artist LIKE ? OR isbn LIKE ?
         ORDER BY title COLLATE NOCASE
-    """, (search_pattern, search_pattern, search_pattern, search_pattern))
-    
-    books = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    return books
-
-
-def advanced_search(isbn=None, title=None, series=None, author=None, artist=None, publisher=None):
-    """Advanced search with multiple criteria (case-insensitive, partial matching)"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # Build query dynamically based on provided criteria
+    """, (search_pattern, search_pattern, search_pattern, search_pattern), summaries)
+
+
+def advanced_search(isbn=None, title=None, series=None, author=None, artist=None, publisher=None,
+                    summaries=False):
+    """
+    Advanced search with multiple criteria (case-insensitive, partial matching)
+
+    Each criterion is matched against its own column of the full-text index;
+    results stay sorted by title. Falls back to substring matching without
+    FTS5, like search_books. Returns dicts, or BookSummary objects if
+    summaries is True.
+    """
+    match = _advanced_fts_match(isbn, title, series, author, artist, publisher)
+    if match and _has_fts():
+        return _fetch("""
+            SELECT {columns} FROM books_fts
+            JOIN books ON books.id = books_fts.rowid
+            WHERE books_fts MATCH ?
+            ORDER BY books.title COLLATE NOCASE
+        """, (match,), summaries)
+    
+    return _advanced_search_like(isbn, title, series, author, artist, publisher, summaries)
+
+
+def advanced_search_ids(isbn=None, title=None, series=None, author=None, artist=None,
+                        publisher=None):
+    """
+    Just the IDs of advanced_search's results, in the same order
+
+    Returned as a compact array of integers, so even "every book" in a big
+    library is cheap to hold; fetch the rows on screen with
+    get_book_summaries(ids). With no criteria, every book.
+    """
+    where, params = _advanced_search_filter(isbn, title, series, author, artist, publisher)
+    cursor = _connect().cursor()
+    cursor.row_factory = None       # plain tuples; sqlite3.Row costs more than the query
+    cursor.execute(f"SELECT id FROM books WHERE {where} ORDER BY title COLLATE NOCASE", params)
+    return array('q', (row[0] for row in cursor))
+
+
+def _advanced_fts_match(isbn, title, series, author, artist, publisher):
+    """Full-text MATCH expression for advanced search criteria, or None if there isn't one"""
+    criteria = {
+        'isbn': isbn,
+        'title': title,
+        'series_name': series,
+        'author': author,
+        'artist': artist,
+        'publisher': publisher,
+    }
+    filters = []
+    for column, value in criteria.items():
+        if not value:
+            continue
+        terms = _fts_terms(value)
+        if terms is None:
+            # Punctuation-only criterion - only a substring match can honour it
+            return None
+        filters.append(f"{column} : ({terms})")
+    return ' AND '.join(filters) or None
+
+
+def _advanced_search_filter(isbn, title, series, author, artist, publisher):
+    """
+    WHERE clause and params restricting books to advanced search criteria
+
+    Same matching rules as advanced_search, like _quick_search_filter is
+    for search_books.
+    """
+    match = _advanced_fts_match(isbn, title, series, author, artist, publisher)
+    if match and _has_fts():
+        return "id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ?)", [match]
+    return _advanced_like_filter(isbn, title, series, author, artist, publisher)
+
+
+def _advanced_like_filter(isbn, title, series, author, artist, publisher):
+    """WHERE clause and params for advanced search by LIKE substring matching"""
     conditions = []
     params = []
+    for column, value in (('isbn', isbn), ('title', title), ('series_name', series),
+                          ('author', author), ('artist', artist), ('publisher', publisher)):
+        if value:
+            conditions.append(f"{column} LIKE ?")
+            params.append(f"%{value}%")
     
-    if isbn:
-        conditions.append("isbn LIKE ?")
-        params.append(f"%{isbn}%")
-    
-    if title:
-        conditions.append("title LIKE ?")
-        params.append(f"%{title}%")
-    
-    if series:
-        conditions.append("series_name LIKE ?")
-        params.append(f"%{series}%")
-    
-    if author:
-        conditions.append("author LIKE ?")
-        params.append(f"%{author}%")
-    
-    if artist:
-        conditions.append("artist LIKE ?")
-        params.append(f"%{artist}%")
-    
-    if publisher:
-        conditions.append("publisher LIKE ?")
-        params.append(f"%{publisher}%")
-    
-    # If no criteria provided, return all books
-    if not conditions:
-        cursor.execute("SELECT * FROM books ORDER BY title COLLATE NOCASE")
-    else:
-        where_clause = " AND ".join(conditions)
-        query = f"SELECT * FROM books WHERE {where_clause} ORDER BY title COLLATE NOCASE"
-        cursor.execute(query, params)
-    
-    books = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    return books
+    # If no criteria provided, every book matches
+    return " AND ".join(conditions) or "1", params
+
+
+def _advanced_search_like(isbn=None, title=None, series=None, author=None, artist=None, publisher=None,
+                          summaries=False):
+    """Advanced search using LIKE substring matching (full table scan)"""
+    where_clause, params = _advanced_like_filter(isbn, title, series, author, artist, publisher)
+    query = f"SELECT {{columns}} FROM books WHERE {where_clause} ORDER BY title COLLATE NOCASE"
+    return _fetch(query, params, summaries)
 
 
+@retry_on_busy
 def loan_book(book_id, borrower_name, loan_days=30):
-    """Record a book loan"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    """Record a book loan (triggers fill in loaned_at and due_at from the dates)"""
+    date_loaned = datetime.now()
+    date_due = date_loaned + timedelta(days=loan_days)
     
-    date_loaned = datetime.now().isoformat()
-    date_due = (datetime.now() + timedelta(days=loan_days)).isoformat()
-    
-    cursor.execute("""
+    cursor = _connect().execute("""
         INSERT INTO loans (book_id, borrower_name, date_loaned, date_due)
         VALUES (?, ?, ?, ?)
-    """, (book_id, borrower_name, date_loaned, date_due))
-    
-    conn.commit()
-    loan_id = cursor.lastrowid
-    conn.close()
+    """, (book_id, borrower_name, date_loaned.isoformat(), date_due.isoformat()))
     
-    return loan_id
+    return cursor.lastrowid
 
 
+@retry_on_busy
 def return_book(loan_id):
-    """Mark a book as returned"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    date_returned = datetime.now().isoformat()
-    cursor.execute("""
+    """Mark a book as returned (a trigger fills in returned_at)"""
+    _connect().execute("""
         UPDATE loans SET date_returned = ? WHERE id = ?
-    """, (date_returned, loan_id))
-    
-    conn.commit()
-    conn.close()
+    """, (datetime.now().isoformat(), loan_id))
 
 
 def get_current_loan(book_id):
     """Get the current active loan for a book (if any)"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute("""
+    loan = _connect().execute("""
         SELECT * FROM loans 
         WHERE book_id = ? AND date_returned IS NULL
         ORDER BY date_loaned DESC
         LIMIT 1
-    """, (book_id,))
-    
-    loan = cursor.fetchone()
-    conn.close()
+    """, (book_id,)).fetchone()
     
     return dict(loan) if loan else None
 
 
-def get_all_loans():
-    """Get all active loans"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT loans.*, books.title, books.author
+def get_all_loans(now=None):
+    """
+    Get all active loans, soonest due first
+
+    Each loan also has due_status - 'overdue', 'due soon' (within
+    DUE_SOON_DAYS) or 'on loan' - and days_left until it is due (negative
+    once overdue). now is a Unix timestamp, for testing.
+    """
+    now = int(time.time()) if now is None else now
+    cursor = _connect().execute("""
+        SELECT loans.*, books.title, books.author,
+            CASE WHEN loans.due_at < :now THEN 'overdue'
+                 WHEN loans.due_at < :now + :soon THEN 'due soon'
+                 ELSE 'on loan' END AS due_status,
+            CASE WHEN loans.due_at < :now THEN -((:now - loans.due_at) / 86400)
+                 ELSE (loans.due_at - :now) / 86400 END AS days_left
         FROM loans
         JOIN books ON loans.book_id = books.id
-        WHERE loans.date_returned IS NULL
-        ORDER BY loans.date_due
-    """)
+        WHERE loans.returned_at IS NULL
+        ORDER BY loans.due_at
+    """, {'now': now, 'soon': DUE_SOON_DAYS * 86400})
     
-    loans = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    return loans
+    return [dict(row) for row in cursor.fetchall()]
 
 
-def get_overdue_loans():
-    """Get all overdue loans (> 30 days)"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    now = datetime.now().isoformat()
-    cursor.execute("""
-        SELECT loans.*, books.title, books.author
+def get_overdue_loans(now=None):
+    """
+    Get the loans not yet returned whose due date (due_at) is before now,
+    with days_overdue worked out
+
+    A range scan of idx_loans_open_due_at, however long the loan history
+    gets. now is a Unix timestamp, for testing.
+    """
+    now = int(time.time()) if now is None else now
+    cursor = _connect().execute("""
+        SELECT loans.*, books.title, books.author,
+            (:now - loans.due_at) / 86400 AS days_overdue
         FROM loans
         JOIN books ON loans.book_id = books.id
-        WHERE loans.date_returned IS NULL AND loans.date_due < ?
-        ORDER BY loans.date_due
-    """, (now,))
-    
-    loans = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+        WHERE loans.returned_at IS NULL AND loans.due_at < :now
+        ORDER BY loans.due_at
+    """, {'now': now})
     
-    return loans
+    return [dict(row) for row in cursor.fetchall()]
 
 
 def get_loan_history(book_id):
     """Get loan history for a specific book"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute("""
+    cursor = _connect().execute("""
         SELECT * FROM loans 
         WHERE book_id = ?
         ORDER BY date_loaned DESC
     """, (book_id,))
     
-    loans = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    return loans
+    return [dict(row) for row in cursor.fetchall()]
 
 
+@retry_on_busy
 def delete_book(book_id):
-    """Delete a book from the database"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("DELETE FROM books WHERE id = ?", (book_id,))
-    conn.commit()
-    conn.close()
+    """Delete a book from the database (its loans go with it via ON DELETE CASCADE)"""
+    _connect().execute("DELETE FROM books WHERE id = ?", (book_id,))
 
 
 if __name__ == "__main__":
     # Initialise database when run directly
-    init_database()
+    for version, description, seconds in init_database():
+        print(f"Applied migration {version} ({description}) in {seconds * 1000:.1f} ms")
     print(f"Database initialised at {DB_PATH}")
@@ -0,0 +1,242 @@
+"""
+Fill in missing book details from Open Library
+
+Books added by hand or while offline often have an ISBN but no publisher,
+page count, description or cover. enrich_library() finds them, looks them
+up on a small pool of worker threads (sharing one rate limit, so Open
+Library isn't hammered) and writes the answers back in batches. Only empty
+fields are filled in - anything the user has typed is left alone.
+
+Every book that was dealt with is recorded in the enrichment log, so an
+interrupted run carries on where it stopped. Run it from the app's
+"Fill In Missing Details" button or from the command line:
+
+    python enrichment.py [--workers 4] [--rate 2] [--no-covers] [--retry]
+"""
+
+import argparse
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import database
+import isbn_cache
+import isbn_lookup
+
+WORKERS = 4             # lookups and downloads running at once
+RATE = 2.0              # requests per second to Open Library, across all workers
+WRITE_BATCH = 25        # books written per transaction
+
+
+class RateLimiter:
+    """Spaces out calls to acquire() so they happen at most rate times a second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for the next free slot"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class EnrichmentStats:
+    """Counters for one enrichment run"""
+
+    def __init__(self):
+        self.checked = 0        # books looked up
+        self.enriched = 0       # books that got at least one new detail
+        self.not_found = 0      # ISBNs Open Library doesn't know
+        self.failed = 0         # lookups that failed (retried next run)
+        self.covers = 0         # covers downloaded
+        self.seconds = 0.0
+        self.stopped = False    # True if the run was interrupted
+
+    @property
+    def books_per_second(self):
+        return self.checked / self.seconds if self.seconds else 0.0
+
+    def summary(self):
+        text = (f"Checked {self.checked} books in {self.seconds:.1f} s "
+                f"({self.books_per_second:.1f}/s): {self.enriched} filled in, "
+                f"{self.covers} covers, {self.not_found} not found, {self.failed} failed")
+        if self.stopped:
+            text += " (stopped early - run again to continue)"
+        return text
+
+
+def _missing(book):
+    """Names of the enrichable fields a book row has no value for"""
+    return [field for field in database.ENRICHABLE_FIELDS if book[field] in (None, '')]
+
+
+def _fields_from(result, missing):
+    """The looked-up values for a book's missing fields (cover handled separately)"""
+    fields = {}
+    for field in missing:
+        value = result.get(field)
+        if field != 'cover_path' and value not in (None, ''):
+            fields[field] = value
+    return fields
+
+
+def _lookup(isbns, limiter):
+    """Look up a batch of ISBNs (worker thread)"""
+    limiter.acquire()
+    return isbn_lookup.lookup_isbns(isbns)
+
+
+def _download(cover_url, isbn, limiter):
+    """Download a cover, returning its path or None (worker thread)"""
+    limiter.acquire()
+    cover_path = isbn_lookup.get_cover_path(isbn)
+    if isbn_lookup.download_cover(cover_url, cover_path):
+        return str(cover_path)
+    return None
+
+
+def enrich_library(workers=WORKERS, rate=RATE, covers=True, retry=False, limit=None,
+                   batch_size=WRITE_BATCH, lookup_size=isbn_lookup.BATCH_SIZE,
+                   should_stop=None, progress=None):
+    """
+    Look up and fill in missing details for every incomplete book
+
+    ISBNs are looked up lookup_size to a request. should_stop() is checked
+    between steps; when it returns True the run saves what it has and
+    returns early. progress(stats) is called after each batch is written.
+    Both are called on the thread running this function. Returns an
+    EnrichmentStats.
+    """
+    stats = EnrichmentStats()
+    start = time.perf_counter()
+    books = database.get_books_to_enrich(retry=retry, limit=limit)
+    limiter = RateLimiter(rate)
+    pending_writes = []
+    in_flight = {}      # future -> (kind, books or book)
+
+    def stopping():
+        return should_stop is not None and should_stop()
+
+    def flush():
+        if pending_writes:
+            database.save_enrichment(pending_writes)
+            pending_writes.clear()
+            if progress:
+                progress(stats)
+
+    def finish(book, fields, status):
+        if fields:
+            stats.enriched += 1
+        pending_writes.append((book['id'], status, fields))
+        if len(pending_writes) >= batch_size:
+            flush()
+
+    # Split into lookup batches; lookup_isbns sends each as one request
+    batches = [books[i:i + lookup_size] for i in range(0, len(books), lookup_size)]
+    batches.reverse()
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="enrichment")
+    try:
+        while batches or in_flight:
+            # Keep at most `workers` jobs queued so a stop takes effect quickly
+            while batches and len(in_flight) < workers and not stopping():
+                batch = batches.pop()
+                future = executor.submit(_lookup, [book['isbn'] for book in batch], limiter)
+                in_flight[future] = ('lookup', batch)
+            if batches and stopping():
+                stats.stopped = True
+                batches.clear()
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, item = in_flight.pop(future)
+                if kind == 'cover':
+                    book, fields = item
+                    cover_path = future.result()
+                    if cover_path:
+                        stats.covers += 1
+                        fields['cover_path'] = cover_path
+                    finish(book, fields, 'enriched' if fields else 'unchanged')
+                    continue
+
+                results = future.result()
+                for book in item:
+                    stats.checked += 1
+                    result = results.get(book['isbn'])
+                    if result is None:
+                        # A cached "not found" is a real answer; anything else
+                        # was a failed request, so try again next run
+                        if isbn_cache.get(isbn_lookup.normalize_isbn(book['isbn']))[0]:
+                            stats.not_found += 1
+                            finish(book, {}, 'not_found')
+                        else:
+                            stats.failed += 1
+                        continue
+
+                    missing = _missing(book)
+                    fields = _fields_from(result, missing)
+                    wants_cover = covers and 'cover_path' in missing and result.get('cover_url')
+                    if wants_cover and stopping():
+                        # Save what we have, but leave the book out of the log
+                        # so the next run comes back for the cover
+                        finish(book, fields, None)
+                    elif wants_cover:
+                        cover = executor.submit(_download, result['cover_url'], book['isbn'],
+                                                limiter)
+                        in_flight[cover] = ('cover', (book, fields))
+                    else:
+                        finish(book, fields, 'enriched' if fields else 'unchanged')
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        flush()
+        stats.seconds = time.perf_counter() - start
+
+    return stats
+
+
+def progress_printer(file=None):
+    """A progress callback for enrich_library that prints a line per batch to file (stdout)"""
+    started = time.perf_counter()
+
+    def progress(stats):
+        stats.seconds = time.perf_counter() - started
+        print(f"  {stats.checked} checked, {stats.enriched} filled in "
+              f"({stats.books_per_second:.1f}/s)", file=file)
+
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill in missing book details from Open Library")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="lookups running at once (default %(default)s)")
+    parser.add_argument('--rate', type=float, default=RATE,
+                        help="requests per second (default %(default)s)")
+    parser.add_argument('--limit', type=int, help="only check this many books")
+    parser.add_argument('--no-covers', action='store_true', help="don't download covers")
+    parser.add_argument('--retry', action='store_true',
+                        help="also retry books an earlier run already dealt with")
+    args = parser.parse_args()
+
+    database.init_database()
+    print(f"{len(database.get_books_to_enrich(retry=args.retry, limit=args.limit))} books to check")
+
+    try:
+        stats = enrich_library(workers=args.workers, rate=args.rate, covers=not args.no_covers,
+                               retry=args.retry, limit=args.limit, progress=progress_printer())
+    except KeyboardInterrupt:
+        print("Interrupted - finished books were saved; run again to continue")
+        return
+    print(stats.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+Barcode-scanner intake for Callum's Library App
+
+Cataloguing a donated box means scanning ISBN after ISBN. Intake keeps
+scanning instant: scan() only checks the ISBN against in-memory sets and
+returns; the ISBN is written to the intake table on a worker thread, with
+anything else scanned meanwhile. Lookups happen on a worker thread too,
+several at a time (see async_lookup), and everything scanned while one
+batch is being looked up goes in the next batch. Results land in the
+intake table for the user to review and approve in bulk:
+
+- ISBNs already in the library are flagged as duplicates straight away,
+  from a set of the library's ISBNs loaded once in the background
+- scanning the same ISBN twice is ignored
+- approving adds every selected book in one transaction
+
+Intake entries have a status: 'pending' (waiting for its lookup), 'found',
+'not_found', 'failed' (the request failed; retry() tries again) or
+'duplicate'.
+"""
+
+import re
+
+import async_lookup
+import database
+import isbn_cache
+import isbn_lookup
+
+LOOKUP_BATCH = 100      # most ISBNs handed to one lookup job
+REQUEST_SIZE = 10       # ISBNs per Open Library request within a job
+
+_ISBN = re.compile(r"\d{9}[\dX]|\d{13}")
+
+
+def clean_isbn(text):
+    """The normalised ISBN in scanned or typed text, or None if it isn't one"""
+    isbn = isbn_lookup.normalize_isbn(text.strip()).upper()
+    return isbn if _ISBN.fullmatch(isbn) else None
+
+
+def isbn13(isbn):
+    """
+    A normalised ISBN in its 13-digit form, for comparing
+
+    The same book may be in the library under its ISBN-10 and be scanned
+    from its EAN-13 barcode. Anything else is returned unchanged.
+    """
+    if len(isbn) != 10 or not isbn[:9].isdigit():
+        return isbn
+    digits = "978" + isbn[:9]
+    check = -sum(int(digit) * (3 if i % 2 else 1) for i, digit in enumerate(digits)) % 10
+    return digits + str(check)
+
+
+def load_library_isbns():
+    """The ISBNs of every book in the library, as isbn13() (runs on a worker thread)"""
+    return {isbn13(isbn_lookup.normalize_isbn(isbn).upper()) for isbn in database.get_isbns()}
+
+
+def stage_scans(scans):
+    """Write scanned (isbn, status) pairs to the intake table, in order; returns their ids"""
+    return [database.add_intake(isbn, status) for isbn, status in scans]
+
+
+def lookup_intake(task, entries, concurrency):
+    """
+    Look up staged ISBNs and save what was found (runs on a worker thread)
+
+    entries is a list of (intake_id, isbn). Returns the results written, as
+    for database.save_intake_results, or None if the task was cancelled
+    first (the entries are left pending).
+    """
+    books = async_lookup.fetch_books([isbn for _, isbn in entries], concurrency=concurrency,
+                                     batch_size=REQUEST_SIZE,
+                                     should_stop=lambda: task.cancelled)
+    if books is None:
+        return None
+
+    results = []
+    for intake_id, isbn in entries:
+        result, cover_path = books[isbn]
+        if result:
+            fields = {field: result.get(field) for field in database.INTAKE_FIELDS}
+            fields['cover_path'] = str(cover_path) if cover_path else None
+            results.append((intake_id, 'found', fields))
+        elif isbn_cache.get(isbn)[0]:
+            # A cached "not found" is a real answer; anything else was a failed request
+            results.append((intake_id, 'not_found', {}))
+        else:
+            results.append((intake_id, 'failed', {}))
+    database.save_intake_results(results)
+    return results
+
+
+class Intake:
+    """
+    The scan queue behind the intake tab
+
+    Runs lookups through tasks (a BackgroundTasks) and calls on_change()
+    on the Tk main thread whenever entries were added, looked up or removed.
+    """
+
+    def __init__(self, tasks, on_change, concurrency=async_lookup.CONCURRENCY):
+        self.tasks = tasks
+        self.on_change = on_change
+        self.concurrency = concurrency
+        self.library_isbns = None   # isbn13() of every book in the library, once loaded
+        self.staged = {}            # isbn13() -> intake id (None until written)
+        self._scanned = []          # (isbn13(), isbn, status) waiting to be written
+        self._writing = []          # those being written now
+        self._queue = []            # (intake_id, isbn) waiting for a lookup
+        self._unchecked = []        # (intake_id, isbn) not yet checked against library_isbns
+        self._task = None           # lookup job in progress
+        self._in_flight = []        # (intake_id, isbn) in that job
+        self.last_error = None
+
+    def start(self):
+        """Pick up entries from earlier sessions and load the library's ISBNs"""
+        for entry in database.get_intake():
+            self.staged[isbn13(entry['isbn'])] = entry['id']
+            if entry['status'] == 'pending':
+                self._unchecked.append((entry['id'], entry['isbn']))
+        self.reload_isbns()
+
+    def reload_isbns(self):
+        """Reload the library's ISBNs in the background (after books changed elsewhere)"""
+        self.tasks.submit(load_library_isbns, on_done=self._on_isbns_loaded,
+                          key='intake-isbns')
+
+    def stop(self):
+        """Cancel the lookup in progress; its entries stay pending for next time"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._in_flight = []
+
+    def scan(self, text):
+        """
+        Stage a scanned ISBN and queue its lookup, without waiting for either
+
+        Returns what happened: 'queued', 'duplicate' (already in the
+        library), 'already scanned' or 'invalid'.
+        """
+        isbn = clean_isbn(text)
+        if isbn is None:
+            return 'invalid'
+        key = isbn13(isbn)
+        if key in self.staged:
+            return 'already scanned'
+        duplicate = self.library_isbns is not None and key in self.library_isbns
+        self.staged[key] = None
+        self._scanned.append((key, isbn, 'duplicate' if duplicate else 'pending'))
+        self._write_scans()
+        return 'duplicate' if duplicate else 'queued'
+
+    @property
+    def queued(self):
+        """ISBNs waiting for or being looked up"""
+        writing = sum(status == 'pending' for _, _, status in self._scanned + self._writing)
+        return writing + len(self._queue) + len(self._unchecked) + len(self._in_flight)
+
+    def approve(self, intake_ids):
+        """Add staged books to the library (one transaction); returns the outcomes"""
+        outcomes = database.approve_intake(intake_ids)
+        approved = {outcome['intake_id'] for outcome in outcomes
+                    if outcome['status'] in ('inserted', 'skipped')}
+        for key, intake_id in list(self.staged.items()):
+            if intake_id in approved:
+                del self.staged[key]
+                if self.library_isbns is not None:
+                    self.library_isbns.add(key)
+        if outcomes:
+            self.on_change()
+        return outcomes
+
+    def discard(self, intake_ids):
+        """Remove staged entries without adding them"""
+        intake_ids = set(intake_ids)
+        database.discard_intake(intake_ids)
+        self.staged = {isbn: intake_id for isbn, intake_id in self.staged.items()
+                       if intake_id not in intake_ids}
+        self._queue = [entry for entry in self._queue if entry[0] not in intake_ids]
+        self._unchecked = [entry for entry in self._unchecked if entry[0] not in intake_ids]
+        self.on_change()
+
+    def retry(self):
+        """Look up the entries whose request failed (or whose job went wrong) again"""
+        waiting = {intake_id for intake_id, _ in self._queue + self._unchecked + self._in_flight}
+        failed = [(entry['id'], entry['isbn']) for entry in database.get_intake()
+                  if entry['status'] == 'failed'
+                  or (entry['status'] == 'pending' and entry['id'] not in waiting)]
+        if failed:
+            database.save_intake_results([(intake_id, 'pending', {}) for intake_id, _ in failed])
+            self._queue.extend(failed)
+            self._pump()
+            self.on_change()
+        return len(failed)
+
+    def _write_scans(self):
+        """Write what has been scanned to the intake table, if no write is running"""
+        if self._writing or not self._scanned:
+            return
+        self._writing, self._scanned = self._scanned, []
+        self.tasks.submit(stage_scans, [(isbn, status) for _, isbn, status in self._writing],
+                          on_done=self._on_written, on_error=self._on_write_failed)
+
+    def _on_written(self, intake_ids):
+        written, self._writing = self._writing, []
+        for (key, isbn, status), intake_id in zip(written, intake_ids):
+            self.staged[key] = intake_id
+            if status == 'pending':
+                self._unchecked.append((intake_id, isbn))
+        self._write_scans()
+        if self.library_isbns is not None:
+            self._sort_unchecked()
+        self.on_change()
+
+    def _on_write_failed(self, error):
+        # Forget the scans, so scanning them again tries again
+        for key, _, _ in self._writing:
+            self.staged.pop(key, None)
+        self._writing = []
+        self.last_error = error
+        self._write_scans()
+        self.on_change()
+
+    def _on_isbns_loaded(self, isbns):
+        self.library_isbns = isbns
+        if self._unchecked:
+            self._sort_unchecked()
+            self.on_change()
+
+    def _sort_unchecked(self):
+        """Flag unchecked entries already in the library as duplicates and queue the rest"""
+        isbns = self.library_isbns
+        unchecked, self._unchecked = self._unchecked, []
+        duplicates = [(intake_id, 'duplicate', {}) for intake_id, isbn in unchecked
+                      if isbn13(isbn) in isbns]
+        if duplicates:
+            database.save_intake_results(duplicates)
+        self._queue.extend(entry for entry in unchecked if isbn13(entry[1]) not in isbns)
+        self._pump()
+
+    def _pump(self):
+        """Start the next lookup job if none is running"""
+        if self._task is not None or not self._queue:
+            return
+        self._in_flight, self._queue = self._queue[:LOOKUP_BATCH], self._queue[LOOKUP_BATCH:]
+        self._task = self.tasks.submit(lookup_intake, self._in_flight, self.concurrency,
+                                       on_done=self._on_looked_up, on_error=self._on_failed,
+                                       pass_task=True)
+
+    def _on_looked_up(self, results):
+        self._task = None
+        self._in_flight = []
+        self.last_error = None
+        self._pump()
+        self.on_change()
+
+    def _on_failed(self, error):
+        # The entries stay pending; retry() or the next session picks them up
+        self._task = None
+        self._in_flight = []
+        self.last_error = error
+        self._pump()
+        self.on_change()
@@ -0,0 +1,123 @@
+"""
+Local cache of Open Library lookups for Callum's Library App
+
+Stored in its own SQLite file, separate from library.db, so it can be
+deleted at any time without losing anything. Entries are keyed on the
+normalised ISBN and hold the parsed result, the raw JSON and when it was
+fetched. ISBNs Open Library doesn't know are cached too ("negative"
+entries), but for a shorter time, since they may be added later.
+"""
+
+import json
+import threading
+import time
+from pathlib import Path
+
+from connection_manager import get_connection, transaction
+
+CACHE_PATH = Path(__file__).parent / "isbn_cache.db"
+
+# How long entries stay fresh
+TTL_SECONDS = 30 * 24 * 60 * 60          # found: 30 days
+NOT_FOUND_TTL_SECONDS = 24 * 60 * 60     # not found: 1 day
+
+_ready = set()      # cache files whose table has been created
+_stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'stores': 0}
+_stats_lock = threading.Lock()
+
+
+def _connect():
+    """Get this thread's connection to the cache, creating the table on first use"""
+    conn = get_connection(CACHE_PATH)
+    key = str(CACHE_PATH)
+    if key not in _ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS isbn_cache (
+                isbn TEXT PRIMARY KEY,
+                result TEXT,            -- parsed result as JSON, NULL if not found
+                raw TEXT,               -- response from Open Library
+                fetched_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        _ready.add(key)
+    return conn
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def get(isbn):
+    """
+    Look up a normalised ISBN in the cache
+
+    Returns (hit, result). hit is False if there is no fresh entry; when it
+    is True, result is the cached dict, or None for a cached "not found".
+    """
+    row = _connect().execute(
+        "SELECT result, fetched_at FROM isbn_cache WHERE isbn = ?", (isbn,)
+    ).fetchone()
+
+    if row is not None:
+        result, fetched_at = row
+        ttl = TTL_SECONDS if result is not None else NOT_FOUND_TTL_SECONDS
+        if time.time() - fetched_at < ttl:
+            _count('hits' if result is not None else 'negative_hits')
+            return True, json.loads(result) if result is not None else None
+
+    _count('misses')
+    return False, None
+
+
+def put(isbn, result, raw=None):
+    """Store a lookup result (None for "not found") with its raw JSON"""
+    put_many([(isbn, result, raw)])
+
+
+def put_many(entries):
+    """Store several (isbn, result, raw) lookups in one transaction"""
+    now = time.time()
+    rows = [(isbn, json.dumps(result) if result is not None else None,
+             json.dumps(raw) if raw is not None else None, now)
+            for isbn, result, raw in entries]
+    if not rows:
+        return
+
+    conn = _connect()
+    with transaction(conn):
+        conn.executemany("""
+            INSERT OR REPLACE INTO isbn_cache (isbn, result, raw, fetched_at)
+            VALUES (?, ?, ?, ?)
+        """, rows)
+    with _stats_lock:
+        _stats['stores'] += len(rows)
+
+
+def get_raw(isbn):
+    """Get the raw Open Library JSON stored for an ISBN, or None"""
+    row = _connect().execute("SELECT raw FROM isbn_cache WHERE isbn = ?", (isbn,)).fetchone()
+    return json.loads(row[0]) if row and row[0] is not None else None
+
+
+def invalidate(isbn):
+    """Forget one ISBN, so the next lookup goes to Open Library"""
+    _connect().execute("DELETE FROM isbn_cache WHERE isbn = ?", (isbn,))
+
+
+def clear():
+    """Forget every cached lookup"""
+    _connect().execute("DELETE FROM isbn_cache")
+
+
+def stats():
+    """Get the hit/miss counters since start-up (or the last reset_stats)"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    """Zero the hit/miss counters"""
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
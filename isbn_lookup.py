@@ -2,13 +2,63 @@
 ISBN lookup module using Open Library API
 """
 
+import os
+import re
+import tempfile
+import threading
 import requests
 from pathlib import Path
-from io import BytesIO
 from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import isbn_cache
+from cover_cache import to_rgb
 
-def lookup_isbn(isbn):
+OPEN_LIBRARY_URL = "https://openlibrary.org"
+COVERS_DIR = Path(__file__).parent / "covers"
+
+# Network settings
+TIMEOUT = 10                # seconds per request
+RETRIES = 3                 # retries for connection errors and 429/5xx responses
+BACKOFF_FACTOR = 0.5        # waits 0, 1, 2... seconds between retries
+BATCH_SIZE = 50             # ISBNs per Books API request
+
+# Cover downloads
+MAX_COVER_BYTES = 10 * 1024 * 1024      # give up on anything bigger
+MAX_COVER_SIZE = (1200, 1800)           # larger covers are shrunk to fit
+CHUNK_SIZE = 64 * 1024
+
+_local = threading.local()
+
+
+def _session():
+    """
+    Get this thread's requests.Session
+
+    A Session keeps connections to Open Library open between requests, so
+    only the first one pays for the TCP and TLS handshakes. Failed requests
+    are retried with exponential backoff.
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        retry = Retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset({'GET'}))
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=4)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return session
+
+
+def normalize_isbn(isbn):
+    """Clean an ISBN for lookups and cache keys (remove hyphens/spaces)"""
+    return isbn.replace("-", "").replace(" ", "")
+
+
+def lookup_isbn(isbn, use_cache=True):
     """
     Look up book information by ISBN using Open Library API
     
@@ -22,117 +72,230 @@ def lookup_isbn(isbn):
         - cover_url (for downloading)
     
     Returns None if ISBN not found
+    
+    Answers are kept in the local ISBN cache (see isbn_cache.py), so looking
+    up the same ISBN again doesn't go back to Open Library. Pass
+    use_cache=False to force a fresh lookup.
+    """
+    return lookup_isbns([isbn], use_cache=use_cache)[isbn]
+
+
+def lookup_isbns(isbns, batch_size=BATCH_SIZE, use_cache=True):
     """
-    # Clean ISBN (remove hyphens/spaces)
-    isbn_clean = isbn.replace("-", "").replace(" ", "")
+    Look up many ISBNs, asking Open Library for up to batch_size per request
     
-    # Try Open Library Books API
-    url = f"https://openlibrary.org/api/books?bibkeys=ISBN:{isbn_clean}&jscmd=data&format=json"
+    Returns a dict mapping each ISBN, as given, to the same result
+    lookup_isbn would return (None if not found). Cached answers are used
+    where available and new answers are cached. ISBNs in a batch whose
+    request fails also map to None, but aren't cached.
+    """
+    results, wanted = check_cache(isbns, use_cache)
+    
+    pending = list(wanted)
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        for isbn_clean, result in fetch_batch(batch).items():
+            for isbn in wanted[isbn_clean]:
+                results[isbn] = result
+    
+    return results
+
+
+def check_cache(isbns, use_cache=True):
+    """
+    Split ISBNs into cached answers and ones still to look up
+    
+    Returns (results, wanted): results maps every ISBN as given to its
+    cached answer or None for now, and wanted maps each normalised ISBN
+    still to look up to the ISBNs as given (for fetch_batch). With
+    use_cache=False, every ISBN is wanted.
+    """
+    results = {}
+    wanted = {}
+    for isbn in isbns:
+        isbn_clean = normalize_isbn(isbn)
+        if use_cache:
+            hit, result = isbn_cache.get(isbn_clean)
+            if hit:
+                results[isbn] = result
+                continue
+        wanted.setdefault(isbn_clean, []).append(isbn)
+        results[isbn] = None
+    return results, wanted
+
+
+def fetch_batch(isbns_clean, cancel=None):
+    """
+    Ask the Books API about several normalised ISBNs in one request
+    
+    Returns {isbn: result or None}, or {} if the request failed. The
+    answers are cached, unless cancel (an optional threading.Event) was
+    set while the request was out: a caller that gave up waiting doesn't
+    want them, and they may be stale by then.
+    """
+    bibkeys = ','.join(f"ISBN:{isbn}" for isbn in isbns_clean)
+    url = f"{OPEN_LIBRARY_URL}/api/books?bibkeys={bibkeys}&jscmd=data&format=json"
     
     try:
-        response = requests.get(url, timeout=10)
+        response = _session().get(url, timeout=TIMEOUT)
         response.raise_for_status()
         data = response.json()
-        
-        # Check if we got results
-        key = f"ISBN:{isbn_clean}"
-        if key not in data:
-            return None
-        
-        book_data = data[key]
-        
-        # Extract information
-        result = {}
-        
-        # Title
-        result['title'] = book_data.get('title', '')
-        
-        # Year - extract from publish_date if available
-        result['year'] = ''
-        if 'publish_date' in book_data:
-            publish_date = book_data['publish_date']
-            # Try to extract year (often in format like "2005" or "May 2005")
-            import re
-            year_match = re.search(r'\b(19|20)\d{2}\b', publish_date)
-            if year_match:
-                result['year'] = year_match.group(0)
-        
-        # Authors
-        authors = []
-        if 'authors' in book_data:
-            for author in book_data['authors']:
-                if 'name' in author:
-                    authors.append(author['name'])
-        result['author'] = ', '.join(authors)
-        
-        # Publishers
-        publishers = []
-        if 'publishers' in book_data:
-            for publisher in book_data['publishers']:
-                if 'name' in publisher:
-                    publishers.append(publisher['name'])
-        result['publisher'] = ', '.join(publishers)
-        
-        # Page count
-        result['page_count'] = book_data.get('number_of_pages', None)
-        
-        # Description
-        result['description'] = ''
-        if 'description' in book_data:
-            desc = book_data['description']
-            if isinstance(desc, dict) and 'value' in desc:
-                result['description'] = desc['value']
-            elif isinstance(desc, str):
-                result['description'] = desc
-        
-        # Cover URL
-        result['cover_url'] = None
-        if 'cover' in book_data:
-            cover = book_data['cover']
-            if 'large' in cover:
-                result['cover_url'] = cover['large']
-            elif 'medium' in cover:
-                result['cover_url'] = cover['medium']
-            elif 'small' in cover:
-                result['cover_url'] = cover['small']
-        
-        return result
-        
-    except requests.RequestException as e:
+    except (requests.RequestException, ValueError) as e:
+        # Not cached - the next lookup should try again
         print(f"Error looking up ISBN: {e}")
-        return None
+        return {}
+    
+    if cancel is not None and cancel.is_set():
+        return {}
+    
+    results = {}
+    entries = []
+    for isbn in isbns_clean:
+        book_data = data.get(f"ISBN:{isbn}")
+        results[isbn] = parse_book_data(book_data) if book_data is not None else None
+        entries.append((isbn, results[isbn], book_data))
+    isbn_cache.put_many(entries)
+    return results
+
+
+def parse_book_data(book_data):
+    """Extract our fields from one Open Library Books API entry (see lookup_isbn)"""
+    result = {}
+    
+    # Title
+    result['title'] = book_data.get('title', '')
+    
+    # Year - extract from publish_date if available
+    result['year'] = ''
+    if 'publish_date' in book_data:
+        publish_date = book_data['publish_date']
+        # Try to extract year (often in format like "2005" or "May 2005")
+        year_match = re.search(r'\b(19|20)\d{2}\b', publish_date)
+        if year_match:
+            result['year'] = year_match.group(0)
+    
+    # Authors
+    authors = []
+    if 'authors' in book_data:
+        for author in book_data['authors']:
+            if 'name' in author:
+                authors.append(author['name'])
+    result['author'] = ', '.join(authors)
+    
+    # Publishers
+    publishers = []
+    if 'publishers' in book_data:
+        for publisher in book_data['publishers']:
+            if 'name' in publisher:
+                publishers.append(publisher['name'])
+    result['publisher'] = ', '.join(publishers)
+    
+    # Page count
+    result['page_count'] = book_data.get('number_of_pages', None)
+    
+    # Description
+    result['description'] = ''
+    if 'description' in book_data:
+        desc = book_data['description']
+        if isinstance(desc, dict) and 'value' in desc:
+            result['description'] = desc['value']
+        elif isinstance(desc, str):
+            result['description'] = desc
+    
+    # Cover URL
+    result['cover_url'] = None
+    if 'cover' in book_data:
+        cover = book_data['cover']
+        if 'large' in cover:
+            result['cover_url'] = cover['large']
+        elif 'medium' in cover:
+            result['cover_url'] = cover['medium']
+        elif 'small' in cover:
+            result['cover_url'] = cover['small']
+    
+    return result
 
 
-def download_cover(cover_url, save_path):
+def download_cover(cover_url, save_path, max_bytes=MAX_COVER_BYTES, cancel=None):
     """
     Download a cover image from URL and save it locally
     
+    The download is streamed to a temporary file next to save_path and
+    abandoned if it grows past max_bytes, or once cancel (an optional
+    threading.Event) is set. A JPEG that fits MAX_COVER_SIZE is
+    kept byte for byte; anything else is shrunk and/or converted to JPEG.
+    save_path only ever appears complete, so a failed or interrupted
+    download never leaves a broken cover behind.
+    
     Returns True if successful, False otherwise
     """
     if not cover_url:
         return False
     
+    save_path = Path(save_path)
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=save_path.parent, suffix='.part')
     try:
-        response = requests.get(cover_url, timeout=10)
-        response.raise_for_status()
+        with os.fdopen(fd, 'wb') as temp_file, \
+                _session().get(cover_url, timeout=TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            length = response.headers.get('Content-Length')
+            if length and int(length) > max_bytes:
+                raise ValueError(f"cover is {int(length):,} bytes, more than {max_bytes:,}")
+            
+            received = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if cancel is not None and cancel.is_set():
+                    raise InterruptedError("download cancelled")
+                received += len(chunk)
+                if received > max_bytes:
+                    raise ValueError(f"cover is more than {max_bytes:,} bytes")
+                temp_file.write(chunk)
         
-        # Open image and save
-        img = Image.open(BytesIO(response.content))
-        img.save(save_path)
+        _store_cover(temp_path, save_path)
         return True
         
     except Exception as e:
         print(f"Error downloading cover: {e}")
         return False
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _store_cover(temp_path, save_path):
+    """Check a downloaded image and move it (shrunk or converted if needed) to save_path"""
+    # verify() checks the file without decoding the pixels
+    with Image.open(temp_path) as img:
+        img.verify()
+        image_format, (width, height) = img.format, img.size
+    
+    max_width, max_height = MAX_COVER_SIZE
+    if image_format == 'JPEG' and width <= max_width and height <= max_height:
+        os.replace(temp_path, save_path)
+        return
+    
+    # verify() leaves the image unusable, so open it again to convert it
+    with Image.open(temp_path) as img:
+        img.draft('RGB', MAX_COVER_SIZE)    # JPEGs decode straight at a smaller scale
+        img.thumbnail(MAX_COVER_SIZE, Image.Resampling.LANCZOS)
+        img = to_rgb(img)
+    
+    fd, converted_path = tempfile.mkstemp(dir=save_path.parent, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as converted_file:
+            img.save(converted_file, 'JPEG', quality=90)
+        os.replace(converted_path, save_path)
+    finally:
+        if os.path.exists(converted_path):
+            os.remove(converted_path)
 
 
 def get_cover_path(isbn):
     """Get the path where a cover image should be saved"""
-    covers_dir = Path(__file__).parent / "covers"
-    covers_dir.mkdir(exist_ok=True)
+    COVERS_DIR.mkdir(exist_ok=True)
     
-    isbn_clean = isbn.replace("-", "").replace(" ", "")
-    return covers_dir / f"{isbn_clean}.jpg"
+    return COVERS_DIR / f"{normalize_isbn(isbn)}.jpg"
 
 
 if __name__ == "__main__":
@@ -3,13 +3,23 @@ Callum's Library Management System
 Main GUI Application
 """
 
+import logging
+import os
 import tkinter as tk
 from tkinter import ttk, scrolledtext, filedialog
-from PIL import Image, ImageTk
 from pathlib import Path
 import shutil
+import connection_manager
+import cover_cache
 import database
+import enrichment
 import isbn_lookup
+import query_stats
+from background import BackgroundTasks
+from change_watcher import ChangeWatcher
+from intake import Intake
+from prefetch import Prefetcher
+from widgets import ChunkedRenderer, VirtualListbox, VirtualTreeview, load_window
 
 
 class SilentDialog:
@@ -126,6 +136,64 @@ class SilentDialog:
         return result[0]
 
 
+# Wait this long after the last keystroke before searching
+SEARCH_DEBOUNCE_MS = 200
+
+
+def fetch_book_details(task, isbn):
+    """
+    Look up an ISBN and download its cover (runs on a worker thread)
+
+    Returns (result, cover_path); cover_path is None if there was no cover.
+    """
+    result = isbn_lookup.lookup_isbn(isbn)
+    if not result or not result.get('cover_url') or task.cancelled:
+        return result, None
+    
+    cover_path = isbn_lookup.get_cover_path(isbn)
+    if isbn_lookup.download_cover(result['cover_url'], cover_path):
+        return result, cover_path
+    return result, None
+
+
+def enrich_books(task):
+    """Fill in missing details for incomplete books (runs on a worker thread)"""
+    return enrichment.enrich_library(should_stop=lambda: task.cancelled)
+
+
+def find_search_results(criteria):
+    """
+    IDs of the books matching advanced search criteria (runs on a worker
+    thread; no criteria means every book)
+    """
+    return database.advanced_search_ids(**criteria)
+
+
+class BookListSource:
+    """Keyset-paginated books for the library list, optionally filtered by a search"""
+    
+    def __init__(self, query=''):
+        self.query = query
+    
+    def count(self):
+        return database.count_books(self.query)
+    
+    def page_after(self, key, limit):
+        return database.get_books_page(key, limit, self.query)
+    
+    def page_before(self, key, limit):
+        return database.get_books_page(limit=limit, query=self.query, before_sort_key=key)
+    
+    def page_at(self, offset, limit):
+        return database.get_books_page_at(offset, limit, self.query)
+    
+    def count_before(self, key):
+        return database.count_books_before(key, self.query)
+    
+    def key(self, row):
+        return database.book_sort_key(row)
+
+
 class LibraryApp:
     def __init__(self, root):
         self.root = root
@@ -139,9 +207,32 @@ class LibraryApp:
         self.current_book_id = None
         self.cover_image = None
         
+        # Thumbnails of recently shown covers, ready to display
+        self.cover_photos = cover_cache.PhotoCache()
+        
+        # Bumped whenever the form is cleared or another book is loaded, so
+        # background results meant for the previous contents can be ignored
+        self.form_generation = 0
+        self.lookup_task = None
+        self.enrichment_task = None
+        
         # Debounce timer for listbox selection
         self.selection_timer = None
         
+        # Debounce timer for the library search box
+        self.search_timer = None
+        
+        # Worker threads for slow queries and lookups
+        self.tasks = BackgroundTasks(root)
+        
+        # Books next to the selection, loaded ahead of time
+        self.prefetcher = Prefetcher(self.tasks)
+        
+        # Fill the loan lists a few milliseconds at a time, so long lists don't freeze the window
+        self.loans_renderer = ChunkedRenderer(root)
+        self.overdue_renderer = ChunkedRenderer(root)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        
         # Create notebook for tabs
         self.notebook = ttk.Notebook(root)
         self.notebook.pack(fill='both', expand=True, padx=10, pady=10)
@@ -151,11 +242,27 @@ class LibraryApp:
         self.create_search_tab()
         self.create_loans_tab()
         self.create_overdue_tab()
+        self.create_intake_tab()
         
         # Load initial data
         self.refresh_library_list()
         self.refresh_loans_list()
         self.refresh_overdue_list()
+        
+        # Scanned ISBNs waiting for lookup or review (picks up the last session's)
+        self.intake = Intake(self.tasks, self.refresh_intake_list)
+        self.intake.start()
+        self.refresh_intake_list()
+        
+        # Refresh tabs when the data behind them changes, here or in
+        # another copy of the app using the same database
+        self.changes = ChangeWatcher(root, self.on_database_changed)
+        self.changes.start()
+        
+        # Hidden query diagnostics window
+        self.diagnostics_window = None
+        self.diagnostics_timer = None
+        root.bind('<Control-Shift-D>', self.show_diagnostics)
     
     def create_library_tab(self):
         """Main library tab for browsing and adding books"""
@@ -170,10 +277,16 @@ class LibraryApp:
         self.isbn_entry = ttk.Entry(top_frame, width=20)
         self.isbn_entry.pack(side='left', padx=5)
         
-        ttk.Button(top_frame, text="Look Up", command=self.lookup_isbn).pack(side='left', padx=5)
+        self.lookup_button = ttk.Button(top_frame, text="Look Up", command=self.lookup_isbn)
+        self.lookup_button.pack(side='left', padx=5)
         ttk.Button(top_frame, text="Add New Book", command=self.add_new_book).pack(side='left', padx=5)
         ttk.Button(top_frame, text="Clear", command=self.clear_form).pack(side='left', padx=5)
         
+        # Shown only while an ISBN lookup is running
+        self.lookup_progress = ttk.Progressbar(top_frame, mode='indeterminate', length=120)
+        self.lookup_cancel_button = ttk.Button(top_frame, text="Cancel Lookup",
+                                               command=self.cancel_lookup)
+        
         # Main content area
         content_frame = ttk.Frame(library_frame)
         content_frame.pack(fill='both', expand=True, padx=10)
@@ -287,15 +400,15 @@ class LibraryApp:
         ttk.Label(search_frame, text="Search:").pack(side='left', padx=5)
         self.search_entry = ttk.Entry(search_frame)
         self.search_entry.pack(side='left', fill='x', expand=True, padx=5)
-        self.search_entry.bind('<KeyRelease>', lambda e: self.refresh_library_list())
+        self.search_entry.bind('<KeyRelease>', self.on_search_typed)
+        self.enrich_button = ttk.Button(search_frame, text="Fill In Missing Details",
+                                        command=self.toggle_enrichment)
+        self.enrich_button.pack(side='left', padx=5)
         
-        # Book list with debounced selection
-        list_scroll = ttk.Scrollbar(list_frame)
-        list_scroll.pack(side='right', fill='y')
-        
-        self.book_list = tk.Listbox(list_frame, yscrollcommand=list_scroll.set, height=8)
-        self.book_list.pack(side='left', fill='both', expand=True)
-        list_scroll.config(command=self.book_list.yview)
+        # Book list with debounced selection - only the rows on screen are loaded
+        self.library_query = None
+        self.book_list = VirtualListbox(list_frame, format_row=self.format_book_row, height=8)
+        self.book_list.pack(fill='both', expand=True)
         
         self.book_list.bind('<<ListboxSelect>>', self.on_book_selected_debounced)
     
@@ -365,20 +478,20 @@ class LibraryApp:
         results_frame = ttk.Frame(search_frame)
         results_frame.pack(fill='both', expand=True, padx=10, pady=(0, 10))
         
-        # Scrollbars
-        v_scroll = ttk.Scrollbar(results_frame, orient='vertical')
-        v_scroll.pack(side='right', fill='y')
-        
+        # Scrollbar (the virtual treeview has its own vertical one)
         h_scroll = ttk.Scrollbar(results_frame, orient='horizontal')
         h_scroll.pack(side='bottom', fill='x')
         
-        # Treeview
-        columns = ('Title', 'Author', 'Artist', 'Series', 'Publisher', 'Year')
-        self.search_results_tree = ttk.Treeview(results_frame, columns=columns, show='tree headings',
-                                                yscrollcommand=v_scroll.set,
-                                                xscrollcommand=h_scroll.set)
+        # Treeview holding only the rows on screen; the results are kept as book IDs
+        columns = ('Title', 'Author', 'Artist', 'Series', 'Publisher', 'Year', 'Status')
+        self.search_results = VirtualTreeview(results_frame, self.search_result_item,
+                                              fetch=lambda ids: database.get_book_summaries(ids),
+                                              row_id=lambda book: book.id,
+                                              columns=columns, show='tree headings',
+                                              xscrollcommand=h_scroll.set)
+        self.search_results_tree = self.search_results.tree
+        self.search_criteria = None     # criteria of the results shown, {} for Show All
         
-        v_scroll.config(command=self.search_results_tree.yview)
         h_scroll.config(command=self.search_results_tree.xview)
         
         self.search_results_tree.heading('#0', text='ID')
@@ -402,7 +515,10 @@ class LibraryApp:
         self.search_results_tree.heading('Year', text='Year')
         self.search_results_tree.column('Year', width=60)
         
-        self.search_results_tree.pack(side='left', fill='both', expand=True)
+        self.search_results_tree.heading('Status', text='Status')
+        self.search_results_tree.column('Status', width=160)
+        
+        self.search_results.pack(side='left', fill='both', expand=True)
         
         # Bind double-click to load book
         self.search_results_tree.bind('<Double-Button-1>', self.load_book_from_search)
@@ -419,7 +535,7 @@ class LibraryApp:
         self.notebook.add(loans_frame, text='Current Loans')
         
         # Treeview for loans
-        columns = ('Title', 'Author', 'Borrower', 'Loaned', 'Due')
+        columns = ('Title', 'Author', 'Borrower', 'Loaned', 'Due', 'Status')
         self.loans_tree = ttk.Treeview(loans_frame, columns=columns, show='tree headings')
         
         self.loans_tree.heading('#0', text='ID')
@@ -482,6 +598,51 @@ class LibraryApp:
         ttk.Button(button_frame, text="Refresh", 
                    command=self.refresh_overdue_list).pack(side='left', padx=5)
     
+    def create_intake_tab(self):
+        """Tab for scanning a pile of books and adding them in one go"""
+        intake_frame = ttk.Frame(self.notebook)
+        self.notebook.add(intake_frame, text='Intake')
+        
+        # Scan box: a barcode scanner types the ISBN and presses Enter
+        scan_frame = ttk.Frame(intake_frame)
+        scan_frame.pack(fill='x', padx=10, pady=10)
+        ttk.Label(scan_frame, text="Scan ISBN:").pack(side='left', padx=5)
+        self.intake_entry = ttk.Entry(scan_frame, width=20)
+        self.intake_entry.pack(side='left', padx=5)
+        self.intake_entry.bind('<Return>', self.scan_intake_isbn)
+        self.intake_message = ttk.Label(scan_frame, text="")
+        self.intake_message.pack(side='left', padx=10)
+        self.intake_status = ttk.Label(scan_frame, text="")
+        self.intake_status.pack(side='right', padx=5)
+        
+        # Treeview of staged ISBNs
+        columns = ('ISBN', 'Status', 'Title', 'Author', 'Year')
+        self.intake_tree = ttk.Treeview(intake_frame, columns=columns, show='headings')
+        for col in columns:
+            self.intake_tree.heading(col, text=col)
+            if col == 'Title':
+                self.intake_tree.column(col, width=280)
+            elif col == 'Author':
+                self.intake_tree.column(col, width=180)
+            elif col == 'Year':
+                self.intake_tree.column(col, width=60)
+            else:
+                self.intake_tree.column(col, width=120)
+        self.intake_tree.tag_configure('duplicate', foreground='red')
+        self.intake_tree.tag_configure('pending', foreground='gray')
+        self.intake_tree.pack(fill='both', expand=True, padx=10)
+        
+        button_frame = ttk.Frame(intake_frame)
+        button_frame.pack(fill='x', padx=10, pady=10)
+        ttk.Button(button_frame, text="Approve All Found",
+                   command=self.approve_all_intake).pack(side='left', padx=5)
+        ttk.Button(button_frame, text="Approve Selected",
+                   command=self.approve_selected_intake).pack(side='left', padx=5)
+        ttk.Button(button_frame, text="Discard Selected",
+                   command=self.discard_selected_intake).pack(side='left', padx=5)
+        ttk.Button(button_frame, text="Retry Failed",
+                   command=self.retry_intake).pack(side='left', padx=5)
+    
     def upload_cover_image(self):
         """Allow manual upload of cover image"""
         if not self.current_book_id:
@@ -518,6 +679,7 @@ class LibraryApp:
             
             # Update database
             database.update_book(self.current_book_id, cover_path=str(new_path))
+            self.changes.check_now()
             
             # Display the cover
             self.display_cover(new_path)
@@ -528,7 +690,7 @@ class LibraryApp:
             SilentDialog.showerror("Error", f"Failed to upload cover image: {e}", self.root)
     
     def lookup_isbn(self):
-        """Look up book information by ISBN"""
+        """Look up book information by ISBN (runs in the background)"""
         isbn = self.isbn_entry.get().strip()
         if not isbn:
             SilentDialog.showwarning("No ISBN", "Please enter an ISBN", self.root)
@@ -538,54 +700,117 @@ class LibraryApp:
         self.clear_form()
         self.isbn_entry.insert(0, isbn)
         
-        # Show loading message
-        self.root.config(cursor="wait")
-        self.root.update()
+        # Remember which form the result is for; loading another book or
+        # clearing the form in the meantime makes it stale
+        form_generation = self.form_generation
         
-        try:
-            result = isbn_lookup.lookup_isbn(isbn)
+        self.lookup_task = self.tasks.submit(
+            fetch_book_details, isbn,
+            on_done=lambda result: self.on_lookup_finished(isbn, form_generation, result),
+            on_error=lambda error: self.on_lookup_failed(isbn, form_generation, error),
+            key='isbn-lookup', pass_task=True)
+        self.show_lookup_progress(True)
+    
+    def cancel_lookup(self):
+        """Abandon the ISBN lookup in progress"""
+        if self.lookup_task:
+            self.lookup_task.cancel()
+            self.lookup_task = None
+        self.show_lookup_progress(False)
+    
+    def show_lookup_progress(self, running):
+        """Show or hide the lookup progress bar and cancel button"""
+        if running:
+            self.lookup_button.config(state='disabled')
+            self.lookup_progress.pack(side='left', padx=5)
+            self.lookup_cancel_button.pack(side='left', padx=5)
+            self.lookup_progress.start(15)
+        else:
+            self.lookup_progress.stop()
+            self.lookup_progress.pack_forget()
+            self.lookup_cancel_button.pack_forget()
+            self.lookup_button.config(state='normal')
+    
+    def lookup_is_current(self, isbn, form_generation):
+        """Whether the form is still showing the lookup that was started"""
+        return (form_generation == self.form_generation and
+                self.isbn_entry.get().strip() == isbn)
+    
+    def on_lookup_finished(self, isbn, form_generation, details):
+        """Fill in the form from a finished ISBN lookup"""
+        self.lookup_task = None
+        self.show_lookup_progress(False)
+        if not self.lookup_is_current(isbn, form_generation):
+            return
+        
+        result, cover_path = details
+        if result:
+            # Fill in the fields
+            self.title_entry.delete(0, 'end')
+            self.title_entry.insert(0, result.get('title', ''))
             
-            if result:
-                # Fill in the fields
-                self.title_entry.delete(0, 'end')
-                self.title_entry.insert(0, result.get('title', ''))
-                
-                self.year_entry.delete(0, 'end')
-                self.year_entry.insert(0, result.get('year', ''))
-                
-                self.author_entry.delete(0, 'end')
-                self.author_entry.insert(0, result.get('author', ''))
-                
-                self.publisher_entry.delete(0, 'end')
-                self.publisher_entry.insert(0, result.get('publisher', ''))
-                
-                self.page_count_entry.delete(0, 'end')
-                if result.get('page_count'):
-                    self.page_count_entry.insert(0, str(result['page_count']))
-                
-                self.description_text.delete('1.0', 'end')
-                self.description_text.insert('1.0', result.get('description', ''))
-                
-                # Download cover if available
-                if result.get('cover_url'):
-                    cover_path = isbn_lookup.get_cover_path(isbn)
-                    if isbn_lookup.download_cover(result['cover_url'], cover_path):
-                        self.display_cover(cover_path)
-                
-                SilentDialog.showinfo("Success", "Book information loaded! Please review and save.", self.root)
-            else:
-                SilentDialog.showwarning("Not Found", 
-                                       "ISBN not found in Open Library. You can still add the book manually.",
-                                       self.root)
-        finally:
-            self.root.config(cursor="")
+            self.year_entry.delete(0, 'end')
+            self.year_entry.insert(0, result.get('year', ''))
+            
+            self.author_entry.delete(0, 'end')
+            self.author_entry.insert(0, result.get('author', ''))
+            
+            self.publisher_entry.delete(0, 'end')
+            self.publisher_entry.insert(0, result.get('publisher', ''))
+            
+            self.page_count_entry.delete(0, 'end')
+            if result.get('page_count'):
+                self.page_count_entry.insert(0, str(result['page_count']))
+            
+            self.description_text.delete('1.0', 'end')
+            self.description_text.insert('1.0', result.get('description', ''))
+            
+            if cover_path:
+                self.display_cover(cover_path)
+            
+            SilentDialog.showinfo("Success", "Book information loaded! Please review and save.", self.root)
+        else:
+            SilentDialog.showwarning("Not Found", 
+                                   "ISBN not found in Open Library. You can still add the book manually.",
+                                   self.root)
+    
+    def on_lookup_failed(self, isbn, form_generation, error):
+        """Report an ISBN lookup that raised an error"""
+        self.lookup_task = None
+        self.show_lookup_progress(False)
+        if self.lookup_is_current(isbn, form_generation):
+            SilentDialog.showerror("Error", f"ISBN lookup failed: {error}", self.root)
+    
+    def toggle_enrichment(self):
+        """Start filling in missing details from Open Library, or stop a run in progress"""
+        if self.enrichment_task:
+            # The run saves what it has done so far; the next one carries on
+            self.enrichment_task.cancel()
+            self.on_enrichment_finished(None)
+            return
+        
+        self.enrichment_task = self.tasks.submit(
+            enrich_books, on_done=self.on_enrichment_finished,
+            on_error=self.on_enrichment_failed, key='enrichment', pass_task=True)
+        self.enrich_button.config(text="Stop Filling In")
+    
+    def on_enrichment_finished(self, stats):
+        """Show the result of an enrichment run"""
+        self.enrichment_task = None
+        self.enrich_button.config(text="Fill In Missing Details")
+        self.changes.check_now()
+        if stats is not None:
+            SilentDialog.showinfo("Missing Details", stats.summary(), self.root)
+    
+    def on_enrichment_failed(self, error):
+        """Report an enrichment run that raised an error"""
+        self.on_enrichment_finished(None)
+        SilentDialog.showerror("Error", f"Filling in details failed: {error}", self.root)
     
     def display_cover(self, image_path):
         """Display a cover image"""
         try:
-            img = Image.open(image_path)
-            img.thumbnail((200, 300), Image.Resampling.LANCZOS)
-            photo = ImageTk.PhotoImage(img)
+            photo = self.cover_photos.get(image_path)
             
             self.cover_image = photo
             self.cover_label.config(image=photo, text='')
@@ -595,6 +820,7 @@ class LibraryApp:
     
     def clear_form(self):
         """Clear all form fields"""
+        self.form_generation += 1
         self.current_book_id = None
         self.isbn_entry.delete(0, 'end')
         self.title_entry.delete(0, 'end')
@@ -664,7 +890,7 @@ class LibraryApp:
             
             SilentDialog.showinfo("Success", "Book added to library!", self.root)
             self.clear_form()
-            self.refresh_library_list()
+            self.changes.check_now()
             
         except ValueError as e:
             SilentDialog.showerror("Error", str(e), self.root)
@@ -698,9 +924,9 @@ class LibraryApp:
             updates['series_number'] = int(series_number) if series_number else None
             
             database.update_book(self.current_book_id, **updates)
+            self.changes.check_now()
             
             SilentDialog.showinfo("Success", "Book updated!", self.root)
-            self.refresh_library_list()
             
         except Exception as e:
             SilentDialog.showerror("Error", f"Failed to save changes: {e}", self.root)
@@ -719,9 +945,9 @@ class LibraryApp:
         
         try:
             database.delete_book(self.current_book_id)
+            self.changes.check_now()
             SilentDialog.showinfo("Success", "Book deleted", self.root)
             self.clear_form()
-            self.refresh_library_list()
         except Exception as e:
             SilentDialog.showerror("Error", f"Failed to delete book: {e}", self.root)
     
@@ -760,8 +986,7 @@ class LibraryApp:
                 database.loan_book(self.current_book_id, borrower)
                 SilentDialog.showinfo("Success", f"Book loaned to {borrower}", self.root)
                 dialog.destroy()
-                self.refresh_loans_list()
-                self.refresh_overdue_list()
+                self.changes.check_now()
             except Exception as e:
                 SilentDialog.showerror("Error", f"Failed to record loan: {e}", dialog)
         
@@ -773,31 +998,40 @@ class LibraryApp:
         # Cancel any existing timer
         if self.selection_timer:
             self.root.after_cancel(self.selection_timer)
+            self.selection_timer = None
+        
+        # Prefetched books are already in memory, so there's nothing to wait for
+        book = self.book_list.selected_row()
+        if book and book['id'] in self.prefetcher:
+            self.on_book_selected(event)
+            return
         
         # Set new timer for 300ms delay
         self.selection_timer = self.root.after(300, self.on_book_selected, event)
     
     def on_book_selected(self, event):
         """Handle book selection from list"""
-        selection = self.book_list.curselection()
-        if not selection:
-            return
-        
-        index = selection[0]
-        book_info = self.book_list.get(index)
-        
-        try:
-            book_id = int(book_info.split(':')[0])
-            self.load_book(book_id)
-        except:
-            pass
+        self.selection_timer = None
+        book = self.book_list.selected_row()
+        if book:
+            self.load_book(book['id'])
+            # Get the neighbours ready for the next arrow key press
+            nearby = self.book_list.rows_near_selection(self.prefetcher.depth)
+            self.prefetcher.prefetch(row['id'] for row in nearby)
     
     def load_book(self, book_id):
         """Load a book's details into the form"""
-        book = database.get_book(book_id)
+        prefetched = self.prefetcher.take(book_id)
+        if prefetched:
+            book, thumbnail = prefetched
+            if thumbnail is not None and Path(book['cover_path']).exists():
+                self.cover_photos.put(book['cover_path'], thumbnail)
+        else:
+            book = database.get_book(book_id)
         if not book:
             return
         
+        self.form_generation += 1
         self.current_book_id = book_id
         
         # Fill in fields
@@ -846,59 +1080,94 @@ class LibraryApp:
             self.cover_label.config(image='', text='No cover image')
             self.cover_image = None
     
+    def on_search_typed(self, event):
+        """Debounced search: only run the query once typing pauses"""
+        if self.search_timer:
+            self.root.after_cancel(self.search_timer)
+        self.search_timer = self.root.after(SEARCH_DEBOUNCE_MS, self.refresh_library_list)
+    
     def refresh_library_list(self):
-        """Refresh the library book list"""
-        self.book_list.delete(0, 'end')
+        """
+        Refresh the library book list (stays at the same place unless the search changed)
         
+        The query runs on a worker thread. If another refresh starts before it
+        finishes, this one's result is thrown away.
+        """
+        self.search_timer = None
         query = self.search_entry.get().strip()
         
-        if query:
-            books = database.search_books(query)
-        else:
-            books = database.get_all_books()
+        same_query = query == self.library_query
+        self.library_query = query
+        source = BookListSource(query)
+        top = self.book_list.top if same_query else 0
         
-        for book in books:
-            display = f"{book['id']}: {book['title']}"
-            if book['author']:
-                display += f" by {book['author']}"
-            self.book_list.insert('end', display)
+        self.tasks.submit(load_window, source, top, self.book_list.visible,
+                          on_done=lambda window: self.book_list.set_source(
+                              source, keep_position=same_query, window=window),
+                          key='library-list')
+    
+    @staticmethod
+    def format_book_row(book):
+        """Text for a book in the library list"""
+        display = f"{book['id']}: {book['title']}"
+        if book['author']:
+            display += f" by {book['author']}"
+        if book['borrower_name']:
+            display += f"  [{LibraryApp.loan_status(book['borrower_name'], book['date_due'])}]"
+        return display
+    
+    @staticmethod
+    def loan_status(borrower_name, date_due):
+        """Availability text for a book, from its current loan's borrower and due date"""
+        if not borrower_name:
+            return "Available"
+        return f"On loan to {borrower_name} (due {date_due[:10]})"
     
     def refresh_loans_list(self):
         """Refresh the current loans list"""
-        for item in self.loans_tree.get_children():
-            self.loans_tree.delete(item)
-        
         loans = database.get_all_loans()
         
-        for loan in loans:
-            loaned = loan['date_loaned'][:10]
-            due = loan['date_due'][:10]
-            
-            self.loans_tree.insert('', 'end', text=str(loan['id']),
-                                   values=(loan['title'], loan['author'], 
-                                          loan['borrower_name'], loaned, due))
+        self.loans_renderer.cancel()
+        self.loans_tree.delete(*self.loans_tree.get_children())
+        self.loans_renderer.start(loans, self.insert_loan_row)
+    
+    def insert_loan_row(self, loan):
+        """Add a loan from get_all_loans to the loans list"""
+        loaned = loan['date_loaned'][:10]
+        due = loan['date_due'][:10]
+        
+        self.loans_tree.insert('', 'end', text=str(loan['id']),
+                               values=(loan['title'], loan['author'], 
+                                      loan['borrower_name'], loaned, due,
+                                      self.due_status_text(loan)))
+    
+    @staticmethod
+    def due_status_text(loan):
+        """Status column text for a loan from get_all_loans"""
+        days = loan['days_left']
+        if loan['due_status'] == 'overdue':
+            return f"Overdue by {-days} day{'s' if days != -1 else ''}" if days else "Overdue"
+        if loan['due_status'] == 'due soon':
+            return f"Due in {days} day{'s' if days != 1 else ''}" if days else "Due today"
+        return ""
     
     def refresh_overdue_list(self):
         """Refresh the overdue loans list"""
-        for item in self.overdue_tree.get_children():
-            self.overdue_tree.delete(item)
-        
         loans = database.get_overdue_loans()
         
-        from datetime import datetime
-        now = datetime.now()
-        
-        for loan in loans:
-            loaned = loan['date_loaned'][:10]
-            due = loan['date_due'][:10]
-            
-            due_date = datetime.fromisoformat(loan['date_due'])
-            days_overdue = (now - due_date).days
-            
-            self.overdue_tree.insert('', 'end', text=str(loan['id']),
-                                     values=(loan['title'], loan['author'],
-                                            loan['borrower_name'], loaned, due,
-                                            str(days_overdue)))
+        self.overdue_renderer.cancel()
+        self.overdue_tree.delete(*self.overdue_tree.get_children())
+        self.overdue_renderer.start(loans, self.insert_overdue_row)
+    
+    def insert_overdue_row(self, loan):
+        """Add a loan from get_overdue_loans to the overdue list"""
+        loaned = loan['date_loaned'][:10]
+        due = loan['date_due'][:10]
+        
+        self.overdue_tree.insert('', 'end', text=str(loan['id']),
+                                 values=(loan['title'], loan['author'],
+                                        loan['borrower_name'], loaned, due,
+                                        str(loan['days_overdue'])))
     
     def return_selected_loan(self):
         """Mark selected loan as returned"""
@@ -912,8 +1181,7 @@ class LibraryApp:
         try:
             database.return_book(loan_id)
             SilentDialog.showinfo("Success", "Book marked as returned", self.root)
-            self.refresh_loans_list()
-            self.refresh_overdue_list()
+            self.changes.check_now()
         except Exception as e:
             SilentDialog.showerror("Error", f"Failed to return book: {e}", self.root)
     
@@ -929,11 +1197,95 @@ class LibraryApp:
         try:
             database.return_book(loan_id)
             SilentDialog.showinfo("Success", "Book marked as returned", self.root)
-            self.refresh_loans_list()
-            self.refresh_overdue_list()
+            self.changes.check_now()
         except Exception as e:
             SilentDialog.showerror("Error", f"Failed to return book: {e}", self.root)
     
+    def scan_intake_isbn(self, event=None):
+        """Stage the scanned ISBN; the lookup runs in the background"""
+        text = self.intake_entry.get().strip()
+        self.intake_entry.delete(0, 'end')
+        if not text:
+            return
+        
+        outcome = self.intake.scan(text)
+        messages = {
+            'queued': f"Queued {text}",
+            'duplicate': f"{text} is already in the library",
+            'already scanned': f"{text} was already scanned",
+            'invalid': f"'{text}' isn't an ISBN",
+        }
+        self.intake_message.config(text=messages[outcome],
+                                   foreground='' if outcome == 'queued' else 'red')
+    
+    def refresh_intake_list(self):
+        """Refresh the intake list and its counts"""
+        entries = database.get_intake()
+        selection = set(self.intake_tree.selection())
+        self.intake_tree.delete(*self.intake_tree.get_children())
+        for entry in entries:
+            status = entry['status'].replace('_', ' ')
+            if entry['status'] == 'pending':
+                status = "looking up..."
+            self.intake_tree.insert('', 'end', iid=str(entry['id']), tags=(entry['status'],),
+                                    values=(entry['isbn'], status, entry['title'] or '',
+                                            entry['author'] or '', entry['year'] or ''))
+        self.intake_tree.selection_set([iid for iid in selection
+                                        if self.intake_tree.exists(iid)])
+        
+        found = sum(1 for entry in entries if entry['status'] == 'found')
+        text = f"{found} ready to approve, {self.intake.queued} looking up"
+        if self.intake.last_error is not None:
+            text += f" (lookup failed: {self.intake.last_error})"
+        self.intake_status.config(text=text)
+    
+    def approve_intake(self, intake_ids):
+        """Add staged books to the library and report how it went"""
+        try:
+            outcomes = self.intake.approve(intake_ids)
+        except Exception as e:
+            SilentDialog.showerror("Error", f"Failed to add books: {e}", self.root)
+            return
+        if not outcomes:
+            SilentDialog.showwarning("Nothing to Approve",
+                                     "Only books whose lookup found a title can be approved",
+                                     self.root)
+            return
+        added = sum(1 for outcome in outcomes if outcome['status'] == 'inserted')
+        skipped = sum(1 for outcome in outcomes if outcome['status'] == 'skipped')
+        message = f"Added {added} book{'s' if added != 1 else ''} to the library"
+        if skipped:
+            message += f" ({skipped} already there)"
+        self.intake_message.config(text=message, foreground='')
+        self.changes.check_now()
+    
+    def approve_all_intake(self):
+        """Add every book whose lookup found it"""
+        self.approve_intake(entry['id'] for entry in database.get_intake()
+                            if entry['status'] == 'found')
+    
+    def approve_selected_intake(self):
+        """Add the selected staged books"""
+        selection = self.intake_tree.selection()
+        if not selection:
+            SilentDialog.showwarning("No Selection", "Please select books to approve", self.root)
+            return
+        self.approve_intake(int(iid) for iid in selection)
+    
+    def discard_selected_intake(self):
+        """Drop the selected staged ISBNs"""
+        selection = self.intake_tree.selection()
+        if not selection:
+            SilentDialog.showwarning("No Selection", "Please select books to discard", self.root)
+            return
+        self.intake.discard(int(iid) for iid in selection)
+    
+    def retry_intake(self):
+        """Look up the ISBNs whose lookup failed again"""
+        count = self.intake.retry()
+        self.intake_message.config(text=f"Retrying {count} lookup{'s' if count != 1 else ''}",
+                                   foreground='')
+    
     def do_advanced_search(self):
         """Perform advanced search with multiple criteria"""
         isbn = self.search_isbn_entry.get().strip()
@@ -947,14 +1299,12 @@ class LibraryApp:
             SilentDialog.showinfo("No Criteria", "Please enter at least one search criterion", self.root)
             return
         
-        results = database.advanced_search(isbn=isbn or None, 
-                                          title=title or None,
-                                          series=series or None, 
-                                          author=author or None,
-                                          artist=artist or None,
-                                          publisher=publisher or None)
-        
-        self.display_search_results(results)
+        self.run_search({'isbn': isbn or None,
+                         'title': title or None,
+                         'series': series or None,
+                         'author': author or None,
+                         'artist': artist or None,
+                         'publisher': publisher or None})
     
     def clear_search_criteria(self):
         """Clear all search criteria fields"""
@@ -965,37 +1315,44 @@ class LibraryApp:
         self.search_artist_entry.delete(0, 'end')
         self.search_publisher_entry.delete(0, 'end')
         
-        for item in self.search_results_tree.get_children():
-            self.search_results_tree.delete(item)
+        self.search_criteria = None
+        self.search_results.clear()
         
         self.search_results_label.config(text="Enter search criteria and click Search")
     
     def show_all_in_search(self):
         """Show all books in search results"""
-        results = database.get_all_books()
-        self.display_search_results(results)
-    
-    def display_search_results(self, results):
-        """Display search results in the treeview"""
-        for item in self.search_results_tree.get_children():
-            self.search_results_tree.delete(item)
-        
-        for book in results:
-            series_info = ''
-            if book['series_name']:
-                series_info = book['series_name']
-                if book['series_number']:
-                    series_info += f" #{book['series_number']}"
-            
-            self.search_results_tree.insert('', 'end', text=str(book['id']),
-                                           values=(book['title'] or '',
-                                                  book['author'] or '',
-                                                  book.get('artist', '') or '',
-                                                  series_info,
-                                                  book['publisher'] or '',
-                                                  book['year'] or ''))
-        
-        count = len(results)
+        self.run_search({})
+    
+    def run_search(self, criteria, keep_position=False):
+        """Find the matching books in the background, then show them"""
+        self.search_criteria = criteria
+        if not keep_position:
+            self.search_results_label.config(text="Searching...")
+        self.tasks.submit(find_search_results, criteria, key='search-results',
+                          on_done=lambda ids: self.display_search_results(ids, keep_position))
+    
+    def search_result_item(self, book):
+        """Treeview (text, values) for a BookSummary in the search results"""
+        series_info = ''
+        if book.series_name:
+            series_info = book.series_name
+            if book.series_number:
+                series_info += f" #{book.series_number}"
+        
+        return str(book.id), (book.title or '',
+                              book.author or '',
+                              book.artist or '',
+                              series_info,
+                              book.publisher or '',
+                              book.year or '',
+                              self.loan_status(book.borrower_name, book.date_due))
+    
+    def display_search_results(self, ids, keep_position=False):
+        """Show the IDs from find_search_results in the treeview"""
+        self.search_results.set_ids(ids, keep_position)
+        count = len(ids)
+        
         if count == 0:
             self.search_results_label.config(text="No books found matching criteria")
         elif count == 1:
@@ -1005,30 +1362,162 @@ class LibraryApp:
     
     def load_book_from_search(self, event):
         """Load book when double-clicked in search results"""
-        selection = self.search_results_tree.selection()
-        if not selection:
+        book_id = self.search_results.selected_id()
+        if book_id is None:
             return
         
-        book_id = int(self.search_results_tree.item(selection[0])['text'])
         self.load_book(book_id)
         self.notebook.select(0)
     
     def view_book_from_search(self):
         """Load selected book from search results via button"""
-        selection = self.search_results_tree.selection()
-        if not selection:
+        book_id = self.search_results.selected_id()
+        if book_id is None:
             SilentDialog.showwarning("No Selection", "Please select a book to view", self.root)
             return
         
-        book_id = int(self.search_results_tree.item(selection[0])['text'])
         self.load_book(book_id)
         self.notebook.select(0)
+    
+    def on_database_changed(self, tables):
+        """Refresh the tabs showing data from tables that changed"""
+        if 'books' in tables:
+            self.intake.reload_isbns()
+            self.prefetcher.invalidate()
+            self.refresh_library_list()
+            if self.search_criteria is not None:
+                self.run_search(self.search_criteria, keep_position=True)
+        elif 'loans' in tables:
+            # Only loan status moved: re-read the rows in view, the results stand
+            self.refresh_library_list()
+            if self.search_criteria is not None:
+                self.search_results.refresh()
+        # Loans show book titles
+        self.refresh_loans_list()
+        self.refresh_overdue_list()
+    
+    def show_diagnostics(self, event=None):
+        """Open the query diagnostics window (Ctrl+Shift+D)"""
+        if self.diagnostics_window is not None:
+            self.diagnostics_window.lift()
+            return
+        
+        window = tk.Toplevel(self.root)
+        window.title("Query Diagnostics")
+        window.geometry("900x650")
+        window.protocol("WM_DELETE_WINDOW", self.close_diagnostics)
+        self.diagnostics_window = window
+        
+        top = ttk.Frame(window)
+        top.pack(fill='x', padx=10, pady=(10, 0))
+        self.diagnostics_recording = tk.BooleanVar(value=query_stats.is_enabled())
+        ttk.Checkbutton(top, text="Record query timings", variable=self.diagnostics_recording,
+                        command=self.toggle_query_stats).pack(side='left')
+        ttk.Button(top, text="Export JSON...", command=self.export_query_stats).pack(side='right', padx=5)
+        ttk.Button(top, text="Reset", command=self.reset_query_stats).pack(side='right', padx=5)
+        self.diagnostics_summary = ttk.Label(top, text="")
+        self.diagnostics_summary.pack(side='left', padx=20)
+        
+        panes = ttk.PanedWindow(window, orient='vertical')
+        panes.pack(fill='both', expand=True, padx=10, pady=10)
+        
+        timing_columns = ('Calls', 'p50 ms', 'p95 ms', 'p99 ms', 'Max ms', 'Total ms')
+        trees = []
+        for heading, name_width in (("Function", 200), ("Statement", 420)):
+            tree = ttk.Treeview(panes, columns=timing_columns, show='tree headings', height=8)
+            tree.heading('#0', text=heading)
+            tree.column('#0', width=name_width)
+            for col in timing_columns:
+                tree.heading(col, text=col)
+                tree.column(col, width=70, anchor='e')
+            panes.add(tree, weight=1)
+            trees.append(tree)
+        self.diagnostics_functions, self.diagnostics_statements = trees
+        
+        slow_frame = ttk.Frame(panes)
+        ttk.Label(slow_frame, text="Slow queries (newest first)").pack(anchor='w')
+        self.diagnostics_slow = scrolledtext.ScrolledText(slow_frame, height=10, wrap='word')
+        self.diagnostics_slow.pack(fill='both', expand=True)
+        panes.add(slow_frame, weight=1)
+        
+        self.refresh_diagnostics()
+    
+    def refresh_diagnostics(self):
+        """Fill the diagnostics window from query_stats, then again every 2 seconds"""
+        if self.diagnostics_window is None:
+            return
+        stats = query_stats.snapshot()
+        state = "recording" if stats['enabled'] else "not recording"
+        self.diagnostics_summary.config(
+            text=f"{state}; slow-query threshold {stats['slow_query_ms']:g} ms")
+        
+        for tree, rows in ((self.diagnostics_functions, stats['functions']),
+                           (self.diagnostics_statements, stats['statements'])):
+            tree.delete(*tree.get_children())
+            for name, timing in rows.items():
+                tree.insert('', 'end', text=name,
+                            values=(timing['calls'], timing['p50_ms'], timing['p95_ms'],
+                                    timing['p99_ms'], timing['max_ms'], timing['total_ms']))
+        
+        self.diagnostics_slow.delete('1.0', tk.END)
+        for entry in reversed(stats['slow_queries']):
+            plan = '\n    '.join(entry['plan']) or "(no plan)"
+            self.diagnostics_slow.insert(
+                tk.END, f"{entry['time']}  {entry['ms']} ms in {entry['function']}  "
+                        f"{entry['params']}\n  {entry['sql']}\n    {plan}\n\n")
+        
+        self.diagnostics_timer = self.root.after(2000, self.refresh_diagnostics)
+    
+    def toggle_query_stats(self):
+        """Turn query timing on or off from the diagnostics window"""
+        if self.diagnostics_recording.get():
+            query_stats.enable()
+        else:
+            query_stats.disable()
+        self.root.after_cancel(self.diagnostics_timer)
+        self.refresh_diagnostics()
+    
+    def reset_query_stats(self):
+        """Forget the recorded timings"""
+        query_stats.reset()
+        self.root.after_cancel(self.diagnostics_timer)
+        self.refresh_diagnostics()
+    
+    def export_query_stats(self):
+        """Save the recorded timings as JSON"""
+        path = filedialog.asksaveasfilename(parent=self.diagnostics_window,
+                                            defaultextension='.json',
+                                            filetypes=[("JSON", "*.json")],
+                                            initialfile="query_stats.json")
+        if path:
+            query_stats.export_json(path)
+    
+    def close_diagnostics(self):
+        """Close the diagnostics window (recording carries on if switched on)"""
+        if self.diagnostics_timer is not None:
+            self.root.after_cancel(self.diagnostics_timer)
+            self.diagnostics_timer = None
+        self.diagnostics_window.destroy()
+        self.diagnostics_window = None
+    
+    def on_close(self):
+        """Stop background work and close the window"""
+        self.changes.stop()
+        self.intake.stop()
+        self.loans_renderer.cancel()
+        self.overdue_renderer.cancel()
+        self.tasks.shutdown()
+        self.root.destroy()
 
 
 def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s: %(message)s")
+    if os.environ.get('LIBRARY_PROFILE'):
+        query_stats.enable()
     root = tk.Tk()
     app = LibraryApp(root)
     root.mainloop()
+    connection_manager.close_all()
 
 
 if __name__ == "__main__":
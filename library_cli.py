@@ -0,0 +1,254 @@
+"""
+Command-line access to Callum's Library App, without the window
+
+For scripts and scheduled jobs (a nightly overdue report, a backup export)
+on machines with no display. Only database.py is needed for most commands;
+Open Library support (requests and Pillow) is only imported by enrich, and
+tkinter never is, so commands start quickly:
+
+    python library_cli.py search harry                  # quick search, like the library list
+    python library_cli.py search --author tolkien --format csv
+    python library_cli.py overdue                       # overdue loans
+    python library_cli.py overdue --all                 # every book on loan
+    python library_cli.py export --format csv > books.csv
+    python library_cli.py import books.csv --on-conflict update
+    python library_cli.py enrich --no-covers            # fill in missing details
+
+Results are written as they are read, one JSON object per line (the
+default) or as CSV, so large libraries never have to fit in memory.
+--db chooses another library file. Measure startup with
+python -X importtime library_cli.py overdue.
+"""
+
+import argparse
+import sqlite3
+import sys
+
+PAGE_SIZE = 500     # books fetched per query while streaming results
+
+# Columns written by export (and read back by import)
+EXPORT_FIELDS = ('id', 'isbn', 'title', 'year', 'author', 'artist', 'publisher', 'page_count',
+                 'description', 'series_name', 'series_number', 'format', 'cover_path', 'notes',
+                 'date_added')
+LOAN_FIELDS = ('id', 'book_id', 'title', 'author', 'borrower_name', 'date_loaned', 'date_due')
+INTEGER_FIELDS = ('page_count', 'series_number')
+SEARCH_FIELDS = ('isbn', 'title', 'series', 'author', 'artist', 'publisher')
+
+
+def open_database(path=None):
+    """Import database.py, point it at path (if given) and bring its schema up to date"""
+    from pathlib import Path
+    import database
+    if path is not None:
+        database.DB_PATH = Path(path)
+    database.init_database()
+    return database
+
+
+def write_rows(rows, fields, output_format, out):
+    """Write dict rows as JSON lines or CSV as they arrive; returns how many were written"""
+    count = 0
+    if output_format == 'csv':
+        import csv
+        writer = csv.DictWriter(out, fieldnames=fields, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        import json
+        for row in rows:
+            out.write(json.dumps({field: row.get(field) for field in fields}) + '\n')
+            count += 1
+    out.flush()
+    return count
+
+
+def read_records(source, input_format):
+    """
+    Yield add_books_bulk records from JSON lines or CSV, as they are read
+
+    Columns that aren't book fields (such as export's id) are ignored,
+    empty values become None and page/series numbers become integers.
+    """
+    import database
+    if input_format == 'csv':
+        import csv
+        rows = csv.DictReader(source)
+    else:
+        import json
+        rows = (json.loads(line) for line in source if line.strip())
+
+    for row in rows:
+        record = {}
+        for field in database.BOOK_FIELDS:
+            value = row.get(field)
+            if isinstance(value, str):
+                value = value.strip() or None
+            if value is not None and field in INTEGER_FIELDS:
+                try:
+                    value = int(value)
+                except ValueError:
+                    pass    # left for the database to store as given
+            if value is not None:
+                record[field] = value
+        yield record
+
+
+def _summary_dicts(database, books):
+    return ({column: getattr(book, column) for column in database.SUMMARY_COLUMNS}
+            for book in books)
+
+
+def search_results(database, query=None, **criteria):
+    """
+    Yield matching books as summary dicts, alphabetically, a page at a time
+
+    A query is matched like the library list's search box; criteria (the
+    advanced search fields) like the search tab.
+    """
+    if any(criteria.values()):
+        ids = database.advanced_search_ids(**criteria)
+        for start in range(0, len(ids), PAGE_SIZE):
+            yield from _summary_dicts(database,
+                                      database.get_book_summaries(ids[start:start + PAGE_SIZE]))
+        return
+
+    after = None
+    while True:
+        page = database.get_books_page(after, PAGE_SIZE, query)
+        if not page:
+            return
+        yield from _summary_dicts(database,
+                                  database.get_book_summaries(book['id'] for book in page))
+        after = database.book_sort_key(page[-1])
+
+
+def all_books(database):
+    """Yield every book in full, alphabetically, a page at a time"""
+    ids = database.advanced_search_ids()
+    for start in range(0, len(ids), PAGE_SIZE):
+        chunk = ids[start:start + PAGE_SIZE]
+        books = database.get_books(chunk)
+        yield from (books[book_id] for book_id in chunk if book_id in books)
+
+
+def cmd_search(args, out):
+    database = open_database(args.db)
+    criteria = {field: getattr(args, field) for field in SEARCH_FIELDS}
+    rows = search_results(database, ' '.join(args.query), **criteria)
+    write_rows(rows, database.SUMMARY_COLUMNS, args.format, out)
+
+
+def cmd_overdue(args, out):
+    database = open_database(args.db)
+    if args.all:
+        rows = database.get_all_loans()
+        fields = LOAN_FIELDS + ('due_status', 'days_left')
+    else:
+        rows = database.get_overdue_loans()
+        fields = LOAN_FIELDS + ('days_overdue',)
+    write_rows(rows, fields, args.format, out)
+
+
+def cmd_export(args, out):
+    database = open_database(args.db)
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8') as f:
+            count = write_rows(all_books(database), EXPORT_FIELDS, args.format, f)
+        print(f"Exported {count} books to {args.output}", file=sys.stderr)
+    else:
+        write_rows(all_books(database), EXPORT_FIELDS, args.format, out)
+
+
+def cmd_import(args, out):
+    database = open_database(args.db)
+    input_format = args.format or ('csv' if args.file.lower().endswith('.csv') else 'jsonl')
+    with open(args.file, newline='', encoding='utf-8') as f:
+        outcomes = database.add_books_bulk(read_records(f, input_format),
+                                           on_conflict=args.on_conflict)
+
+    counts = {}
+    for outcome in outcomes:
+        counts[outcome['status']] = counts.get(outcome['status'], 0) + 1
+    # Rows that couldn't be added go to stdout, numbered from 1 like the file's records
+    errors = ({'record': outcome['index'] + 1, 'error': outcome['error']}
+              for outcome in outcomes if outcome['status'] == 'error')
+    write_rows(errors, ('record', 'error'), args.output_format, out)
+    print(', '.join(f"{count} {status}" for status, count in counts.items()) or "Nothing to import",
+          file=sys.stderr)
+
+
+def cmd_enrich(args, out):
+    open_database(args.db)
+    import enrichment     # imports requests and Pillow
+
+    options = {name: getattr(args, name) for name in ('workers', 'rate')
+               if getattr(args, name) is not None}
+    stats = enrichment.enrich_library(covers=not args.no_covers, retry=args.retry,
+                                      limit=args.limit,
+                                      progress=enrichment.progress_printer(sys.stderr),
+                                      **options)
+    fields = ('checked', 'enriched', 'not_found', 'failed', 'covers', 'seconds', 'stopped')
+    write_rows([vars(stats)], fields, args.format, out)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Callum's Library from the command line")
+    parser.add_argument('--db', help="library database file (default: library.db next to the app)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_command(name, func, help_text, formats=True):
+        command = commands.add_parser(name, help=help_text, description=help_text)
+        command.set_defaults(func=func)
+        if formats:
+            command.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl',
+                                 help="output format (default %(default)s)")
+        return command
+
+    search = add_command('search', cmd_search, "find books (every book if no search is given)")
+    search.add_argument('query', nargs='*', help="words to look for, as in the library list")
+    for field in SEARCH_FIELDS:
+        search.add_argument(f'--{field}', help=f"{field} contains this (advanced search)")
+
+    overdue = add_command('overdue', cmd_overdue, "list overdue loans")
+    overdue.add_argument('--all', action='store_true', help="every active loan, not just overdue")
+
+    export = add_command('export', cmd_export, "write every book out, for backups or a spreadsheet")
+    export.add_argument('--output', '-o', help="file to write (default: standard output)")
+
+    import_ = add_command('import', cmd_import, "add books from a CSV or JSON lines file",
+                          formats=False)
+    import_.add_argument('file', help="file written by export, or any with the same columns")
+    import_.add_argument('--format', choices=('jsonl', 'csv'),
+                         help="input format (default: from the file extension)")
+    import_.add_argument('--on-conflict', choices=('skip', 'update', 'error'), default='skip',
+                         help="when an ISBN is already in the library (default %(default)s)")
+    import_.add_argument('--output-format', choices=('jsonl', 'csv'), default='jsonl',
+                         help="format of the rows that failed (default %(default)s)")
+
+    # Defaults are left to enrichment.py, which isn't imported until the command runs
+    enrich = add_command('enrich', cmd_enrich, "fill in missing book details from Open Library")
+    enrich.add_argument('--workers', type=int, help="lookups running at once")
+    enrich.add_argument('--rate', type=float, help="requests per second to Open Library")
+    enrich.add_argument('--limit', type=int, help="only check this many books")
+    enrich.add_argument('--no-covers', action='store_true', help="don't download covers")
+    enrich.add_argument('--retry', action='store_true',
+                        help="also retry books an earlier run already dealt with")
+    return parser
+
+
+def main(argv=None, out=None):
+    args = build_parser().parse_args(argv)
+    try:
+        args.func(args, out or sys.stdout)
+    except BrokenPipeError:
+        pass    # e.g. piped into head
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
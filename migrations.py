@@ -0,0 +1,367 @@
+"""
+Schema migrations for Callum's Library App
+
+Each migration is a numbered step. The database remembers the last step it
+ran in PRAGMA user_version, so only newer steps run when the app starts.
+Steps must be safe to re-run, because databases created before this module
+existed already have some of the schema.
+"""
+
+import logging
+import sqlite3
+import time
+
+from connection_manager import transaction
+
+log = logging.getLogger(__name__)
+
+MIGRATIONS = []  # (version, description, function) in version order
+
+
+def migration(version, description):
+    """Register a migration step"""
+    def register(func):
+        if MIGRATIONS and version <= MIGRATIONS[-1][0]:
+            raise ValueError(f"Migration {version} registered out of order")
+        MIGRATIONS.append((version, description, func))
+        return func
+    return register
+
+
+def schema_version(conn):
+    """Get the migration version the database is at"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def latest_version():
+    """Get the version a fully migrated database will be at"""
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def migrate(conn):
+    """
+    Bring the database up to the latest schema version
+
+    Each step runs in its own transaction together with the user_version
+    bump, so an interrupted upgrade resumes from the last completed step.
+    Returns a list of (version, description, seconds) for the steps applied.
+    """
+    applied = []
+    for version, description, func in MIGRATIONS:
+        if version <= schema_version(conn):
+            continue
+
+        start = time.perf_counter()
+        with transaction(conn):
+            # Another copy of the app may have applied it while we waited for the lock
+            if version <= schema_version(conn):
+                continue
+            func(conn)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+        elapsed = time.perf_counter() - start
+
+        log.info("Applied migration %d (%s) in %.1f ms", version, description, elapsed * 1000)
+        applied.append((version, description, elapsed))
+
+    return applied
+
+
+def _columns(conn, table):
+    """Get the column names of a table"""
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def fts5_available():
+    """Check whether this SQLite build was compiled with FTS5"""
+    try:
+        probe = sqlite3.connect(":memory:")
+        probe.execute("CREATE VIRTUAL TABLE fts_probe USING fts5(x)")
+        probe.close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+# Columns indexed for full-text search, with their bm25 weights (higher = more relevant)
+FTS_COLUMNS = {
+    'title': 10.0,
+    'author': 5.0,
+    'artist': 5.0,
+    'series_name': 3.0,
+    'publisher': 1.0,
+    'isbn': 1.0,
+}
+
+
+def fts_insert_trigger_sql():
+    """
+    SQL for the trigger that indexes new books
+
+    Kept separate because add_books_bulk drops it for the length of a bulk
+    load and indexes the new rows in one statement instead.
+    """
+    columns = ', '.join(FTS_COLUMNS)
+    new_columns = ', '.join(f"new.{col}" for col in FTS_COLUMNS)
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts (rowid, {columns}) VALUES (new.id, {new_columns});
+        END
+    """
+
+
+@migration(1, "books and loans tables")
+def _create_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            isbn TEXT UNIQUE,
+            title TEXT NOT NULL,
+            year TEXT,
+            author TEXT,
+            artist TEXT,
+            publisher TEXT,
+            page_count INTEGER,
+            description TEXT,
+            series_name TEXT,
+            series_number INTEGER,
+            format TEXT DEFAULT 'Book',
+            cover_path TEXT,
+            notes TEXT,
+            date_added TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Databases from before the artist field was added
+    if 'artist' not in _columns(conn, 'books'):
+        conn.execute("ALTER TABLE books ADD COLUMN artist TEXT")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS loans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL,
+            borrower_name TEXT NOT NULL,
+            date_loaned TEXT NOT NULL,
+            date_due TEXT NOT NULL,
+            date_returned TEXT,
+            FOREIGN KEY (book_id) REFERENCES books (id) ON DELETE CASCADE
+        )
+    """)
+
+
+@migration(2, "secondary indexes for loans and title sorting")
+def _create_indexes(conn):
+    # Current loan for a book: equality on book_id, IS NULL on date_returned,
+    # newest first by date_loaned - all answered from the index
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_loans_book_returned
+        ON loans (book_id, date_returned, date_loaned)
+    """)
+    # Active loans in due-date order (loans and overdue tabs); returned
+    # loans are left out so the index stays small as history grows
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_loans_open_due
+        ON loans (date_due) WHERE date_returned IS NULL
+    """)
+    # Alphabetical book lists
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_books_title
+        ON books (title COLLATE NOCASE)
+    """)
+
+
+@migration(3, "full-text search index")
+def _create_fts_index(conn):
+    if not fts5_available():
+        log.warning("SQLite was built without FTS5; searches will use LIKE matching")
+        return
+
+    columns = ', '.join(FTS_COLUMNS)
+    new_columns = ', '.join(f"new.{col}" for col in FTS_COLUMNS)
+    old_columns = ', '.join(f"old.{col}" for col in FTS_COLUMNS)
+
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+    ).fetchone()
+
+    # External-content table: the text lives in books, the index only stores tokens
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+            {columns},
+            content='books', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    """)
+
+    conn.execute(fts_insert_trigger_sql())
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, {columns}) VALUES ('delete', old.id, {old_columns});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF {columns} ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, {columns}) VALUES ('delete', old.id, {old_columns});
+            INSERT INTO books_fts (rowid, {columns}) VALUES (new.id, {new_columns});
+        END
+    """)
+
+    # Index any books that were added before the index existed
+    if not exists:
+        conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+
+
+@migration(4, "enrichment log")
+def _create_enrichment_log(conn):
+    # Books the enrichment job has already dealt with, so an interrupted
+    # run picks up where it left off instead of asking about them again
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS enrichment_log (
+            book_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            attempted_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (book_id) REFERENCES books (id) ON DELETE CASCADE
+        )
+    """)
+
+
+def _current_loan_sql(book_id):
+    """Subquery for a book's current loan, the same rule as database.get_current_loan"""
+    return f"""(SELECT id FROM loans WHERE book_id = {book_id} AND date_returned IS NULL
+                ORDER BY date_loaned DESC LIMIT 1)"""
+
+
+@migration(5, "current loan on each book")
+def _add_current_loan(conn):
+    # Lets book lists show who has a book with a rowid lookup per row,
+    # instead of one get_current_loan query per book
+    if 'current_loan_id' not in _columns(conn, 'books'):
+        conn.execute("ALTER TABLE books ADD COLUMN current_loan_id INTEGER")
+
+    for name, event, book_id in (("loans_current_insert", "INSERT", "new.book_id"),
+                                 ("loans_current_return", "UPDATE OF date_returned", "new.book_id"),
+                                 ("loans_current_delete", "DELETE", "old.book_id")):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON loans BEGIN
+                UPDATE books SET current_loan_id = {_current_loan_sql(book_id)}
+                WHERE id = {book_id};
+            END
+        """)
+
+    conn.execute(f"UPDATE books SET current_loan_id = {_current_loan_sql('books.id')}")
+
+
+@migration(6, "epoch timestamps on loans")
+def _add_loan_epochs(conn):
+    # Whole seconds since 1970 (UTC) alongside the readable ISO columns, so
+    # due-date checks are integer comparisons SQLite can answer from an index.
+    # The ISO columns hold local time, hence the 'utc' modifier.
+    existing = _columns(conn, 'loans')
+    for column in ('loaned_at', 'due_at', 'returned_at'):
+        if column not in existing:
+            conn.execute(f"ALTER TABLE loans ADD COLUMN {column} INTEGER")
+    conn.execute(f"UPDATE loans SET {_epochs_sql()}")
+
+    # Replaces idx_loans_open_due: same job, on the integer columns
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_loans_open_due_at
+        ON loans (due_at) WHERE returned_at IS NULL
+    """)
+    conn.execute("DROP INDEX IF EXISTS idx_loans_open_due")
+
+
+# Tables whose changes the app watches for (see database.table_generations)
+TRACKED_TABLES = ('books', 'loans')
+
+
+def change_trigger_sql(table, event, when=None):
+    """
+    SQL for the trigger that bumps a table's change counter on INSERT/UPDATE/DELETE
+
+    add_books_bulk drops the books INSERT one during a bulk load and bumps
+    the counter once at the end instead. when is an optional condition on
+    old/new for the trigger to fire.
+    """
+    condition = f" WHEN {when}" if when else ""
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_changed_{event.lower()} AFTER {event} ON {table}{condition} BEGIN
+            UPDATE change_counters SET generation = generation + 1 WHERE name = '{table}';
+        END
+    """
+
+
+@migration(7, "change counters")
+def _create_change_counters(conn):
+    # One counter per table, bumped by triggers on every write, so any
+    # connection - including other running copies of the app - can tell
+    # which tables changed by comparing two tiny rows
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS change_counters (
+            name TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    for table in TRACKED_TABLES:
+        conn.execute("INSERT OR IGNORE INTO change_counters (name) VALUES (?)", (table,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(change_trigger_sql(table, event))
+
+
+@migration(8, "intake staging table")
+def _create_intake(conn):
+    # ISBNs scanned in intake mode wait here, with what the lookup found,
+    # until they are approved into books or discarded. Kept in the database
+    # so a half-reviewed box survives closing the app.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS intake (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            isbn TEXT NOT NULL,             -- normalised
+            status TEXT NOT NULL DEFAULT 'pending',
+            title TEXT,
+            year TEXT,
+            author TEXT,
+            publisher TEXT,
+            page_count INTEGER,
+            description TEXT,
+            cover_path TEXT,
+            scanned_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+# Epoch column -> the ISO column it is worked out from
+LOAN_EPOCHS = (('loaned_at', 'date_loaned'), ('due_at', 'date_due'), ('returned_at', 'date_returned'))
+
+
+def _epochs_sql(prefix=''):
+    """SET clause working out each loan epoch column from its ISO column (local time)"""
+    return ', '.join(f"{epoch} = CAST(strftime('%s', {prefix}{iso}, 'utc') AS INTEGER)"
+                     for epoch, iso in LOAN_EPOCHS)
+
+
+@migration(9, "derive loan epochs from the ISO dates")
+def _derive_loan_epochs(conn):
+    # The ISO columns are the record: they are what get_current_loan and the
+    # current_loan_id triggers read, and all an older copy of the app, a
+    # script or raw SQL may write. Triggers work the epoch columns out from
+    # them after every insert and update, so the two never disagree.
+    # Recursive triggers are off, so the trigger's own UPDATE doesn't fire it.
+    for name, event in (("loans_epochs_insert", "INSERT"), ("loans_epochs_update", "UPDATE")):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON loans BEGIN
+                UPDATE loans SET {_epochs_sql('new.')} WHERE id = new.id;
+            END
+        """)
+
+    # Loans written since migration 6 without their epochs
+    conn.execute(f"UPDATE loans SET {_epochs_sql()}")
+
+
+@migration(10, "loan changes don't count as book changes")
+def _books_counter_ignores_loans(conn):
+    # Lending or returning a book sets books.current_loan_id from a loans
+    # trigger, which bumped the books counter as well as the loans one, so
+    # every checkout looked like a catalogue edit and made the app reload
+    # its book lists and search results. Those updates count as loan changes.
+    conn.execute("DROP TRIGGER IF EXISTS books_changed_update")
+    conn.execute(change_trigger_sql('books', 'UPDATE', when="old.current_loan_id IS new.current_loan_id"))
@@ -0,0 +1,105 @@
+"""
+A local stand-in for the Open Library API, for tests and benchmarks
+
+Serves the Books API (/api/books?bibkeys=...) and cover images from
+in-memory data, on a random free port, so nothing goes over the network:
+
+    with OpenLibraryStub(books) as stub:
+        isbn_lookup.OPEN_LIBRARY_URL = stub.url
+        ...
+
+books maps ISBN -> Books API entry (as Open Library would return it).
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class OpenLibraryStub:
+    """Books API and cover server running on a background thread"""
+
+    def __init__(self, books=None, covers=None, latency=0.0, fail_first=0):
+        self.books = dict(books or {})
+        self.covers = dict(covers or {})    # path such as '/b/id/1-L.jpg' -> image bytes
+        self.latency = latency              # seconds to wait before every response
+        self.fail_first = fail_first        # answer this many requests with 503 first
+        self.requests = []                  # paths requested, in order
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def cover_url(self, path):
+        """Full URL for a cover path registered in covers"""
+        return self.url + path
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive, so connection reuse is visible
+
+            def do_GET(self):
+                stub._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _handle(self, handler):
+        with self._lock:
+            self.requests.append(handler.path)
+            failing = self.fail_first > 0
+            if failing:
+                self.fail_first -= 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        parsed = urlparse(handler.path)
+        if failing:
+            self._send(handler, 503, b"Service Unavailable", "text/plain")
+        elif parsed.path == "/api/books":
+            keys = parse_qs(parsed.query).get('bibkeys', [''])[0].split(',')
+            data = {}
+            for key in keys:
+                isbn = key.split(':', 1)[-1]
+                if isbn in self.books:
+                    data[key] = self.books[isbn]
+            self._send(handler, 200, json.dumps(data).encode(), "application/json")
+        elif parsed.path in self.covers:
+            self._send(handler, 200, self.covers[parsed.path], "image/jpeg")
+        else:
+            self._send(handler, 404, b"Not Found", "text/plain")
+
+    @staticmethod
+    def _send(handler, status, body, content_type):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
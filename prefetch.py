@@ -0,0 +1,138 @@
+"""
+Prefetching of book records and cover thumbnails
+
+When a book is selected, the books just above and below it in the list are
+the likeliest to be looked at next. Prefetcher loads them (and their cover
+thumbnails) on a worker thread into a small cache, so selecting one of them
+fills the form straight from memory.
+"""
+
+import cover_cache
+import database
+
+PREFETCH_DEPTH = 5                      # books loaded on each side of the selection
+PREFETCH_BYTES = 8 * 1024 * 1024        # memory allowed for prefetched books and thumbnails
+
+
+def _estimate_size(book, thumbnail):
+    """Rough memory used by a prefetched book and its thumbnail"""
+    size = sum(len(str(value)) for value in book.values())
+    if thumbnail is not None:
+        size += thumbnail.width * thumbnail.height * len(thumbnail.getbands())
+    return size
+
+
+def load_books(book_ids):
+    """
+    Load books and their cover thumbnails (runs on a worker thread)
+
+    Returns a list of (book, thumbnail) in book_ids order; thumbnail is a
+    PIL Image, or None if the book has no readable cover.
+    """
+    books = database.get_books(book_ids)
+    loaded = []
+    for book_id in book_ids:
+        book = books.get(book_id)
+        if book is None:
+            continue
+        thumbnail = None
+        if book['cover_path']:
+            try:
+                thumbnail = cover_cache.load_thumbnail(book['cover_path'])
+            except Exception:
+                pass    # shown as "Cover unavailable" if the book is selected
+        loaded.append((book, thumbnail))
+    return loaded
+
+
+class Prefetcher:
+    """
+    Cache of books near the selection, filled in the background
+
+    Use from the Tk main thread only. Each prefetch() supersedes the last,
+    and once the cache passes max_bytes the books that have been furthest
+    from recent selections are dropped first.
+    """
+
+    def __init__(self, tasks, depth=PREFETCH_DEPTH, max_bytes=PREFETCH_BYTES):
+        self.tasks = tasks
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = {}          # book ID -> (book, thumbnail, size), first evicted first
+        self._generation = 0        # bumped by invalidate(), so stale loads are dropped
+        self.hits = 0               # take() answered from the cache
+        self.misses = 0             # take() had to go to the database
+        self.prefetched = 0         # books loaded ahead of time
+        self.wasted = 0             # prefetched books dropped without being used
+
+    def prefetch(self, book_ids):
+        """Load books that aren't cached yet in the background, nearest first"""
+        book_ids = list(book_ids)
+        # Already cached ones move to the back of the eviction queue, nearest last
+        for book_id in reversed(book_ids):
+            if book_id in self._entries:
+                self._entries[book_id] = self._entries.pop(book_id)
+        wanted = [book_id for book_id in book_ids if book_id not in self._entries]
+        if not wanted:
+            return
+        generation = self._generation
+        self.tasks.submit(load_books, wanted, key='prefetch',
+                          on_done=lambda loaded: self._store(generation, loaded))
+
+    def take(self, book_id):
+        """Get (book, thumbnail) for a book if it was prefetched, else None"""
+        entry = self._entries.pop(book_id, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        book, thumbnail, size = entry
+        self.bytes -= size
+        return book, thumbnail
+
+    def __contains__(self, book_id):
+        return book_id in self._entries
+
+    def invalidate(self, book_id=None):
+        """Forget one book (or all of them) after it changed in the database"""
+        self._generation += 1
+        if book_id is None:
+            dropped = list(self._entries)
+        else:
+            dropped = [book_id] if book_id in self._entries else []
+        for dropped_id in dropped:
+            self.bytes -= self._entries.pop(dropped_id)[2]
+        self.wasted += len(dropped)
+
+    def stats(self):
+        """
+        Counters: hit_rate is the share of selections served from the cache,
+        use_rate the share of prefetched books that were then selected
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'prefetched': self.prefetched,
+            'wasted': self.wasted,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'use_rate': self.hits / self.prefetched if self.prefetched else 0.0,
+            'cached': len(self._entries),
+            'bytes': self.bytes,
+        }
+
+    def _store(self, generation, loaded):
+        if generation != self._generation:
+            return      # something changed while loading
+        for book, thumbnail in reversed(loaded):     # nearest are evicted last
+            if book['id'] in self._entries:
+                continue
+            size = _estimate_size(book, thumbnail)
+            self._entries[book['id']] = (book, thumbnail, size)
+            self.bytes += size
+            self.prefetched += 1
+        while self.bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self.bytes -= self._entries.pop(oldest)[2]
+            self.wasted += 1
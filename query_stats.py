@@ -0,0 +1,368 @@
+"""
+Opt-in query instrumentation for database.py
+
+Off by default, and free when off. Once enable() is called:
+
+- every public database.py function is timed
+- every SQL statement it runs is timed (from execute() to the first row,
+  which is where SQLite does its sorting and grouping; time spent fetching
+  the rest of the rows is added up separately), and a trace callback counts
+  the statements SQLite actually ran for it - one per row for executemany,
+  plus any run by triggers and full-text index updates
+- statements slower than the threshold go to the slow-query log with their
+  parameter types and EXPLAIN QUERY PLAN output, and are logged as warnings
+
+Latencies are kept as histograms, so memory use doesn't grow with the
+number of calls. Start the app with LIBRARY_PROFILE=1 to record from the
+start (LIBRARY_SLOW_QUERY_MS sets the threshold and LIBRARY_SLOW_QUERY_LOG
+a file to append slow queries to), or press Ctrl+Shift+D in the app for the
+diagnostics window.
+"""
+
+import bisect
+import functools
+import inspect
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.environ.get('LIBRARY_SLOW_QUERY_MS', 50))
+SLOW_LOG_SIZE = 200         # slow queries kept in memory
+SLOW_LOG_PATH = os.environ.get('LIBRARY_SLOW_QUERY_LOG')    # also append them here, one JSON per line
+ITER_BATCH = 256            # rows fetched (and timed) at a time when a cursor is iterated
+
+# Histogram bucket upper bounds in milliseconds (the last bucket is open-ended)
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_enabled = False
+_slow_ms = SLOW_QUERY_MS
+_lock = threading.Lock()
+_local = threading.local()
+_functions = {}             # database function name -> Histogram
+_statements = {}            # normalised SQL -> StatementStats
+_slow_log = deque(maxlen=SLOW_LOG_SIZE)
+_plans = {}                 # normalised SQL -> EXPLAIN QUERY PLAN lines
+_originals = {}             # database function name -> unwrapped function
+_proxies = {}               # id(connection) -> InstrumentedConnection
+
+
+class Histogram:
+    """Counts of latencies in BUCKETS_MS buckets, plus total and maximum"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile (at most max_ms)"""
+        if not self.count:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                bound = BUCKETS_MS[index] if index < len(BUCKETS_MS) else self.max_ms
+                return round(min(bound, self.max_ms), 3)
+        return round(self.max_ms, 3)
+
+    def summary(self):
+        return {
+            'calls': self.count,
+            'total_ms': round(self.total_ms, 3),
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'max_ms': round(self.max_ms, 3),
+            'buckets': dict(zip([*map(str, BUCKETS_MS), 'more'], self.counts)),
+        }
+
+
+class StatementStats(Histogram):
+    """A statement's latency histogram plus fetch time and the work SQLite did for it"""
+
+    def __init__(self):
+        super().__init__()
+        self.fetch_ms = 0.0
+        self.statements_run = 0
+
+    def summary(self):
+        summary = super().summary()
+        summary['fetch_ms'] = round(self.fetch_ms, 3)
+        summary['statements_run'] = self.statements_run
+        return summary
+
+
+def normalise_sql(sql):
+    """Collapse whitespace and variable-length placeholder lists, so one query is one key"""
+    sql = ' '.join(sql.split())
+    return re.sub(r"\?(\s*,\s*\?)+", "?, ...", sql)
+
+
+def params_shape(params):
+    """Parameter types without their values, e.g. '(int, str)' or '{now: int}'"""
+    if isinstance(params, dict):
+        return '{' + ', '.join(f"{key}: {type(value).__name__}" for key, value in params.items()) + '}'
+    params = list(params)
+    if len(params) > 8 and len({type(value) for value in params}) == 1:
+        return f"({type(params[0]).__name__} x {len(params)})"
+    return '(' + ', '.join(type(value).__name__ for value in params) + ')'
+
+
+def _trace(statement):
+    """sqlite3 trace callback: counts every statement SQLite runs, including from triggers"""
+    _local.traced = getattr(_local, 'traced', 0) + 1
+
+
+def _explain(conn, sql, params):
+    """EXPLAIN QUERY PLAN lines for a statement, worked out once per statement"""
+    key = normalise_sql(sql)
+    with _lock:
+        plan = _plans.get(key)
+    if plan is not None:
+        return plan
+    # Not holding the lock while the plan is worked out: another thread may
+    # explain the same statement meanwhile, which only costs a repeat
+    if not re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH|REPLACE)\b", sql, re.IGNORECASE):
+        plan = []
+    else:
+        conn.set_trace_callback(None)
+        try:
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        except Exception as e:
+            plan = [f"(no plan: {e})"]
+        finally:
+            conn.set_trace_callback(_trace)
+    with _lock:
+        _plans[key] = plan
+    return plan
+
+
+def _record_statement(conn, sql, params, ms, traced):
+    key = normalise_sql(sql)
+    with _lock:
+        stats = _statements.get(key)
+        if stats is None:
+            stats = _statements[key] = StatementStats()
+        stats.add(ms)
+        stats.statements_run += traced
+    if ms >= _slow_ms:
+        stack = getattr(_local, 'functions', [])
+        entry = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'ms': round(ms, 3),
+            'function': stack[-1] if stack else None,
+            'sql': key,
+            'params': params_shape(params) if params is not None else "(executemany)",
+            'statements_run': traced,
+            'plan': _explain(conn, sql, params if params is not None else [None] * sql.count('?')),
+        }
+        with _lock:
+            _slow_log.append(entry)
+            if SLOW_LOG_PATH:
+                with open(SLOW_LOG_PATH, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+        log.warning("Slow query (%.1f ms) in %s: %s %s | plan: %s", ms, entry['function'],
+                    key, entry['params'], '; '.join(entry['plan']))
+
+
+def _record_fetch(sql, ms):
+    key = normalise_sql(sql)
+    with _lock:
+        stats = _statements.get(key)
+        if stats is not None:
+            stats.fetch_ms += ms
+
+
+class InstrumentedCursor:
+    """Wraps a cursor so its statements, and fetching their rows, are timed"""
+
+    def __init__(self, cursor, sql=None):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_sql', sql)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)      # e.g. row_factory
+
+    def execute(self, sql, params=()):
+        object.__setattr__(self, '_sql', sql)
+        _local.traced = 0
+        start = time.perf_counter()
+        self._cursor.execute(sql, params)
+        _record_statement(self._cursor.connection, sql, params,
+                          (time.perf_counter() - start) * 1000, _local.traced)
+        return self
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            _record_fetch(self._sql, (time.perf_counter() - start) * 1000)
+
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall)
+
+    def __iter__(self):
+        # Rows still arrive as they are read, a timed batch at a time
+        while True:
+            rows = self.fetchmany(ITER_BATCH)
+            if not rows:
+                return
+            yield from rows
+
+
+class InstrumentedConnection:
+    """Wraps a pooled connection so execute() and executemany() are timed"""
+
+    def __init__(self, conn):
+        self.raw = conn
+        conn.set_trace_callback(_trace)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def cursor(self):
+        return InstrumentedCursor(self.raw.cursor())
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        _local.traced = 0
+        start = time.perf_counter()
+        cursor = self.raw.executemany(sql, seq_of_params)
+        # Explained with every parameter NULL, since the rows may be a one-shot iterator
+        _record_statement(self.raw, sql, None, (time.perf_counter() - start) * 1000,
+                          _local.traced)
+        return InstrumentedCursor(cursor, sql)
+
+
+def wrap(conn):
+    """The connection to use: an InstrumentedConnection while enabled, else conn itself"""
+    if not _enabled:
+        return conn
+    proxy = _proxies.get(id(conn))
+    if proxy is None or proxy.raw is not conn:
+        proxy = _proxies[id(conn)] = InstrumentedConnection(conn)
+    return proxy
+
+
+def _timed_function(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = getattr(_local, 'functions', None)
+        if stack is None:
+            stack = _local.functions = []
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            stack.pop()
+            with _lock:
+                histogram = _functions.get(name)
+                if histogram is None:
+                    histogram = _functions[name] = Histogram()
+                histogram.add(ms)
+    return wrapper
+
+
+def enable(slow_ms=None):
+    """Start recording (slow_ms overrides the slow-query threshold)"""
+    global _enabled, _slow_ms
+    import database
+    if slow_ms is not None:
+        _slow_ms = slow_ms
+    if _enabled:
+        return
+    for name, func in vars(database).items():
+        if (inspect.isfunction(func) and func.__module__ == database.__name__
+                and not name.startswith('_')):
+            _originals[name] = func
+            setattr(database, name, _timed_function(name, func))
+    _enabled = True
+
+
+def disable():
+    """Stop recording; what was recorded so far is kept until reset()"""
+    global _enabled
+    import database
+    if not _enabled:
+        return
+    _enabled = False
+    for name, func in _originals.items():
+        setattr(database, name, func)
+    _originals.clear()
+    for proxy in _proxies.values():
+        try:
+            proxy.raw.set_trace_callback(None)
+        except Exception:
+            pass    # already closed
+    _proxies.clear()
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Forget everything recorded so far"""
+    with _lock:
+        _functions.clear()
+        _statements.clear()
+        _slow_log.clear()
+        _plans.clear()
+
+
+def snapshot():
+    """Everything recorded so far, as a JSON-ready dict (slowest first)"""
+    with _lock:
+        functions = {name: h.summary() for name, h in _functions.items()}
+        statements = {sql: s.summary() for sql, s in _statements.items()}
+        slow = list(_slow_log)
+
+    def by_total(items):
+        return dict(sorted(items.items(), key=lambda item: -item[1]['total_ms']))
+
+    return {
+        'enabled': _enabled,
+        'slow_query_ms': _slow_ms,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'functions': by_total(functions),
+        'statements': by_total(statements),
+        'slow_queries': slow,
+    }
+
+
+def export_json(path):
+    """Write snapshot() to a JSON file"""
+    with open(path, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+
@@ -0,0 +1,146 @@
+"""
+Multi-process stress test for Callum's Library App
+
+Several copies of the app can share one library.db. This starts N
+processes that, like busy users, loan and return books and edit them as
+fast as they can against one throwaway database, then reports throughput
+and how many writes failed with "database is locked".
+
+Run with:  python stress_test.py [--processes 8] [--seconds 10] [--books 500]
+                                 [--busy-timeout 5000] [--retries 5]
+
+--retries 0 --busy-timeout 0 shows what happens without busy handling.
+"""
+
+import argparse
+import multiprocessing
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import connection_manager
+import database
+
+
+def setup(db_path, books):
+    """Create the shared database with some books to work on"""
+    database.DB_PATH = Path(db_path)
+    database.init_database()
+    ids = [outcome['id'] for outcome in database.add_books_bulk(
+        {'title': f"Stress Book {n}", 'author': "Tester", 'year': "2000"} for n in range(books))]
+    connection_manager.close_all()
+    return ids
+
+
+def worker(db_path, book_ids, seconds, busy_timeout, retries, seed):
+    """
+    Hammer the database until the time is up (runs in its own process)
+
+    Returns (counts, failures, latencies, retry_stats).
+    """
+    connection_manager.BUSY_TIMEOUT_MS = busy_timeout
+    connection_manager.BUSY_RETRIES = retries
+    database.DB_PATH = Path(db_path)
+    rng = random.Random(seed)
+    counts = {'loan': 0, 'return': 0, 'edit': 0, 'add': 0}
+    failures = {}
+    latencies = []
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        book_id = rng.choice(book_ids)
+        roll = rng.random()
+        start = time.perf_counter()
+        try:
+            if roll < 0.6:
+                loan = database.get_current_loan(book_id)
+                if loan:
+                    database.return_book(loan['id'])
+                    kind = 'return'
+                else:
+                    database.loan_book(book_id, f"Borrower {rng.randint(1, 50)}")
+                    kind = 'loan'
+            elif roll < 0.95:
+                database.update_book(book_id, notes=f"Edited at {time.time()}")
+                kind = 'edit'
+            else:
+                database.add_book(None, f"New Book {seed}-{counts['add']}", "2024", "Tester")
+                kind = 'add'
+        except Exception as e:
+            message = f"{type(e).__name__}: {e}"
+            failures[message] = failures.get(message, 0) + 1
+            continue
+        latencies.append(time.perf_counter() - start)
+        counts[kind] += 1
+
+    connection_manager.close_all()
+    return counts, failures, latencies, connection_manager.retry_stats()
+
+
+def run(processes, seconds, books, busy_timeout, retries):
+    """Run the stress test and return a summary dict"""
+    with tempfile.TemporaryDirectory() as folder:
+        db_path = str(Path(folder) / "stress.db")
+        book_ids = setup(db_path, books)
+        jobs = [(db_path, book_ids, seconds, busy_timeout, retries, seed)
+                for seed in range(processes)]
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(worker, jobs)
+
+    counts = {}
+    failures = {}
+    latencies = []
+    retry_totals = {}
+    for worker_counts, worker_failures, worker_latencies, worker_retries in results:
+        for totals, values in ((counts, worker_counts), (failures, worker_failures),
+                               (retry_totals, worker_retries)):
+            for name, value in values.items():
+                totals[name] = totals.get(name, 0) + value
+        latencies.extend(worker_latencies)
+
+    latencies.sort()
+    writes = sum(counts.values())
+    return {
+        'processes': processes,
+        'seconds': seconds,
+        'writes': writes,
+        'writes_per_second': writes / seconds,
+        'counts': counts,
+        'failed': sum(failures.values()),
+        'failures': failures,
+        'retries': retry_totals,
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else 0.0,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hammer one library database from several processes")
+    parser.add_argument('--processes', type=int, default=8, help="processes (default %(default)s)")
+    parser.add_argument('--seconds', type=float, default=10, help="how long to run (default %(default)s)")
+    parser.add_argument('--books', type=int, default=500, help="books to share (default %(default)s)")
+    parser.add_argument('--busy-timeout', type=int, default=connection_manager.BUSY_TIMEOUT_MS,
+                        help="SQLite busy timeout in ms (default %(default)s)")
+    parser.add_argument('--retries', type=int, default=connection_manager.BUSY_RETRIES,
+                        help="retries after a busy error (default %(default)s)")
+    args = parser.parse_args()
+
+    print(f"{args.processes} processes for {args.seconds:g} s "
+          f"(busy timeout {args.busy_timeout} ms, {args.retries} retries)...")
+    summary = run(args.processes, args.seconds, args.books, args.busy_timeout, args.retries)
+
+    counts = ', '.join(f"{count} {name}s" for name, count in summary['counts'].items())
+    print(f"  {summary['writes']:,} writes ({summary['writes_per_second']:,.0f}/s): {counts}")
+    print(f"  latency p50 {summary['p50_ms']:.1f} ms, p99 {summary['p99_ms']:.1f} ms")
+    retries = summary['retries']
+    print(f"  {retries.get('busy_errors', 0)} busy errors, {retries.get('retries', 0)} retried, "
+          f"{retries.get('gave_up', 0)} gave up")
+    print(f"  {summary['failed']} failed writes")
+    for message, count in sorted(summary['failures'].items(), key=lambda item: -item[1]):
+        print(f"    {count} x {message}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,20 @@ Test script to verify all components work correctly
 """
 
 import sys
+import tempfile
+import threading
 from pathlib import Path
 
+
+def use_temp_database(folder):
+    """Point the database module at a fresh database inside folder"""
+    import connection_manager
+    import database
+    connection_manager.close_all()
+    database.DB_PATH = Path(folder) / "test_library.db"
+    database.init_database()
+    return database
+
 def test_database():
     """Test database functionality"""
     print("Testing database...")
@@ -19,6 +31,1516 @@ def test_database():
         return False
 
 
+def test_connection_pooling():
+    """Test that connections are reused per thread and pragmas are applied"""
+    print("\nTesting connection pooling...")
+    original_path = None
+    try:
+        import connection_manager
+        import database
+        original_path = database.DB_PATH
+        
+        with tempfile.TemporaryDirectory() as folder:
+            use_temp_database(folder)
+            conn = database._connect()
+            assert database._connect() is conn, "connection not reused"
+            
+            other = []
+            worker = threading.Thread(target=lambda: other.append(database._connect()))
+            worker.start()
+            worker.join()
+            assert other[0] is not conn, "threads must not share a connection"
+            print("  ✓ One connection per thread, reused between calls")
+            
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+            assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+            print("  ✓ WAL journal and foreign keys enabled")
+            
+            book_id = database.add_book(None, "Test Book", "2024", "Someone")
+            database.loan_book(book_id, "Rowan")
+            database.delete_book(book_id)
+            assert database.get_loan_history(book_id) == [], "loans not cascaded"
+            print("  ✓ Deleting a book removes its loans")
+            
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Connection pooling error: {e!r}")
+        return False
+    finally:
+        if original_path is not None:
+            database.DB_PATH = original_path
+
+
+def test_migrations():
+    """Test upgrading a database created by an older version of the app"""
+    print("\nTesting schema migrations...")
+    original_path = None
+    try:
+        import sqlite3
+        import connection_manager
+        import database
+        import migrations
+        original_path = database.DB_PATH
+        
+        with tempfile.TemporaryDirectory() as folder:
+            # Schema as it was before the artist column, with no indexes
+            legacy = sqlite3.connect(Path(folder) / "test_library.db")
+            legacy.execute("""
+                CREATE TABLE books (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, isbn TEXT UNIQUE, title TEXT NOT NULL,
+                    year TEXT, author TEXT, publisher TEXT, page_count INTEGER, description TEXT,
+                    series_name TEXT, series_number INTEGER, format TEXT DEFAULT 'Book',
+                    cover_path TEXT, notes TEXT, date_added TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            legacy.execute("INSERT INTO books (title, author) VALUES ('Old Favourite', 'Someone')")
+            legacy.commit()
+            legacy.close()
+            
+            connection_manager.close_all()
+            database.DB_PATH = Path(folder) / "test_library.db"
+            applied = database.init_database()
+            assert [step[0] for step in applied] == [step[0] for step in migrations.MIGRATIONS]
+            conn = database._connect()
+            assert migrations.schema_version(conn) == migrations.latest_version()
+            assert 'artist' in migrations._columns(conn, 'books')
+            assert database.get_all_books()[0]['title'] == "Old Favourite"
+            print(f"  ✓ Upgraded legacy database to version {migrations.latest_version()}")
+            
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            assert {'idx_loans_book_returned', 'idx_loans_open_due_at', 'idx_books_title'} <= indexes
+            print("  ✓ Secondary indexes created")
+            
+            assert database.init_database() == [], "migrations re-ran"
+            print("  ✓ Already-migrated database left alone")
+            
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Migration error: {e!r}")
+        return False
+    finally:
+        if original_path is not None:
+            database.DB_PATH = original_path
+
+
+def test_search():
+    """Test quick and advanced search, including the full-text index"""
+    print("\nTesting search...")
+    original_path = None
+    try:
+        import connection_manager
+        import database
+        import migrations
+        original_path = database.DB_PATH
+        
+        with tempfile.TemporaryDirectory() as folder:
+            use_temp_database(folder)
+            potter = database.add_book("9780747532699", "Harry Potter and the Philosopher's Stone",
+                                       "1997", "J. K. Rowling", series_name="Harry Potter")
+            database.add_book(None, "Watchmen", "1987", "Alan Moore", artist="Dave Gibbons")
+            
+            titles = [book['title'] for book in database.search_books("harr pot")]
+            assert titles == ["Harry Potter and the Philosopher's Stone"], titles
+            assert database.search_books("gibb")[0]['title'] == "Watchmen"
+            print("  ✓ Prefix search across title and artist")
+            
+            database.update_book(potter, title="The Casual Vacancy")
+            assert database.search_books("vacancy")[0]['id'] == potter
+            database.delete_book(potter)
+            assert database.search_books("vacancy") == []
+            print("  ✓ Index follows updates and deletes")
+            
+            results = database.advanced_search(title="watch", artist="dave")
+            assert [book['title'] for book in results] == ["Watchmen"]
+            assert database.advanced_search(title="watch", author="rowling") == []
+            print("  ✓ Advanced search matches each field separately")
+            
+            database.add_book(None, "Watching the Detectives", "2001", "A. Moore",
+                              description="A long description " * 50)
+            summaries = database.search_books("watch", summaries=True)
+            assert [book.id for book in summaries] == [book['id'] for book in database.search_books("watch")]
+            assert not hasattr(summaries[0], '__dict__') and not hasattr(summaries[0], 'description')
+            summary = database.advanced_search(artist="dave", summaries=True)[0]
+            assert (summary.title, summary.artist, summary.year) == ("Watchmen", "Dave Gibbons", "1987")
+            assert database._search_books_like("alan", summaries=True)[0].author == "Alan Moore"
+            listed = database.get_book_summaries()
+            assert [book.title for book in listed] == ["Watching the Detectives", "Watchmen"]
+            assert database.get_book(listed[0].id)['description'].startswith("A long description")
+            print("  ✓ List views get compact BookSummary rows; get_book has the full record")
+            
+            # With the index, words must start a word of the book; only the LIKE
+            # fallback (no FTS5) matches substrings
+            database.add_book(None, "Batman: Year One", "1987", "Frank Miller")
+            database.add_book(None, "Iron Man", "1968", "Stan Lee")
+            if migrations.fts5_available():
+                cases = (("man", ["Iron Man"]), ("atma", []))
+            else:
+                cases = (("man", ["Batman: Year One", "Iron Man"]), ("atma", ["Batman: Year One"]))
+            for query, expected in cases:
+                assert sorted(book['title'] for book in database.search_books(query)) == expected
+                assert [book['title'] for book in database.get_books_page(query=query)] == expected
+                assert database.count_books(query) == len(expected)
+                titles = [database.get_book(book_id)['title']
+                          for book_id in database.advanced_search_ids(title=query)]
+                assert titles == expected, (query, titles)
+            print("  ✓ Words match the start of a word: \"man\" finds Iron Man, not Batman")
+            
+            if migrations.fts5_available():
+                original_limit = database.SHORT_QUERY_LIMIT
+                database.SHORT_QUERY_LIMIT = 1
+                try:
+                    assert [book['title'] for book in database.search_books("wa")] == \
+                        ["Watching the Detectives"]
+                finally:
+                    database.SHORT_QUERY_LIMIT = original_limit
+                assert [book['title'] for book in database.search_books("wa")] == \
+                    ["Watching the Detectives", "Watchmen"]
+                print("  ✓ One- and two-letter queries come back by title, capped")
+            
+            if migrations.fts5_available():
+                print("  ✓ Using FTS5 full-text index")
+            else:
+                print("  ⚠ FTS5 not available - using LIKE fallback")
+            
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Search error: {e!r}")
+        return False
+    finally:
+        if original_path is not None:
+            database.DB_PATH = original_path
+
+
+def test_bulk_insert():
+    """Test adding many books in one transaction"""
+    print("\nTesting bulk insert...")
+    original_path = None
+    try:
+        import connection_manager
+        import database
+        original_path = database.DB_PATH
+        
+        with tempfile.TemporaryDirectory() as folder:
+            use_temp_database(folder)
+            existing = database.add_book("111", "Already Here", "2001", "Someone")
+            records = [
+                {'isbn': "111", 'title': "Duplicate"},
+                {'isbn': "222", 'title': "Brand New", 'format_type': 'Comic'},
+                {'isbn': "222", 'title': "Same Batch Duplicate"},
+                {'isbn': "", 'title': "No ISBN"},
+                {'title': ""},
+            ]
+            
+            outcomes = database.add_books_bulk(records, chunk_size=2)
+            assert [o['status'] for o in outcomes] == ['skipped', 'inserted', 'skipped', 'inserted', 'error']
+            assert outcomes[0]['id'] == existing
+            assert outcomes[2]['id'] == outcomes[1]['id']
+            assert database.get_book(outcomes[1]['id'])['format'] == 'Comic'
+            assert database.search_books("brand")[0]['id'] == outcomes[1]['id']
+            print("  ✓ Inserts, skips duplicates and reports bad rows")
+            
+            outcomes = database.add_books_bulk([{'isbn': "111", 'title': "Renamed"}], on_conflict='update')
+            assert outcomes[0]['status'] == 'updated'
+            assert database.get_book(existing)['title'] == "Renamed"
+            print("  ✓ Updates existing books on request")
+            
+            count = len(database.get_all_books())
+            try:
+                database.add_books_bulk([{'isbn': "333", 'title': "New"}, {'isbn': "111", 'title': "Clash"}],
+                                        on_conflict='error')
+                raise AssertionError("duplicate not rejected")
+            except ValueError:
+                pass
+            assert len(database.get_all_books()) == count, "batch not rolled back"
+            print("  ✓ Rolls the whole batch back on error")
+            
+            # Duplicates of rows added earlier in the same load, in the same chunk and a
+            # later one, into an empty index (where a stray FTS delete shows up)
+            with tempfile.TemporaryDirectory() as fresh:
+                use_temp_database(fresh)
+                outcomes = database.add_books_bulk([{'isbn': "444", 'title': "Alpha book"},
+                                                    {'isbn': "444", 'title': "Beta book"},
+                                                    {'isbn': "444", 'title': "Gamma book"}],
+                                                   on_conflict='update', chunk_size=2)
+                assert [o['status'] for o in outcomes] == ['inserted', 'updated', 'updated']
+                assert [book['title'] for book in database.search_books("gamma")] == ["Gamma book"]
+                assert database.search_books("alpha") == []
+                conn = connection_manager.get_connection(database.DB_PATH)
+                conn.execute("INSERT INTO books_fts (books_fts, rank) VALUES ('integrity-check', 1)")
+                connection_manager.close_all()
+            print("  ✓ Duplicates within one load updated, full-text index intact")
+            
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Bulk insert error: {e!r}")
+        return False
+    finally:
+        if original_path is not None:
+            database.DB_PATH = original_path
+
+
+def test_paged_book_list():
+    """Test keyset pagination and the windowed row cache behind the library list"""
+    print("\nTesting paged book list...")
+    original_path = None
+    try:
+        import connection_manager
+        import database
+        from library_app import BookListSource
+        from widgets import PagedRows
+        original_path = database.DB_PATH
+        
+        with tempfile.TemporaryDirectory() as folder:
+            use_temp_database(folder)
+            database.add_books_bulk({'title': f"Book {n % 7} {n:04d}", 'author': "Someone"}
+                                    for n in range(1000))
+            everything = database.get_books_page_at(0, 2000)
+            assert len(everything) == database.count_books() == 1000
+            
+            walked, key = [], None
+            while True:
+                page = database.get_books_page(key, 64)
+                if not page:
+                    break
+                walked += page
+                key = database.book_sort_key(page[-1])
+            assert walked == everything
+            print("  ✓ Keyset pages cover the list in order")
+            
+            model = PagedRows(BookListSource(), overscan=10, max_rows=100)
+            for top in list(range(0, 990, 7)) + list(range(990, 0, -13)) + [500, 3, 980]:
+                assert model.rows(top, 10) == everything[top:top + 10], f"wrong rows at {top}"
+                assert len(model.cache) <= 100 + 10 + 10 * 2
+            print("  ✓ Scrolling and jumping return the right rows with a bounded cache")
+            
+            position = model.position_of(("book 5", 0))
+            assert everything[position]['title'].startswith("Book 5")
+            assert not everything[position - 1]['title'].startswith("Book 5")
+            print("  ✓ Jump to a title prefix")
+            
+            model.reset(BookListSource("book 3"))
+            assert model.total == database.count_books("book 3") == len(database.search_books("book 3"))
+            assert all(row['title'].startswith("Book 3") for row in model.rows(0, 200))
+            print("  ✓ Search filter applied to pages")
+            
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Paged book list error: {e!r}")
+        return False
+    finally:
+        if original_path is not None:
+            database.DB_PATH = original_path
+
+
+class FakeRoot:
+    """Stands in for tk.Tk's after() scheduling so background work can be tested headless"""
+    
+    def __init__(self):
+        self.callbacks = {}
+        self.next_id = 0
+    
+    def after(self, ms, func, *args):
+        self.next_id += 1
+        self.callbacks[self.next_id] = (func, args)
+        return self.next_id
+    
+    def after_cancel(self, after_id):
+        self.callbacks.pop(after_id, None)
+    
+    def run_until_idle(self, timeout=5.0):
+        import time
+        deadline = time.time() + timeout
+        while self.callbacks and time.time() < deadline:
+            after_id = min(self.callbacks)
+            func, args = self.callbacks.pop(after_id)
+            func(*args)
+            time.sleep(0.005)
+
+
+def test_background_refresh():
+    """Test that superseded background queries are discarded and list updates are minimal"""
+    print("\nTesting background refresh...")
+    try:
+        import time
+        from background import BackgroundTasks
+        from widgets import VirtualListbox
+        
+        root = FakeRoot()
+        tasks = BackgroundTasks(root)
+        delivered = []
+        
+        def slow_query(text, delay):
+            time.sleep(delay)
+            return text
+        
+        tasks.submit(slow_query, "harr", 0.2, on_done=delivered.append, key='search')
+        tasks.submit(slow_query, "harry", 0.0, on_done=delivered.append, key='search')
+        root.run_until_idle()
+        assert delivered == ["harry"], delivered
+        print("  ✓ Older query's result thrown away")
+        
+        task = tasks.submit(slow_query, "cancelled", 0.1, on_done=delivered.append)
+        task.cancel()
+        root.run_until_idle()
+        assert delivered == ["harry"] and not root.callbacks
+        print("  ✓ Cancelled task delivers nothing and polling stops")
+        tasks.shutdown()
+        
+        class ListboxRecorder:
+            def __init__(self, items):
+                self.items = list(items)
+                self.operations = 0
+            
+            def delete(self, first, last):
+                del self.items[first:last + 1]
+                self.operations += 1
+            
+            def insert(self, index, *items):
+                self.items[index:index] = items
+                self.operations += 1
+        
+        widget = VirtualListbox.__new__(VirtualListbox)
+        old = [f"row {n}" for n in range(30)]
+        new = old[3:] + ["row 30", "row 31", "row 32"]
+        widget.listbox = ListboxRecorder(old)
+        widget._apply_changes(old, new)
+        assert widget.listbox.items == new
+        assert widget.listbox.operations == 2, widget.listbox.operations
+        print("  ✓ Scrolling three rows is one delete and one insert")
+        
+        return True
+    except Exception as e:
+        print(f"  ✗ Background refresh error: {e!r}")
+        return False
+
+
+def test_isbn_cache():
+    """Test the local ISBN lookup cache (no network needed)"""
+    print("\nTesting ISBN cache...")
+    original_path = None
+    try:
+        import time
+        import connection_manager
+        import isbn_cache
+        import isbn_lookup
+        original_path = isbn_cache.CACHE_PATH
+        
+        with tempfile.TemporaryDirectory() as folder:
+            isbn_cache.CACHE_PATH = Path(folder) / "test_cache.db"
+            isbn_cache.reset_stats()
+            book = {'title': "Nineteen Eighty-Four", 'year': "1949", 'author': "George Orwell",
+                    'publisher': "Secker & Warburg", 'page_count': 328, 'description': '',
+                    'cover_url': None}
+            
+            assert isbn_cache.get("9780451526538") == (False, None)
+            isbn_cache.put("9780451526538", book, {'title': "Nineteen Eighty-Four"})
+            isbn_cache.put("9780000000000", None)
+            
+            # lookup_isbn answers from the cache without touching the network
+            start = time.perf_counter()
+            assert isbn_lookup.lookup_isbn("978-0-451-52653-8") == book
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            assert isbn_lookup.lookup_isbn("978 0000000000") is None
+            assert isbn_cache.get_raw("9780451526538") == {'title': "Nineteen Eighty-Four"}
+            print(f"  ✓ Cached hit in {elapsed_ms:.3f} ms, not-found cached too")
+            
+            original_ttl = isbn_cache.NOT_FOUND_TTL_SECONDS
+            isbn_cache.NOT_FOUND_TTL_SECONDS = 0
+            try:
+                assert isbn_cache.get("9780000000000") == (False, None)
+            finally:
+                isbn_cache.NOT_FOUND_TTL_SECONDS = original_ttl
+            print("  ✓ Expired entries are misses")
+            
+            isbn_cache.invalidate("9780451526538")
+            assert isbn_cache.get("9780451526538") == (False, None)
+            isbn_cache.clear()
+            assert isbn_cache.get("9780000000000") == (False, None)
+            stats = isbn_cache.stats()
+            assert stats['hits'] == 1 and stats['negative_hits'] == 1 and stats['misses'] == 4, stats
+            print("  ✓ Invalidate, clear and hit/miss counters")
+            
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ ISBN cache error: {e!r}")
+        return False
+    finally:
+        if original_path is not None:
+            isbn_cache.CACHE_PATH = original_path
+
+
+def test_batched_lookup():
+    """Test batched ISBN lookups against a local stand-in for Open Library"""
+    print("\nTesting batched ISBN lookup...")
+    original_path = None
+    original_url = None
+    try:
+        import connection_manager
+        import isbn_cache
+        import isbn_lookup
+        from openlibrary_stub import OpenLibraryStub
+        original_path = isbn_cache.CACHE_PATH
+        original_url = isbn_lookup.OPEN_LIBRARY_URL
+        
+        books = {
+            "9780451526538": {'title': "Nineteen Eighty-Four", 'publish_date': "June 1950",
+                              'authors': [{'name': "George Orwell"}],
+                              'publishers': [{'name': "Signet Classic"}], 'number_of_pages': 328},
+            "9780141439518": {'title': "Pride and Prejudice", 'authors': [{'name': "Jane Austen"}]},
+            "9780261103573": {'title': "The Fellowship of the Ring",
+                              'cover': {'medium': "http://covers.example/1-M.jpg"}},
+            "9780007525546": {'title': "The Hobbit", 'publish_date': "2013"},
+        }
+        isbns = ["9780451526538", "978-0-14-143951-8", "9780261103573", "9780007525546",
+                 "9780000000000"]
+        
+        with tempfile.TemporaryDirectory() as folder, \
+                OpenLibraryStub(books, fail_first=1) as stub:
+            isbn_cache.CACHE_PATH = Path(folder) / "test_cache.db"
+            isbn_lookup.OPEN_LIBRARY_URL = stub.url
+            
+            results = isbn_lookup.lookup_isbns(isbns, batch_size=2)
+            assert list(results) == isbns
+            assert results["9780451526538"]['author'] == "George Orwell"
+            assert results["9780451526538"]['year'] == "1950"
+            assert results["978-0-14-143951-8"]['title'] == "Pride and Prejudice"
+            assert results["9780261103573"]['cover_url'] == "http://covers.example/1-M.jpg"
+            assert results["9780000000000"] is None
+            # 5 ISBNs in batches of 2 = 3 requests, plus a retry of the first (503)
+            assert len(stub.requests) == 4, stub.requests
+            print(f"  ✓ {len(isbns)} ISBNs in {len(stub.requests) - 1} requests, 503 retried")
+            
+            assert isbn_lookup.lookup_isbns(isbns, batch_size=2) == results
+            assert len(stub.requests) == 4
+            print("  ✓ Repeat lookups (including not-found) answered from the cache")
+            
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Batched lookup error: {e!r}")
+        return False
+    finally:
+        if original_path is not None:
+            isbn_cache.CACHE_PATH = original_path
+            isbn_lookup.OPEN_LIBRARY_URL = original_url
+
+
+def test_enrichment():
+    """Test filling in missing details against a local stand-in for Open Library"""
+    print("\nTesting enrichment...")
+    import database
+    import isbn_cache
+    import isbn_lookup
+    original_paths = (database.DB_PATH, isbn_cache.CACHE_PATH, isbn_lookup.COVERS_DIR,
+                      isbn_lookup.OPEN_LIBRARY_URL)
+    try:
+        from io import BytesIO
+        from PIL import Image
+        import connection_manager
+        import enrichment
+        from openlibrary_stub import OpenLibraryStub
+        
+        cover = BytesIO()
+        Image.new('RGB', (4, 6), 'red').save(cover, 'JPEG')
+        books = {
+            f"97800000000{i:02d}": {'title': f"Book {i}", 'publishers': [{'name': "Found Press"}],
+                                    'number_of_pages': 100 + i, 'description': "Looked up",
+                                    'cover': {'large': "COVER"}}
+            for i in range(30)
+        }
+        
+        with tempfile.TemporaryDirectory() as folder, OpenLibraryStub() as stub:
+            use_temp_database(folder)
+            isbn_cache.CACHE_PATH = Path(folder) / "test_cache.db"
+            isbn_lookup.COVERS_DIR = Path(folder) / "covers"
+            isbn_lookup.OPEN_LIBRARY_URL = stub.url
+            stub.covers = {'/cover.jpg': cover.getvalue()}
+            for book in books.values():
+                book['cover'] = {'large': stub.cover_url('/cover.jpg')}
+            stub.books = books
+            
+            # 30 known ISBNs with nothing but a title, one the user has
+            # partly filled in, one unknown ISBN and one with no ISBN
+            database.add_books_bulk([{'isbn': isbn, 'title': "Typed in"} for isbn in books])
+            edited = database.get_books_page(limit=1)[0]['id']
+            database.update_book(edited, publisher="My Publisher")
+            unknown = database.add_book("9781111111111", "Unknown", "", "")
+            database.add_book(None, "No ISBN", "", "")
+            assert len(database.get_books_to_enrich()) == 31
+            
+            # Stop after the first batch is written, then resume
+            written = []
+            stats = enrichment.enrich_library(workers=1, rate=0, batch_size=5, lookup_size=10,
+                                              should_stop=lambda: bool(written),
+                                              progress=written.append)
+            assert stats.stopped
+            first_pass = stats.checked
+            remaining = len(database.get_books_to_enrich())
+            assert remaining == 31 - first_pass, (first_pass, remaining)
+            
+            stats = enrichment.enrich_library(workers=3, rate=0, batch_size=5)
+            assert not stats.stopped and stats.failed == 0
+            assert stats.checked == remaining, stats.summary()
+            assert database.get_books_to_enrich() == []
+            print(f"  ✓ Stopped after {first_pass} books, resumed with the other {remaining}")
+            
+            book = database.get_book(edited)
+            assert book['publisher'] == "My Publisher"
+            assert book['page_count'] and book['description'] == "Looked up"
+            assert Path(book['cover_path']).exists()
+            assert database.get_book(unknown)['publisher'] is None
+            print("  ✓ Empty fields filled in, the user's publisher kept, unknown ISBN logged")
+            
+            # retry=True looks again at logged books that are incomplete
+            database.update_book(edited, description=None)
+            database.update_book(unknown, publisher=None)
+            stats = enrichment.enrich_library(workers=2, rate=20, retry=True, covers=False)
+            assert stats.checked == 2 and stats.enriched == 1, stats.summary()
+            print(f"  ✓ {stats.summary()}")
+            
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Enrichment error: {e!r}")
+        return False
+    finally:
+        (database.DB_PATH, isbn_cache.CACHE_PATH, isbn_lookup.COVERS_DIR,
+         isbn_lookup.OPEN_LIBRARY_URL) = original_paths
+
+
+def test_cover_cache():
+    """Test cover thumbnails on disk and the PhotoImage LRU (no display needed)"""
+    print("\nTesting cover cache...")
+    import cover_cache
+    original_dir = cover_cache.THUMBNAIL_DIR
+    try:
+        import os
+        import subprocess
+        import time
+        from PIL import Image
+        
+        with tempfile.TemporaryDirectory() as folder:
+            cover_cache.THUMBNAIL_DIR = Path(folder) / "thumbnails"
+            cover_cache.reset_stats()
+            covers = []
+            for i, colour in enumerate(['red', 'green', 'blue']):
+                path = Path(folder) / f"cover{i}.jpg"
+                Image.new('RGB', (1200, 1800), colour).save(path)
+                covers.append(path)
+            
+            # Stand-in for ImageTk.PhotoImage, which needs a display
+            photos = cover_cache.PhotoCache(make_photo=lambda image: ('photo', image.size))
+            assert photos.get(covers[0]) == ('photo', (200, 300))
+            assert cover_cache.thumbnail_path(covers[0]).exists()
+            start = time.perf_counter()
+            photos.get(covers[0])
+            hit_ms = (time.perf_counter() - start) * 1000
+            stats = cover_cache.stats()
+            assert stats['generated'] == 1 and stats['memory_hits'] == 1, stats
+            print(f"  ✓ Thumbnail made once, repeat view {hit_ms:.3f} ms from memory")
+            
+            # A new cache (next app start) reads the thumbnail back from disk
+            assert cover_cache.PhotoCache(make_photo=lambda image: image.size).get(covers[0]) == (200, 300)
+            assert cover_cache.stats()['disk_hits'] == 1
+            
+            # Replacing the cover file makes a fresh thumbnail
+            Image.new('RGB', (300, 300), 'white').save(covers[0])
+            os.utime(covers[0], ns=(time.time_ns(), time.time_ns() + 10**9))
+            assert photos.get(covers[0]) == ('photo', (200, 200))
+            assert cover_cache.stats()['generated'] == 2
+            print("  ✓ Thumbnails reused from disk and remade when the cover changes")
+            
+            # Budget for two 200x300 thumbnails: the least recently used goes
+            small = cover_cache.PhotoCache(max_bytes=2 * 200 * 300 * 4, make_photo=lambda image: image)
+            small.get(covers[1])
+            small.get(covers[2])
+            small.get(covers[1])
+            small.get(covers[0])
+            assert len(small) == 2 and small.bytes <= small.max_bytes
+            hits = cover_cache.stats()['memory_hits']
+            small.get(covers[1])
+            assert cover_cache.stats()['memory_hits'] == hits + 1
+            print(f"  ✓ LRU keeps {len(small)} photos within {small.max_bytes:,} bytes")
+            
+            check = "import sys, cover_cache, isbn_lookup; print('tkinter' in sys.modules)"
+            result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True,
+                                    cwd=Path(__file__).parent)
+            assert result.stdout.strip() == "False", (result.stdout, result.stderr)
+            print("  ✓ Thumbnails and lookups don't load tkinter")
+        return True
+    except Exception as e:
+        print(f"  ✗ Cover cache error: {e!r}")
+        return False
+    finally:
+        cover_cache.THUMBNAIL_DIR = original_dir
+
+
+def test_cover_download():
+    """Test streamed cover downloads against a local stand-in for Open Library"""
+    print("\nTesting cover download...")
+    import isbn_lookup
+    try:
+        from io import BytesIO
+        from PIL import Image
+        from openlibrary_stub import OpenLibraryStub
+        
+        def encode(image, image_format, **options):
+            data = BytesIO()
+            image.save(data, image_format, **options)
+            return data.getvalue()
+        
+        covers = {
+            '/small.jpg': encode(Image.new('RGB', (400, 600), 'red'), 'JPEG', quality=95),
+            '/huge.jpg': encode(Image.new('RGB', (4800, 7200), 'green'), 'JPEG'),
+            '/clear.png': encode(Image.new('RGBA', (300, 450), (0, 0, 255, 0)), 'PNG'),
+            '/broken.jpg': b"\xff\xd8\xff\xe0 not really a JPEG",
+        }
+        
+        with tempfile.TemporaryDirectory() as folder, OpenLibraryStub(covers=covers) as stub:
+            folder = Path(folder)
+            
+            assert isbn_lookup.download_cover(stub.cover_url('/small.jpg'), folder / "small.jpg")
+            assert (folder / "small.jpg").read_bytes() == covers['/small.jpg']
+            print("  ✓ JPEG that fits kept byte for byte")
+            
+            assert isbn_lookup.download_cover(stub.cover_url('/huge.jpg'), folder / "huge.jpg")
+            with Image.open(folder / "huge.jpg") as img:
+                assert img.format == 'JPEG' and img.size == isbn_lookup.MAX_COVER_SIZE, img.size
+            assert isbn_lookup.download_cover(stub.cover_url('/clear.png'), folder / "clear.jpg")
+            with Image.open(folder / "clear.jpg") as img:
+                assert img.format == 'JPEG' and img.getpixel((0, 0))[0] > 250
+            print("  ✓ Oversized covers shrunk, PNG converted to JPEG")
+            
+            assert not isbn_lookup.download_cover(stub.cover_url('/small.jpg'), folder / "capped.jpg",
+                                                  max_bytes=1000)
+            assert not isbn_lookup.download_cover(stub.cover_url('/broken.jpg'), folder / "broken.jpg")
+            assert not isbn_lookup.download_cover(stub.cover_url('/missing.jpg'), folder / "missing.jpg")
+            names = sorted(path.name for path in folder.iterdir())
+            assert names == ["clear.jpg", "huge.jpg", "small.jpg"], names
+            print("  ✓ Too big, broken and missing covers fail cleanly, no partial files")
+        return True
+    except Exception as e:
+        print(f"  ✗ Cover download error: {e!r}")
+        return False
+
+
+def test_async_lookup():
+    """Test concurrent lookups and cover downloads against a slow stand-in for Open Library"""
+    print("\nTesting async ISBN lookup...")
+    import isbn_cache
+    import isbn_lookup
+    originals = (isbn_cache.CACHE_PATH, isbn_lookup.OPEN_LIBRARY_URL, isbn_lookup.COVERS_DIR)
+    try:
+        import asyncio
+        import time
+        from io import BytesIO
+        from PIL import Image
+        import async_lookup
+        import connection_manager
+        from openlibrary_stub import OpenLibraryStub
+        
+        cover = BytesIO()
+        Image.new('RGB', (200, 300), 'blue').save(cover, 'JPEG')
+        isbns = [f"97800000{n:05d}" for n in range(16)]
+        
+        with tempfile.TemporaryDirectory() as folder, \
+                OpenLibraryStub(covers={'/1-M.jpg': cover.getvalue()}, latency=0.1) as stub:
+            isbn_cache.CACHE_PATH = Path(folder) / "test_cache.db"
+            isbn_lookup.OPEN_LIBRARY_URL = stub.url
+            isbn_lookup.COVERS_DIR = Path(folder) / "covers"
+            stub.books = {isbn: {'title': f"Book {n}", 'authors': [{'name': "Author"}],
+                                 'publish_date': "2001"} for n, isbn in enumerate(isbns[:-1])}
+            stub.books[isbns[0]]['cover'] = {'medium': stub.cover_url('/1-M.jpg')}
+            
+            start = time.perf_counter()
+            expected = isbn_lookup.lookup_isbns(isbns, batch_size=1, use_cache=False)
+            one_at_a_time = time.perf_counter() - start
+            
+            async def lookup_all():
+                async with async_lookup.AsyncLookupEngine(concurrency=8, batch_size=1) as engine:
+                    return await engine.lookup_isbns(isbns, use_cache=False), engine.requests
+            start = time.perf_counter()
+            results, requests_made = asyncio.run(lookup_all())
+            concurrent = time.perf_counter() - start
+            assert results == expected and list(results) == isbns
+            assert results[isbns[-1]] is None and requests_made == len(isbns)
+            assert concurrent < one_at_a_time / 3, (concurrent, one_at_a_time)
+            print(f"  ✓ Same results, {one_at_a_time:.2f} s one at a time vs "
+                  f"{concurrent:.2f} s 8 at a time")
+            
+            books = async_lookup.fetch_books(isbns[:3])
+            result, cover_path = books[isbns[0]]
+            assert result == expected[isbns[0]] and cover_path.read_bytes() == cover.getvalue()
+            assert books[isbns[1]] == (expected[isbns[1]], None)
+            print("  ✓ Blocking fetch_books() looks up and downloads covers")
+            
+            stub.latency = 1.0
+            start = time.perf_counter()
+            unseen = [f"97811111{n:05d}" for n in range(16)]
+            assert async_lookup.lookup_isbns(unseen, should_stop=lambda: True) is None
+            assert time.perf_counter() - start < 0.5
+            
+            async def impatient():
+                async with async_lookup.AsyncLookupEngine(timeout=0.2) as engine:
+                    return await engine.lookup_isbn("9780451526538"), engine.timeouts
+            assert asyncio.run(impatient()) == (None, 1)
+            # The abandoned request's worker thread gets its late answer, but doesn't cache it
+            time.sleep(stub.latency)
+            assert isbn_cache.get("9780451526538") == (False, None)
+            assert not any(isbn_cache.get(isbn)[0] for isbn in unseen)
+            print("  ✓ Stopping cancels the lookups, timed-out requests aren't cached")
+
+            def open_connections_after_workers_exit():
+                deadline = time.monotonic() + 5
+                while any(thread.name.startswith("async-lookup") for thread in threading.enumerate()):
+                    assert time.monotonic() < deadline, "lookup threads still running"
+                    time.sleep(0.01)
+                return len(connection_manager._all_connections)
+            stub.latency = 0.01
+            async_lookup.fetch_books(isbns[3:6])
+            before = open_connections_after_workers_exit()
+            for n in range(6):
+                async_lookup.fetch_books(isbns[n:n + 4], use_cache=n % 2 == 0)
+            assert open_connections_after_workers_exit() == before
+            print(f"  ✓ Repeated fetch_books() calls leave {before} connection(s) open, not more")
+
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Async lookup error: {e!r}")
+        return False
+    finally:
+        isbn_cache.CACHE_PATH, isbn_lookup.OPEN_LIBRARY_URL, isbn_lookup.COVERS_DIR = originals
+
+
+def test_intake():
+    """Test scanner intake: instant scans, background lookups, bulk approval"""
+    print("\nTesting intake...")
+    import database
+    import isbn_cache
+    import isbn_lookup
+    originals = (database.DB_PATH, isbn_cache.CACHE_PATH, isbn_lookup.OPEN_LIBRARY_URL,
+                 isbn_lookup.COVERS_DIR, database.add_intake)
+    try:
+        import time
+        from io import BytesIO
+        from PIL import Image
+        import connection_manager
+        from background import BackgroundTasks
+        from intake import Intake
+        from openlibrary_stub import OpenLibraryStub
+        
+        cover = BytesIO()
+        Image.new('RGB', (200, 300), 'blue').save(cover, 'JPEG')
+        
+        with tempfile.TemporaryDirectory() as folder, \
+                OpenLibraryStub(covers={'/1-M.jpg': cover.getvalue()}, latency=0.2) as stub:
+            use_temp_database(folder)
+            isbn_cache.CACHE_PATH = Path(folder) / "test_cache.db"
+            isbn_lookup.OPEN_LIBRARY_URL = stub.url
+            isbn_lookup.COVERS_DIR = Path(folder) / "covers"
+            stub.books = {
+                "9780141439518": {'title': "Pride and Prejudice", 'authors': [{'name': "Jane Austen"}],
+                                  'cover': {'medium': stub.cover_url('/1-M.jpg')}},
+                "9780007525546": {'title': "The Hobbit", 'publish_date': "2013"},
+            }
+            database.add_book("0-451-52653-8", "Nineteen Eighty-Four", "1949", "George Orwell")
+            
+            root = FakeRoot()
+            tasks = BackgroundTasks(root)
+            changes = []
+            intake = Intake(tasks, lambda: changes.append(1))
+            intake.start()
+            root.run_until_idle()
+            
+            written_by = []
+            add_intake = database.add_intake
+            database.add_intake = lambda *args: written_by.append(threading.current_thread()) \
+                or add_intake(*args)
+            start = time.perf_counter()
+            outcomes = [intake.scan(text) for text in
+                        ("978-0-14-143951-8", "9780007525546", "9780000000000",
+                         "9780451526533", "9780141439518", "not an isbn")]
+            scanning = time.perf_counter() - start
+            assert outcomes == ['queued', 'queued', 'queued', 'duplicate', 'already scanned',
+                                'invalid'], outcomes
+            assert scanning < 0.1 and intake.queued == 3, (scanning, intake.queued)
+            print(f"  ✓ 6 scans in {scanning * 1000:.1f} ms, ISBN-10 in library caught as duplicate")
+            
+            root.run_until_idle(timeout=10)
+            database.add_intake = add_intake
+            assert len(written_by) == 4 and threading.main_thread() not in written_by
+            entries = {entry['isbn']: entry for entry in database.get_intake()}
+            assert [entry['status'] for entry in entries.values()] == \
+                ['found', 'found', 'not_found', 'duplicate']
+            assert entries["9780141439518"]['author'] == "Jane Austen"
+            assert Path(entries["9780141439518"]['cover_path']).exists()
+            # The first scan started a lookup; the two scanned meanwhile shared the next one
+            assert intake.queued == 0 and len(stub.requests) == 3, stub.requests
+            print("  ✓ Looked up in the background, later scans batched, cover downloaded")
+            
+            outcomes = intake.approve(entry['id'] for entry in entries.values())
+            assert [outcome['status'] for outcome in outcomes] == ['inserted', 'inserted']
+            assert database.count_books() == 3
+            assert [entry['status'] for entry in database.get_intake()] == ['not_found', 'duplicate']
+            assert intake.scan("9780007525546") == 'duplicate'
+            print("  ✓ Found books approved together, the rest left for review")
+            
+            intake.discard(entry['id'] for entry in database.get_intake())
+            assert database.get_intake() == [] and intake.scan("9780000000000") == 'queued'
+            intake.stop()
+            tasks.shutdown()
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Intake error: {e!r}")
+        return False
+    finally:
+        (database.DB_PATH, isbn_cache.CACHE_PATH, isbn_lookup.OPEN_LIBRARY_URL,
+         isbn_lookup.COVERS_DIR, database.add_intake) = originals
+
+
+def test_prefetch():
+    """Test prefetching the books around the selection"""
+    print("\nTesting prefetch...")
+    import cover_cache
+    import database
+    original_paths = (database.DB_PATH, cover_cache.THUMBNAIL_DIR)
+    try:
+        from types import SimpleNamespace
+        from PIL import Image
+        import connection_manager
+        from background import BackgroundTasks
+        from prefetch import Prefetcher
+        from widgets import PagedRows, VirtualListbox
+        
+        # Neighbours come nearest first, the row below before the row above
+        rows = [{'id': i} for i in range(10)]
+        source = SimpleNamespace(count=lambda: len(rows), key=lambda row: row['id'],
+                                 page_at=lambda offset, limit: rows[offset:offset + limit])
+        fake_list = SimpleNamespace(selected=4, model=PagedRows(source))
+        nearby = VirtualListbox.rows_near_selection(fake_list, 2)
+        assert [row['id'] for row in nearby] == [5, 3, 6, 2], nearby
+        fake_list.selected = 0
+        assert [row['id'] for row in VirtualListbox.rows_near_selection(fake_list, 2)] == [1, 2]
+        print("  ✓ Neighbours of the selection, nearest first")
+        
+        with tempfile.TemporaryDirectory() as folder:
+            use_temp_database(folder)
+            cover_cache.THUMBNAIL_DIR = Path(folder) / "thumbnails"
+            cover = Path(folder) / "cover.jpg"
+            Image.new('RGB', (800, 1200), 'blue').save(cover)
+            ids = [database.add_book(None, f"Book {i}", "", "", cover_path=str(cover) if i % 2 else None)
+                   for i in range(10)]
+            
+            root = FakeRoot()
+            tasks = BackgroundTasks(root)
+            prefetcher = Prefetcher(tasks)
+            prefetcher.prefetch(ids[1:6])
+            root.run_until_idle()
+            assert all(book_id in prefetcher for book_id in ids[1:6])
+            
+            book, thumbnail = prefetcher.take(ids[1])
+            assert book['title'] == "Book 1" and thumbnail.size == (200, 300)
+            assert prefetcher.take(ids[2])[1] is None       # no cover
+            assert prefetcher.take(ids[8]) is None          # never prefetched
+            stats = prefetcher.stats()
+            assert stats['hits'] == 2 and stats['misses'] == 1 and stats['prefetched'] == 5, stats
+            print(f"  ✓ Prefetched books served from memory (hit rate {stats['hit_rate']:.0%})")
+            
+            # An edit while a load is running: the stale load is thrown away
+            prefetcher.prefetch([ids[7]])
+            database.update_book(ids[7], title="Edited")
+            prefetcher.invalidate(ids[7])
+            root.run_until_idle()
+            assert ids[7] not in prefetcher
+            prefetcher.invalidate(ids[3])
+            assert ids[3] not in prefetcher and prefetcher.stats()['wasted'] == 1
+            print("  ✓ Changed books dropped, loads started before the change ignored")
+            
+            # Budget for roughly one thumbnail: the nearest book is the one kept
+            small = Prefetcher(tasks, max_bytes=200 * 300 * 3 + 1000)
+            small.prefetch([ids[5], ids[7], ids[9]])
+            root.run_until_idle()
+            assert ids[5] in small and ids[9] not in small and small.bytes <= small.max_bytes
+            print(f"  ✓ Memory budget kept ({small.bytes:,} of {small.max_bytes:,} bytes)")
+            
+            tasks.shutdown()
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Prefetch error: {e!r}")
+        return False
+    finally:
+        database.DB_PATH, cover_cache.THUMBNAIL_DIR = original_paths
+
+
+def test_loan_status():
+    """Test that book lists carry each book's current loan without per-book queries"""
+    print("\nTesting loan status in book lists...")
+    import database
+    original_path = database.DB_PATH
+    try:
+        import connection_manager
+        
+        with tempfile.TemporaryDirectory() as folder:
+            use_temp_database(folder)
+            dune = database.add_book(None, "Dune", "1965", "Frank Herbert")
+            emma = database.add_book(None, "Emma", "1815", "Jane Austen")
+            
+            def status():
+                return {book.id: book.borrower_name for book in database.get_book_summaries()}
+            
+            assert status() == {dune: None, emma: None}
+            first = database.loan_book(dune, "Sam")
+            assert status() == {dune: "Sam", emma: None}
+            page = database.get_books_page(limit=10)
+            assert page[0]['borrower_name'] == "Sam" and page[0]['date_due'] is not None
+            assert database.search_books("dune", summaries=True)[0].borrower_name == "Sam"
+            print("  ✓ Borrower and due date come with the list and search rows")
+            
+            database.return_book(first)
+            assert status() == {dune: None, emma: None}
+            second = database.loan_book(dune, "Alex")
+            assert status()[dune] == "Alex"
+            connection_manager.get_connection(database.DB_PATH).execute(
+                "DELETE FROM loans WHERE id = ?", (second,))
+            assert status()[dune] is None
+            print("  ✓ Kept up to date by loans, returns and deleted loans")
+            
+            # Databases from before the column existed are filled in by the migration
+            conn = connection_manager.get_connection(database.DB_PATH)
+            database.loan_book(emma, "Jo")
+            for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'loans_current_%'").fetchall():
+                conn.execute(f"DROP TRIGGER {name}")
+            conn.execute("UPDATE books SET current_loan_id = NULL")
+            conn.execute("PRAGMA user_version = 4")
+            database.init_database()
+            assert status() == {dune: None, emma: "Jo"}
+            print("  ✓ Migration fills in loans made before it")
+            
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Loan status error: {e!r}")
+        return False
+    finally:
+        database.DB_PATH = original_path
+
+
+def test_overdue_loans():
+    """Test due dates worked out in SQL from the epoch columns"""
+    print("\nTesting overdue loans...")
+    import database
+    original_path = database.DB_PATH
+    try:
+        import time
+        from datetime import datetime
+        import connection_manager
+        
+        with tempfile.TemporaryDirectory() as folder:
+            use_temp_database(folder)
+            conn = connection_manager.get_connection(database.DB_PATH)
+            book = database.add_book(None, "Dune", "1965", "Frank Herbert")
+            now = int(time.time())
+            day = 86400
+            
+            late = database.loan_book(book, "Late", loan_days=-10)
+            database.loan_book(book, "Soon", loan_days=3)
+            database.loan_book(book, "Later", loan_days=30)
+            returned = database.loan_book(book, "Back", loan_days=-40)
+            database.return_book(returned)
+            
+            overdue = database.get_overdue_loans(now=now + day // 2)
+            assert [loan['borrower_name'] for loan in overdue] == ["Late"]
+            due = datetime.fromisoformat(overdue[0]['date_due'])
+            assert overdue[0]['days_overdue'] == (datetime.fromtimestamp(now + day // 2) - due).days == 10
+            statuses = {loan['borrower_name']: (loan['due_status'], loan['days_left'])
+                        for loan in database.get_all_loans(now=now)}
+            assert statuses == {"Late": ('overdue', -10), "Soon": ('due soon', 3),
+                                "Later": ('on loan', 30)}, statuses
+            assert len(database.get_overdue_loans(now=now + 31 * day)) == 3
+            print("  ✓ Days overdue and due-soon buckets computed in SQL")
+            
+            plan = ' '.join(row[3] for row in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT id FROM loans WHERE returned_at IS NULL AND due_at < ?", (now,)))
+            assert 'idx_loans_open_due_at' in plan, plan
+            print("  ✓ Overdue query is a range scan of the open-loans index")
+            
+            # Loans from before the epoch columns are filled in from the ISO dates
+            conn.execute("UPDATE loans SET loaned_at = NULL, due_at = NULL, returned_at = NULL")
+            conn.execute("PRAGMA user_version = 5")
+            database.init_database()
+            row = conn.execute("SELECT date_due, due_at, returned_at FROM loans WHERE id = ?",
+                               (late,)).fetchone()
+            assert row['due_at'] == int(datetime.fromisoformat(row['date_due']).timestamp())
+            assert row['returned_at'] is None
+            assert conn.execute("SELECT returned_at FROM loans WHERE id = ?", (returned,)).fetchone()[0]
+            print("  ✓ Migration converts existing ISO dates")
+            
+            # Writers that only set the ISO dates (older copies of the app, raw SQL)
+            conn.execute("""
+                INSERT INTO loans (book_id, borrower_name, date_loaned, date_due)
+                VALUES (?, 'Raw', '2024-01-01T09:00:00', '2024-01-31T09:00:00')
+            """, (book,))
+            raw = conn.execute("SELECT * FROM loans WHERE borrower_name = 'Raw'").fetchone()
+            assert raw['due_at'] == int(datetime.fromisoformat(raw['date_due']).timestamp())
+            assert "Raw" in [loan['borrower_name'] for loan in database.get_overdue_loans()]
+            conn.execute("UPDATE loans SET date_returned = date_due WHERE id = ?", (raw['id'],))
+            assert "Raw" not in [loan['borrower_name'] for loan in database.get_overdue_loans()]
+            conn.execute("UPDATE loans SET due_at = 0 WHERE id = ?", (late,))
+            assert conn.execute("SELECT due_at FROM loans WHERE id = ?", (late,)).fetchone()[0] \
+                == row['due_at']
+            print("  ✓ Epoch columns follow the ISO dates, however the loan is written")
+            
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Overdue loans error: {e!r}")
+        return False
+    finally:
+        database.DB_PATH = original_path
+
+
+def test_change_detection():
+    """Test per-table change counters and the watcher that polls them"""
+    print("\nTesting change detection...")
+    import database
+    original_path = database.DB_PATH
+    try:
+        import threading
+        import connection_manager
+        from change_watcher import ChangeWatcher
+        
+        with tempfile.TemporaryDirectory() as folder:
+            use_temp_database(folder)
+            root = FakeRoot()
+            changes = []
+            watcher = ChangeWatcher(root, changes.append)
+            
+            assert watcher.check_now() == set() and watcher.reads == 0
+            print("  ✓ Nothing changed: no tables read, no refresh")
+            
+            book = database.add_book(None, "Dune", "1965", "Frank Herbert")
+            assert watcher.check_now() == {'books'}
+            database.loan_book(book, "Alice")
+            assert watcher.check_now() == {'loans'}     # current_loan_id isn't a book change
+            database.update_book(book, title="Dune Messiah")
+            assert watcher.check_now() == {'books'}
+            assert changes == [{'books'}, {'loans'}, {'books'}]
+            print("  ✓ Changes made on this connection picked up per table")
+            
+            # Another connection (as another copy of the app would use)
+            def elsewhere():
+                database.return_book(database.get_current_loan(book)['id'])
+                connection_manager.close_all()
+            thread = threading.Thread(target=elsewhere)
+            thread.start()
+            thread.join()
+            assert watcher.check_now() == {'loans'}
+            print("  ✓ Changes committed by another connection picked up")
+            
+            before = database.table_generations()['books']
+            database.add_books_bulk([{'title': f"Book {n}"} for n in range(100)])
+            assert database.table_generations()['books'] == before + 1
+            assert watcher.check_now() == {'books'}
+            print("  ✓ Bulk insert counts as one change")
+            
+            watcher.start()
+            assert len(root.callbacks) == 1
+            watcher.stop()
+            assert not root.callbacks
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Change detection error: {e!r}")
+        return False
+    finally:
+        database.DB_PATH = original_path
+
+
+def test_busy_retry():
+    """Test that writes wait and retry while another connection holds the lock"""
+    print("\nTesting busy retry...")
+    import database
+    import connection_manager
+    original = (database.DB_PATH, connection_manager.BUSY_TIMEOUT_MS, connection_manager.BUSY_RETRIES)
+    try:
+        import sqlite3
+        import time
+        import stress_test
+        
+        with tempfile.TemporaryDirectory() as folder:
+            connection_manager.BUSY_TIMEOUT_MS = 10
+            # Enough retries that the jittered waits always outlast the 0.3 s lock
+            # (with the default 5 they fall short about 1 run in 75)
+            connection_manager.BUSY_RETRIES = 10
+            use_temp_database(folder)
+            book = database.add_book(None, "Dune", "1965", "Frank Herbert")
+            locked = threading.Event()
+            
+            def hold_lock(seconds):
+                conn = connection_manager.get_connection(database.DB_PATH)
+                conn.execute("BEGIN IMMEDIATE")
+                locked.set()
+                time.sleep(seconds)
+                conn.execute("COMMIT")
+            
+            connection_manager.reset_retry_stats()
+            holder = threading.Thread(target=hold_lock, args=(0.3,))
+            holder.start()
+            locked.wait()
+            database.loan_book(book, "Alice")
+            holder.join()
+            stats = connection_manager.retry_stats()
+            assert database.get_current_loan(book)['borrower_name'] == "Alice"
+            assert stats['retries'] > 0 and stats['gave_up'] == 0, stats
+            print(f"  ✓ Locked write succeeded after {stats['retries']} retries")
+            
+            connection_manager.BUSY_RETRIES = 0
+            locked.clear()
+            holder = threading.Thread(target=hold_lock, args=(0.3,))
+            holder.start()
+            locked.wait()
+            try:
+                database.update_book(book, notes="Too soon")
+                raise AssertionError("write should have failed")
+            except sqlite3.OperationalError as e:
+                assert connection_manager.is_busy_error(e)
+            holder.join()
+            print("  ✓ Gives up with 'database is locked' once out of retries")
+            connection_manager.close_all()
+        
+        connection_manager.BUSY_TIMEOUT_MS, connection_manager.BUSY_RETRIES = original[1:]
+        summary = stress_test.run(processes=2, seconds=1, books=20, busy_timeout=5000, retries=5)
+        assert summary['writes'] > 0 and summary['failed'] == 0, summary['failures']
+        print(f"  ✓ Two processes: {summary['writes']} writes, none failed")
+        return True
+    except Exception as e:
+        print(f"  ✗ Busy retry error: {e!r}")
+        return False
+    finally:
+        database.DB_PATH, connection_manager.BUSY_TIMEOUT_MS, connection_manager.BUSY_RETRIES = original
+
+
+def test_benchmark_suite():
+    """Test the benchmark suite's coverage, statistics and regression check"""
+    print("\nTesting benchmark suite...")
+    import database
+    original_path = database.DB_PATH
+    try:
+        import benchmark_suite
+        
+        assert benchmark_suite.uncovered_functions() == [], benchmark_suite.uncovered_functions()
+        print("  ✓ Every public database function has a benchmark")
+        
+        timings = list(range(1, 101))
+        assert [benchmark_suite.percentile(timings, p) for p in (50, 95, 99)] == [50, 95, 99]
+        
+        results = benchmark_suite.run_size("tiny", 300, repeat=3, budget=0.1, log=lambda line: None)
+        assert set(results) == set(benchmark_suite.CASES)
+        assert all(t['p50_ms'] <= t['p95_ms'] <= t['p99_ms'] for t in results.values())
+        print("  ✓ Synthetic library built and every case timed")
+        
+        baseline = {'results': {'10k': {'get_book': {'p50_ms': 1.0, 'p95_ms': 2.0},
+                                        'count_books': {'p50_ms': 0.01, 'p95_ms': 0.01}}}}
+        current = {'results': {'10k': {'get_book': {'p50_ms': 1.1, 'p95_ms': 3.0},
+                                       'count_books': {'p50_ms': 0.03, 'p95_ms': 0.03},
+                                       'search_books': {'p50_ms': 9.0, 'p95_ms': 9.0}}}}
+        assert benchmark_suite.compare(baseline, current) == [('10k', 'get_book', 'p95_ms', 2.0, 3.0)]
+        print("  ✓ Regressions flagged, jitter and new cases ignored")
+        return True
+    except Exception as e:
+        print(f"  ✗ Benchmark suite error: {e!r}")
+        return False
+    finally:
+        database.DB_PATH = original_path
+
+
+def test_query_stats():
+    """Test opt-in timing of database functions and statements, and the slow-query log"""
+    print("\nTesting query stats...")
+    import database
+    import query_stats
+    original_path = database.DB_PATH
+    original_get_book = database.get_book
+    try:
+        import json
+        import logging
+        import sqlite3
+        import connection_manager
+        
+        with tempfile.TemporaryDirectory() as folder:
+            use_temp_database(folder)
+            book = database.add_book("9780441172719", "Dune", "1965", "Frank Herbert")
+            assert query_stats.snapshot()['functions'] == {}
+            
+            query_stats.reset()
+            query_stats.log.setLevel(logging.ERROR)     # every query is "slow" here
+            query_stats.enable(slow_ms=0)
+            try:
+                assert database.get_book(book)['title'] == "Dune"
+                assert [b.title for b in database.search_books("dune", summaries=True)] == ["Dune"]
+                database.get_books([book, book + 1, book + 2])
+                database.loan_book(book, "Alice")
+                counting = ("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n "
+                            "WHERE i < ?) SELECT i FROM n")
+                cursor = database._connect().execute(counting, (100000,))
+                assert next(iter(cursor))[0] == 1
+                assert len(cursor.fetchall()) == 100000 - query_stats.ITER_BATCH
+                stats = query_stats.snapshot()
+            finally:
+                query_stats.disable()
+            
+            assert stats['functions']['get_book']['calls'] == 1
+            assert stats['functions']['loan_book']['calls'] == 1
+            assert "SELECT * FROM books WHERE id IN (?, ...)" in stats['statements']
+            insert = next(v for sql, v in stats['statements'].items() if sql.startswith("INSERT INTO loans"))
+            assert insert['statements_run'] > 1      # the current-loan and counter triggers
+            assert stats['statements'][counting]['fetch_ms'] > 0
+            print("  ✓ Functions and statements timed, trigger work counted, iteration streamed")
+            
+            slow = next(entry for entry in stats['slow_queries'] if entry['function'] == 'get_book')
+            assert slow['params'] == "(int)" and any('books' in line for line in slow['plan']), slow
+            print("  ✓ Slow queries logged with parameter types and query plan")
+            
+            assert database.get_book is original_get_book
+            assert type(database._connect()) is sqlite3.Connection
+            assert query_stats.snapshot()['functions']['get_book']['calls'] == 1
+            print("  ✓ Disabling restores the plain functions and connection")
+            
+            path = Path(folder) / "stats.json"
+            query_stats.export_json(path)
+            assert json.loads(path.read_text())['functions']['get_book']['calls'] == 1
+            query_stats.reset()
+            assert query_stats.snapshot()['statements'] == {}
+            print("  ✓ Exported as JSON")
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Query stats error: {e!r}")
+        return False
+    finally:
+        query_stats.disable()
+        query_stats.reset()
+        query_stats.log.setLevel(logging.NOTSET)
+        database.DB_PATH = original_path
+
+
+def test_search_results():
+    """Test the ID-based search results behind the virtual treeview"""
+    print("\nTesting search results...")
+    import database
+    original_path = database.DB_PATH
+    try:
+        from types import SimpleNamespace
+        import connection_manager
+        from library_app import find_search_results
+        from widgets import IdRows, VirtualTreeview
+        
+        with tempfile.TemporaryDirectory() as folder:
+            use_temp_database(folder)
+            database.add_books_bulk({'title': f"Book {n:04d}", 'author': "Moore" if n % 3 else "Gaiman"}
+                                    for n in range(1000))
+            
+            for criteria in ({}, {'author': "gaiman"}, {'title': "book 00", 'author': "moore"},
+                             {'title': "ook 01"}, {'author': "nobody"}):
+                ids = find_search_results(criteria)
+                expected = [book.id for book in database.advanced_search(summaries=True, **criteria)]
+                assert list(ids) == expected, criteria
+            ids = find_search_results({})
+            assert len(ids) == database.count_books() == 1000 and ids.itemsize == 8
+            print("  ✓ IDs match advanced_search, Show All included")
+            
+            fetched = []
+            def fetch(book_ids):
+                fetched.append(len(book_ids))
+                return database.get_book_summaries(book_ids)
+            model = IdRows(ids, fetch, lambda book: book.id, overscan=10, max_rows=100)
+            everything = database.get_book_summaries()
+            for top in [0, 3, 6, 500, 990, 980, 0]:
+                assert [book.id for book in model.rows(top, 10)] == [b.id for b in everything[top:top + 10]]
+                assert len(model.cache) <= 100
+            assert model.fetches == 3 and max(fetched) <= 30, (model.fetches, fetched)
+            print("  ✓ Only the rows in view (plus overscan) are fetched, cache bounded")
+            
+            database.delete_book(ids[1])
+            model.reset()
+            assert model.rows(0, 3)[1] is None
+            print("  ✓ Deleted books show as gaps until the search is re-run")
+            
+            class FakeTree:
+                def __init__(self):
+                    self.items, self.selected = {}, ()
+                def get_children(self):
+                    return tuple(self.items)
+                def item(self, iid, text, values):
+                    self.items[iid] = text
+                def insert(self, parent, index, iid, text, values):
+                    self.items[iid] = text
+                def delete(self, *iids):
+                    for iid in iids:
+                        del self.items[iid]
+                def selection(self):
+                    return self.selected
+                def selection_set(self, items):
+                    self.selected = (items,) if isinstance(items, str) else tuple(items)
+            
+            view = VirtualTreeview.__new__(VirtualTreeview)
+            view.tree, view.scrollbar = FakeTree(), SimpleNamespace(set=lambda *a: None)
+            view.make_item = lambda book: (str(book.id), ())
+            view.model = IdRows(fetch=fetch, row_id=lambda book: book.id)
+            view.top, view.visible, view.selected = 0, 20, None
+            view.set_ids(ids)
+            view._move_selection(25)
+            assert view.top == 5 and view.selected_id() == ids[24]
+            assert view.tree.items[view.tree.selected[0]] == str(ids[24])
+            view.scroll_to(500)
+            assert len(view.tree.items) == 20 and view.tree.items['0'] == str(ids[500])
+            assert view.tree.selected == () and view.selected_id() == ids[24]
+            view.set_ids(ids[:10])
+            assert len(view.tree.items) == 10 and view.selected_id() is None
+            print("  ✓ Treeview holds only the visible rows and keeps the selection while scrolling")
+            
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Search results error: {e!r}")
+        return False
+    finally:
+        database.DB_PATH = original_path
+
+
+def test_chunked_renderer():
+    """Test that long lists are added in short, cancellable slices"""
+    print("\nTesting chunked renderer...")
+    try:
+        import time
+        from widgets import ChunkedRenderer
+        
+        root = FakeRoot()
+        renderer = ChunkedRenderer(root, slice_ms=8)
+        added, done = [], []
+        
+        def slow_insert(row):
+            time.sleep(0.001)
+            added.append(row)
+        
+        start = time.perf_counter()
+        renderer.start(range(100), slow_insert, on_done=lambda: done.append(True))
+        first_slice_ms = (time.perf_counter() - start) * 1000
+        assert 0 < len(added) < 100 and renderer.busy
+        assert first_slice_ms < 8 + 5, first_slice_ms
+        print(f"  ✓ First {len(added)} rows in {first_slice_ms:.1f} ms, then back to the event loop")
+        
+        root.run_until_idle()
+        assert added == list(range(100)) and done == [True] and not renderer.busy
+        assert renderer.slices >= 8, renderer.slices
+        print(f"  ✓ All rows added in {renderer.slices} slices")
+        
+        added.clear()
+        renderer.start(range(100), slow_insert)
+        renderer.start(['new'] * 5, added.append, on_done=lambda: done.append(True))
+        root.run_until_idle()
+        assert added.count('new') == 5 and len(added) < 100 and not root.callbacks
+        assert done == [True, True]
+        print("  ✓ A new render cancels the one in progress")
+        return True
+    except Exception as e:
+        print(f"  ✗ Chunked renderer error: {e!r}")
+        return False
+
+
+def test_library_cli():
+    """Test the command-line entry point and that it stays free of Tk, Pillow and requests"""
+    print("\nTesting command line...")
+    import database
+    original_path = database.DB_PATH
+    try:
+        import io
+        import json
+        import subprocess
+        import connection_manager
+        import library_cli
+        
+        with tempfile.TemporaryDirectory() as folder:
+            db = str(Path(folder) / "cli.db")
+            
+            def run(*args):
+                out = io.StringIO()
+                assert library_cli.main(['--db', db, *args], out=out) == 0
+                return out.getvalue()
+            
+            books_csv = Path(folder) / "books.csv"
+            books_csv.write_text("isbn,title,author,page_count\n"
+                                 "9780261103573,The Fellowship of the Ring,J.R.R. Tolkien,423\n"
+                                 ",Dune,Frank Herbert,\n"
+                                 ",,Nobody,\n", encoding='utf-8')
+            assert json.loads(run('import', str(books_csv))) == {'record': 3,
+                                                                 'error': "Title is required"}
+            
+            found = [json.loads(line) for line in run('search', 'fellowship').splitlines()]
+            assert [book['title'] for book in found] == ["The Fellowship of the Ring"]
+            assert run('search', '--author', 'herbert', '--format', 'csv').splitlines()[1] \
+                .startswith(f"{found[0]['id'] + 1},Dune,Frank Herbert")
+            
+            exported = [json.loads(line) for line in run('export').splitlines()]
+            assert [book['title'] for book in exported] == ["Dune", "The Fellowship of the Ring"]
+            assert exported[1]['page_count'] == 423
+            export_file = Path(folder) / "books.jsonl"
+            run('export', '--output', str(export_file))
+            assert run('import', str(export_file)) == ""      # no errors
+            assert database.count_books() == 3                # Dune has no ISBN to match on
+            print("  ✓ import, search and export stream JSON lines and CSV")
+            
+            book_id = found[0]['id']
+            database.loan_book(book_id, "Alice", loan_days=-3)
+            overdue = [json.loads(line) for line in run('overdue').splitlines()]
+            assert [(loan['book_id'], loan['days_overdue']) for loan in overdue] == [(book_id, 3)]
+            assert json.loads(run('overdue', '--all'))['due_status'] == 'overdue'
+            print("  ✓ overdue report")
+            
+            missing = str(Path(folder) / "no such folder" / "x.db")
+            result = subprocess.run([sys.executable, 'library_cli.py', '--db', missing, 'overdue'],
+                                    capture_output=True, text=True, cwd=Path(__file__).parent)
+            assert result.returncode == 1, (result.returncode, result.stderr)
+            assert result.stderr.startswith("Error: ") and len(result.stderr.splitlines()) == 1, \
+                result.stderr
+            print("  ✓ Database errors reported in one line, exit status 1")
+            
+            check = ("import io, sys, library_cli\n"
+                     f"for args in (['overdue'], ['search', 'dune'], ['export']):\n"
+                     f"    library_cli.main(['--db', {db!r}, *args], out=io.StringIO())\n"
+                     "print(sorted(m for m in ('tkinter', 'PIL', 'requests') if m in sys.modules))")
+            result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True,
+                                    cwd=Path(__file__).parent)
+            assert result.stdout.strip() == "[]", (result.stdout, result.stderr)
+            print("  ✓ tkinter, Pillow and requests never imported")
+            
+            # enrich needs Pillow and requests, but still not Tk (nothing to enrich here,
+            # so no requests are made)
+            check = ("import io, sys, library_cli\n"
+                     f"library_cli.main(['--db', {db!r}, 'enrich', '--limit', '0'], out=io.StringIO())\n"
+                     "print(sorted(m for m in ('tkinter', 'PIL', 'requests') if m in sys.modules))")
+            result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True,
+                                    cwd=Path(__file__).parent)
+            assert result.stdout.strip() == "['PIL', 'requests']", (result.stdout, result.stderr)
+            print("  ✓ enrich never imports tkinter")
+            connection_manager.close_all()
+        return True
+    except Exception as e:
+        print(f"  ✗ Command line error: {e!r}")
+        return False
+    finally:
+        database.DB_PATH = original_path
+
+
 def test_isbn_lookup():
     """Test ISBN lookup functionality"""
     print("\nTesting ISBN lookup...")
@@ -79,6 +1601,29 @@ def main():
     
     # Run tests
     results.append(("Database", test_database()))
+    results.append(("Connection Pooling", test_connection_pooling()))
+    results.append(("Migrations", test_migrations()))
+    results.append(("Search", test_search()))
+    results.append(("Bulk Insert", test_bulk_insert()))
+    results.append(("Paged Book List", test_paged_book_list()))
+    results.append(("Background Refresh", test_background_refresh()))
+    results.append(("ISBN Cache", test_isbn_cache()))
+    results.append(("Batched Lookup", test_batched_lookup()))
+    results.append(("Enrichment", test_enrichment()))
+    results.append(("Cover Cache", test_cover_cache()))
+    results.append(("Cover Download", test_cover_download()))
+    results.append(("Async Lookup", test_async_lookup()))
+    results.append(("Intake", test_intake()))
+    results.append(("Prefetch", test_prefetch()))
+    results.append(("Loan Status", test_loan_status()))
+    results.append(("Overdue Loans", test_overdue_loans()))
+    results.append(("Change Detection", test_change_detection()))
+    results.append(("Busy Retry", test_busy_retry()))
+    results.append(("Benchmark Suite", test_benchmark_suite()))
+    results.append(("Query Stats", test_query_stats()))
+    results.append(("Search Results", test_search_results()))
+    results.append(("Chunked Renderer", test_chunked_renderer()))
+    results.append(("Command Line", test_library_cli()))
     results.append(("ISBN Lookup", test_isbn_lookup()))
     results.append(("GUI Imports", test_gui_imports()))
     
@@ -0,0 +1,511 @@
+"""
+Custom widgets for Callum's Library App
+"""
+
+import difflib
+import time
+import tkinter as tk
+from array import array
+from collections import OrderedDict
+from tkinter import font as tkfont
+from tkinter import ttk
+
+RENDER_SLICE_MS = 8         # longest a ChunkedRenderer blocks the event loop at a time
+
+
+class PagedRows:
+    """
+    A window of rows from a large, sorted, paged data source
+
+    Only the rows around the visible range (plus some overscan) are held in
+    memory. Moving a little up or down extends the window one page at a time
+    from the keys at its edges; jumping elsewhere refetches by position.
+
+    The source must provide:
+        count()                  - total number of rows
+        page_after(key, limit)   - rows after key (key None = from the start)
+        page_before(key, limit)  - rows before key, in list order
+        page_at(offset, limit)   - rows starting at a row number
+        count_before(key)        - row number a key would have
+        key(row)                 - sort key of a row
+    """
+
+    def __init__(self, source, overscan=20, max_rows=600):
+        self.overscan = overscan
+        self.max_rows = max_rows
+        self.reset(source)
+
+    def reset(self, source, window=None):
+        """
+        Switch to a new source (or re-read the current one) and drop cached rows
+
+        window is an optional (total, start, rows) from load_window(), so the
+        counting and first fetch can be done off the main thread.
+        """
+        self.source = source
+        if window is not None:
+            self.total, self.start, rows = window
+            self.cache = list(rows)
+        else:
+            self.total = source.count() if source else 0
+            self.start = 0      # row number of self.cache[0]
+            self.cache = []
+
+    def rows(self, start, count):
+        """Get rows [start, start + count), fetching whatever isn't cached"""
+        start = max(0, min(start, self.total))
+        end = min(self.total, start + count)
+        if start >= end:
+            return []
+
+        cache_end = self.start + len(self.cache)
+        if not self.cache or start > cache_end or end < self.start:
+            # Nowhere near what we have - fetch by position
+            self.start = max(0, start - self.overscan)
+            self.cache = self.source.page_at(self.start, end - self.start + self.overscan)
+        else:
+            if end > cache_end:
+                key = self.source.key(self.cache[-1])
+                self.cache.extend(self.source.page_after(key, end - cache_end + self.overscan))
+            if start < self.start:
+                key = self.source.key(self.cache[0])
+                before = self.source.page_before(key, self.start - start + self.overscan)
+                self.cache[:0] = before
+                self.start -= len(before)
+            self._trim(start, end)
+
+        return self.cache[start - self.start:end - self.start]
+
+    def _trim(self, start, end):
+        """Drop cached rows far from [start, end) once the cache gets too big"""
+        if len(self.cache) <= self.max_rows:
+            return
+        keep_from = max(self.start, start - self.overscan)
+        keep_to = min(self.start + len(self.cache), end + self.overscan)
+        self.cache = self.cache[keep_from - self.start:keep_to - self.start]
+        self.start = keep_from
+
+    def position_of(self, key):
+        """Row number of the first row at or after key"""
+        return self.source.count_before(key) if self.source else 0
+
+
+def load_window(source, top, count, overscan=20):
+    """
+    Fetch everything a PagedRows needs to show count rows from top
+
+    Safe to run on a worker thread; pass the result to PagedRows.reset or
+    VirtualListbox.set_source.
+    """
+    total = source.count()
+    top = max(0, min(top, total - count))
+    start = max(0, top - overscan)
+    return total, start, source.page_at(start, top - start + count + overscan)
+
+
+class VirtualScrolling:
+    """
+    Scrolling and keyboard selection for the virtual list widgets
+
+    Shared by VirtualListbox and VirtualTreeview, which provide self.model
+    (with a total row count), self.top, self.visible, self.selected,
+    self.scrollbar and render(). The inner widget's scroll and selection
+    keys are bound by _bind_scrolling; _selection_moved() is called after
+    the keyboard moves the selection.
+    """
+
+    def scroll_to(self, position):
+        """Scroll so that row number position is at the top"""
+        self.top = position
+        self._clamp_top()
+        self.render()
+
+    def _bind_scrolling(self, widget):
+        widget.bind('<MouseWheel>', self._on_mousewheel)
+        widget.bind('<Button-4>', lambda e: self._scroll_and_break(-3))
+        widget.bind('<Button-5>', lambda e: self._scroll_and_break(3))
+        widget.bind('<Up>', lambda e: self._move_selection(-1))
+        widget.bind('<Down>', lambda e: self._move_selection(1))
+        widget.bind('<Prior>', lambda e: self._move_selection(-self.visible))
+        widget.bind('<Next>', lambda e: self._move_selection(self.visible))
+        widget.bind('<Home>', lambda e: self._move_selection(-self.model.total))
+        widget.bind('<End>', lambda e: self._move_selection(self.model.total))
+
+    def _update_scrollbar(self):
+        total = self.model.total
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.visible) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def _clamp_top(self):
+        self.top = max(0, min(self.top, self.model.total - self.visible))
+
+    def _on_scrollbar(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.scroll_to(int(float(amount) * self.model.total))
+        elif action == 'scroll':
+            step = self.visible if unit == 'pages' else 1
+            self.scroll_to(self.top + int(amount) * step)
+
+    def _on_mousewheel(self, event):
+        return self._scroll_and_break(-3 if event.delta > 0 else 3)
+
+    def _scroll_and_break(self, rows):
+        self.scroll_to(self.top + rows)
+        return 'break'
+
+    def _move_selection(self, step):
+        if not self.model.total:
+            return 'break'
+        current = self.selected if self.selected is not None else self.top - (1 if step > 0 else 0)
+        self.selected = max(0, min(self.model.total - 1, current + step))
+        if self.selected < self.top:
+            self.top = self.selected
+        elif self.selected >= self.top + self.visible:
+            self.top = self.selected - self.visible + 1
+        self._clamp_top()
+        self.render()
+        self._selection_moved()
+        return 'break'
+
+    def _selection_moved(self):
+        pass
+
+
+class VirtualListbox(VirtualScrolling, ttk.Frame):
+    """
+    A Listbox for very long lists that only holds the rows on screen
+
+    The Listbox itself contains just the visible rows; scrolling is driven by
+    our own scrollbar and key/mouse bindings, which move a window over a
+    PagedRows cache. format_row turns a row into its display text.
+    Emits <<ListboxSelect>> when the selection changes, like a Listbox.
+    """
+
+    def __init__(self, parent, format_row, source=None, overscan=20, **listbox_options):
+        super().__init__(parent)
+        self.format_row = format_row
+        self.model = PagedRows(source, overscan=overscan)
+        self.top = 0                # row number of the first visible row
+        self.visible = 1            # rows that fit in the Listbox
+        self.selected = None        # row number of the selected row
+        self.shown = []             # display text of the rows currently in the Listbox
+
+        self.scrollbar = ttk.Scrollbar(self, command=self._on_scrollbar)
+        self.scrollbar.pack(side='right', fill='y')
+        self.listbox = tk.Listbox(self, activestyle='none', exportselection=False,
+                                  **listbox_options)
+        self.listbox.pack(side='left', fill='both', expand=True)
+
+        self.listbox.bind('<Configure>', self._on_resize)
+        self.listbox.bind('<<ListboxSelect>>', self._on_click_select)
+        self._bind_scrolling(self.listbox)
+        self.listbox.bind('<Key>', self._on_key)
+
+    # Public API
+
+    def set_source(self, source, keep_position=False, window=None):
+        """
+        Show a new source; keep_position holds the scroll position (for refreshes)
+
+        window is an optional preloaded (total, start, rows) from load_window().
+        """
+        self.model.reset(source, window)
+        if not keep_position:
+            self.top = 0
+            self.selected = None
+        self._clamp_top()
+        self.render()
+
+    def refresh(self):
+        """Re-read the current source, keeping the scroll position"""
+        self.set_source(self.model.source, keep_position=True)
+
+    def selected_row(self):
+        """The selected row, or None"""
+        if self.selected is None or self.selected >= self.model.total:
+            return None
+        rows = self.model.rows(self.selected, 1)
+        return rows[0] if rows else None
+
+    def rows_near_selection(self, distance):
+        """Rows up to distance away from the selected row, nearest first (not the row itself)"""
+        if self.selected is None:
+            return []
+        start = max(0, self.selected - distance)
+        rows = self.model.rows(start, self.selected + distance + 1 - start)
+        here = self.selected - start
+        order = sorted(range(len(rows)), key=lambda i: (abs(i - here), i < here))
+        return [rows[i] for i in order if i != here]
+
+    def jump_to_key(self, key):
+        """Scroll to the first row at or after a sort key (e.g. a letter)"""
+        self.scroll_to(self.model.position_of(key))
+
+    def render(self):
+        """Put the visible rows into the Listbox"""
+        rows = self.model.rows(self.top, self.visible)
+        texts = [self.format_row(row) for row in rows]
+
+        if texts != self.shown:
+            self._apply_changes(self.shown, texts)
+        self.shown = texts
+
+        self.listbox.selection_clear(0, 'end')
+        if self.selected is not None and self.top <= self.selected < self.top + len(rows):
+            self.listbox.selection_set(self.selected - self.top)
+
+        self._update_scrollbar()
+
+    # Internals
+
+    def _apply_changes(self, old, new):
+        """Turn the Listbox contents from old into new with as few inserts/deletes as possible"""
+        opcodes = difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes()
+        # Work from the bottom up so earlier indexes stay valid
+        for tag, i1, i2, j1, j2 in reversed(opcodes):
+            if tag in ('replace', 'delete'):
+                self.listbox.delete(i1, i2 - 1)
+            if tag in ('replace', 'insert'):
+                self.listbox.insert(i1, *new[j1:j2])
+
+    def _on_resize(self, event):
+        # Same line height the Listbox itself uses
+        try:
+            font = tkfont.nametofont(self.listbox.cget('font'))
+        except tk.TclError:
+            font = tkfont.Font(font=self.listbox.cget('font'))
+        linespace = font.metrics('linespace')
+        line_height = linespace + 1 + 2 * int(self.listbox.cget('selectborderwidth'))
+        inner = event.height - 2 * (int(self.listbox.cget('borderwidth')) +
+                                    int(self.listbox.cget('highlightthickness')))
+        visible = max(1, inner // line_height)
+        if visible != self.visible:
+            self.visible = visible
+            self._clamp_top()
+            self.render()
+
+    def _on_click_select(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            self.selected = self.top + selection[0]
+            self.event_generate('<<ListboxSelect>>')
+
+    def _selection_moved(self):
+        self.event_generate('<<ListboxSelect>>')
+
+    def _on_key(self, event):
+        # Typing a letter jumps to the first title starting with it
+        if len(event.char) == 1 and event.char.isalnum():
+            self.jump_to_key((event.char, 0))
+            return 'break'
+        return None
+
+
+class IdRows:
+    """
+    Rows for a fixed list of IDs, fetched only when asked for
+
+    The IDs are held as a compact array, so a result set of a million books
+    costs 8 MB rather than a million row objects. fetch(ids) must return the
+    rows for those IDs (in any order; IDs that no longer exist may be left
+    out) and row_id(row) the ID of a row. Fetched rows are kept in a small
+    least-recently-used cache.
+    """
+
+    def __init__(self, ids=(), fetch=None, row_id=None, overscan=20, max_rows=500):
+        self.fetch = fetch
+        self.row_id = row_id
+        self.overscan = overscan
+        self.max_rows = max_rows
+        self.reset(ids)
+
+    def reset(self, ids=None):
+        """Switch to new IDs (or keep the current ones) and forget the cached rows"""
+        if ids is not None:
+            self.ids = ids if isinstance(ids, array) else array('q', ids)
+        self.cache = OrderedDict()      # ID -> row
+        self.fetches = 0
+
+    @property
+    def total(self):
+        return len(self.ids)
+
+    def rows(self, start, count):
+        """Get the rows for ids[start:start + count], None for any that have gone"""
+        start = max(0, min(start, self.total))
+        wanted = self.ids[start:start + count]
+        missing = [book_id for book_id in wanted if book_id not in self.cache]
+        if missing:
+            # Fetch the neighbours too, so scrolling a little is served from the cache
+            first = max(0, start - self.overscan)
+            nearby = self.ids[first:start + count + self.overscan]
+            to_fetch = [book_id for book_id in nearby if book_id not in self.cache]
+            self.fetches += 1
+            fetched = {self.row_id(row): row for row in self.fetch(to_fetch)}
+            for book_id in to_fetch:
+                self.cache[book_id] = fetched.get(book_id)
+        rows = []
+        for book_id in wanted:
+            self.cache.move_to_end(book_id)
+            rows.append(self.cache[book_id])
+        while len(self.cache) > self.max_rows:
+            self.cache.popitem(last=False)
+        return rows
+
+
+class VirtualTreeview(VirtualScrolling, ttk.Frame):
+    """
+    A Treeview for very large result sets that only holds the rows on screen
+
+    The results are a list of IDs (see IdRows); as the user scrolls, the
+    Treeview's few items are refilled with the rows now in view. make_item
+    turns a row into (text, values) for Treeview.insert. Configure headings
+    and columns on self.tree as usual. Emits <<TreeviewSelect>> from
+    self.tree when the selection changes.
+    """
+
+    def __init__(self, parent, make_item, fetch, row_id, overscan=20, **treeview_options):
+        super().__init__(parent)
+        self.make_item = make_item
+        self.model = IdRows(fetch=fetch, row_id=row_id, overscan=overscan)
+        self.top = 0                # position of the first visible row
+        self.visible = 10           # rows that fit in the Treeview
+        self.selected = None        # position of the selected row
+
+        self.scrollbar = ttk.Scrollbar(self, command=self._on_scrollbar)
+        self.scrollbar.pack(side='right', fill='y')
+        self.tree = ttk.Treeview(self, **treeview_options)
+        self.tree.pack(side='left', fill='both', expand=True)
+
+        self.tree.bind('<Configure>', self._on_resize)
+        self.tree.bind('<<TreeviewSelect>>', self._on_click_select, add=True)
+        self._bind_scrolling(self.tree)
+
+    # Public API
+
+    def set_ids(self, ids, keep_position=False):
+        """Show new results; keep_position holds the scroll position (for refreshes)"""
+        self.model.reset(ids)
+        if not keep_position or self.selected is not None and self.selected >= self.model.total:
+            self.selected = None
+        if not keep_position:
+            self.top = 0
+        self._clamp_top()
+        self.render()
+
+    def clear(self):
+        """Show no results"""
+        self.set_ids(())
+
+    def refresh(self):
+        """Re-read the rows of the current results (e.g. after an edit)"""
+        self.model.reset()
+        self.render()
+
+    def selected_id(self):
+        """ID of the selected row, or None"""
+        if self.selected is None or self.selected >= self.model.total:
+            return None
+        return self.model.ids[self.selected]
+
+    def render(self):
+        """Fill the Treeview's items with the visible rows"""
+        rows = self.model.rows(self.top, self.visible)
+        items = self.tree.get_children()
+        # One item per visible slot, reused as the view scrolls
+        for slot, row in enumerate(rows):
+            text, values = self.make_item(row) if row is not None else ("", ("(deleted)",))
+            iid = str(slot)
+            if slot < len(items):
+                self.tree.item(iid, text=text, values=values)
+            else:
+                self.tree.insert('', 'end', iid=iid, text=text, values=values)
+        if len(items) > len(rows):
+            self.tree.delete(*items[len(rows):])
+
+        if self.selected is not None and self.top <= self.selected < self.top + len(rows):
+            self.tree.selection_set(str(self.selected - self.top))
+        elif self.tree.selection():
+            self.tree.selection_set(())
+
+        self._update_scrollbar()
+
+    # Internals
+
+    def _on_resize(self, event):
+        children = self.tree.get_children()
+        box = self.tree.bbox(children[0]) if children else None
+        if box:
+            first_y, row_height = box[1], box[3]
+        else:
+            row_height = int(ttk.Style().lookup('Treeview', 'rowheight') or 20)
+            first_y = row_height + 4       # below the headings
+        visible = max(1, (event.height - first_y) // row_height)
+        if visible != self.visible:
+            self.visible = visible
+            self._clamp_top()
+            self.render()
+
+    def _on_click_select(self, event):
+        # Also fires for selections render() makes, which agree with self.selected;
+        # an empty selection just means the selected row is scrolled out of view
+        selection = self.tree.selection()
+        if selection:
+            self.selected = self.top + int(selection[0])
+
+
+class ChunkedRenderer:
+    """
+    Adds rows to a widget a few milliseconds at a time on the Tk event loop
+
+    start(rows, insert) calls insert(row) for each row, but hands control
+    back to Tk every slice_ms so the window keeps redrawing and responding
+    to clicks and keys. The first slice runs straight away, so the first
+    rows appear at once. Starting again cancels a render in progress.
+    """
+
+    def __init__(self, root, slice_ms=RENDER_SLICE_MS):
+        self.root = root
+        self.slice_ms = slice_ms
+        self._rows = None           # iterator over the rows still to add
+        self._insert = None
+        self._on_done = None
+        self._after_id = None
+        self.slices = 0             # slices the current (or last) render took
+
+    @property
+    def busy(self):
+        """Whether a render is in progress"""
+        return self._rows is not None
+
+    def start(self, rows, insert, on_done=None):
+        """Start adding rows with insert(row); on_done() is called once all are in"""
+        self.cancel()
+        self._rows = iter(rows)
+        self._insert = insert
+        self._on_done = on_done
+        self.slices = 0
+        self._run_slice()
+
+    def cancel(self):
+        """Stop the render in progress, leaving the rows added so far"""
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+        self._rows = None
+
+    def _run_slice(self):
+        self._after_id = None
+        self.slices += 1
+        rows = self._rows
+        deadline = time.perf_counter() + self.slice_ms / 1000
+        for row in rows:
+            self._insert(row)
+            if time.perf_counter() >= deadline:
+                self._after_id = self.root.after(1, self._run_slice)
+                return
+        self._rows = None
+        if self._on_done is not None:
+            self._on_done()